@@ -0,0 +1,359 @@
+"""
+Benchmarks the kernel against a local stand-in of the OpenAI API.
+
+Every scenario starts real kernels (`python -m openai_kernel`) pointed at a
+`StandInServer`, runs cells through a jupyter client and reports the
+per-cell kernel overhead (cell wall time minus the time the server spent
+answering), throughput and the growth of the kernel's resident memory.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --scenario small_cells --latency 0.05
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline results.json --tolerance 0.25
+
+With `--baseline` the results are compared against an earlier `--output`
+and the exit status is 1 when a metric regressed by more than the
+tolerance.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from jupyter_client import KernelManager
+from jupyter_client.kernelspec import KernelSpecManager
+
+from openai_kernel.metrics import percentile
+from openai_kernel.stand_in import StandInServer
+
+KERNEL_NAME = "openai_bench"
+
+# differences below these are noise, whatever the relative change
+NOISE_FLOORS = {"_ms": 1.0, "_mb": 5.0, "_per_s": 1.0}
+
+
+def get_rss_mb(pid):
+    """Returns the resident memory of a process in MB, or None off Linux."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class BenchKernel:
+    """A kernel process and a blocking client to run cells on it."""
+
+    def __init__(self, spec_manager, server):
+        self.server = server
+        self.manager = KernelManager(
+            kernel_name=KERNEL_NAME, kernel_spec_manager=spec_manager
+        )
+        self.manager.start_kernel()
+        self.client = self.manager.client()
+        self.client.start_channels()
+        self.client.wait_for_ready(timeout=60)
+
+    @property
+    def rss_mb(self):
+        return get_rss_mb(self.manager.provisioner.process.pid)
+
+    def execute(self, code, timeout=600):
+        """Run a cell, returning its wall time and the server's busy time."""
+        busy = self.server.busy_seconds
+        start = time.perf_counter()
+        reply = self.client.execute_interactive(
+            code, timeout=timeout, output_hook=lambda msg: None
+        )
+        elapsed = time.perf_counter() - start
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(f"Cell {code!r} failed: {reply['content']}")
+        return elapsed, self.server.busy_seconds - busy
+
+    def shutdown(self):
+        self.client.stop_channels()
+        self.manager.shutdown_kernel(now=True)
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.spec_dir = tempfile.mkdtemp(prefix="openai_bench")
+        self.spec_manager = KernelSpecManager(kernel_dirs=[self.spec_dir])
+
+    def close(self):
+        shutil.rmtree(self.spec_dir, ignore_errors=True)
+
+    @contextmanager
+    def server(self):
+        args = self.args
+        server = StandInServer(
+            latency=args.latency,
+            chunk_interval=args.chunk_interval,
+            payload_size=args.payload_size,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            seed=args.seed,
+        )
+        url = server.start()
+        os.makedirs(os.path.join(self.spec_dir, KERNEL_NAME), exist_ok=True)
+        with open(os.path.join(self.spec_dir, KERNEL_NAME, "kernel.json"), "w") as f:
+            json.dump(
+                {
+                    "argv": [sys.executable, "-m", "openai_kernel"]
+                    + ["-f", "{connection_file}"],
+                    "display_name": "OpenAI (benchmark)",
+                    "language": "openai",
+                    "env": {"OPENAI_API_BASE": url, "OPENAI_API_KEY": "sk-stand-in"},
+                },
+                f,
+            )
+        try:
+            yield server
+        finally:
+            server.stop()
+
+    @contextmanager
+    def kernel(self, server, setup=()):
+        kernel = BenchKernel(self.spec_manager, server)
+        try:
+            if self.args.stream:
+                kernel.execute("%set stream True")
+            for code in setup:
+                kernel.execute(code)
+            yield kernel
+        finally:
+            kernel.shutdown()
+
+
+def run_cells(kernel, prompts):
+    """Returns the per-cell overheads (seconds) and the total wall time."""
+    overheads = []
+    start = time.perf_counter()
+    for prompt in prompts:
+        elapsed, busy = kernel.execute(prompt)
+        overheads.append(max(0.0, elapsed - busy))
+    return overheads, time.perf_counter() - start
+
+
+def summarize(overheads, wall, rss_before=None, rss_after=None):
+    result = {
+        "cells": len(overheads),
+        "overhead_p50_ms": percentile(overheads, 50) * 1000,
+        "overhead_p95_ms": percentile(overheads, 95) * 1000,
+        "throughput_cells_per_s": len(overheads) / wall,
+    }
+    if rss_before is not None and rss_after is not None:
+        result["memory_growth_mb"] = rss_after - rss_before
+    return result
+
+
+def small_cells(bench):
+    """Many short, independent cells."""
+    cells = bench.args.cells
+    with bench.server() as server, bench.kernel(
+        server, ["%set use_history False"]
+    ) as kernel:
+        kernel.execute("warm up")
+        rss_before = kernel.rss_mb
+        overheads, wall = run_cells(kernel, [f"cell {i}" for i in range(cells)])
+        return summarize(overheads, wall, rss_before, kernel.rss_mb)
+
+
+def long_history(bench):
+    """A session that keeps adding to the chat history, turn after turn."""
+    turns = bench.args.turns
+    with bench.server() as server, bench.kernel(server) as kernel:
+        rss_before = kernel.rss_mb
+        prompts = [f"turn {i} " + "word " * 20 for i in range(turns)]
+        overheads, wall = run_cells(kernel, prompts)
+        result = summarize(overheads, wall, rss_before, kernel.rss_mb)
+        # how much slower the last turns are than the first ones
+        window = max(1, turns // 10)
+        first = percentile(overheads[:window], 50)
+        last = percentile(overheads[-window:], 50)
+        result["overhead_growth_ms"] = (last - first) * 1000
+        return result
+
+
+def large_images(bench):
+    """Image cells returning several full size images each."""
+    setup = ["%mode image", f"%set n {bench.args.images}", "%set size 1024x1024"]
+    with bench.server() as server, bench.kernel(server, setup) as kernel:
+        kernel.execute("warm up")
+        rss_before = kernel.rss_mb
+        prompts = [f"image {i}" for i in range(bench.args.image_cells)]
+        overheads, wall = run_cells(kernel, prompts)
+        result = summarize(overheads, wall, rss_before, kernel.rss_mb)
+        result["images_per_s"] = len(prompts) * bench.args.images / wall
+        return result
+
+
+def concurrent_kernels(bench):
+    """Several kernels sending cells to the same server at once."""
+    count = bench.args.kernels
+    cells = bench.args.cells
+    results = [None] * count
+    with ExitStack() as stack:
+        server = stack.enter_context(bench.server())
+        kernels = [
+            stack.enter_context(bench.kernel(server, ["%set use_history False"]))
+            for _ in range(count)
+        ]
+        for kernel in kernels:
+            kernel.execute("warm up")
+
+        def run(i):
+            prompts = [f"kernel {i} cell {j}" for j in range(cells)]
+            results[i] = [kernels[i].execute(prompt)[0] for prompt in prompts]
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+    # the server is shared, so busy times overlap: report cell latency instead
+    latencies = [elapsed for timings in results for elapsed in timings]
+    return {
+        "kernels": count,
+        "cells": len(latencies),
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "throughput_cells_per_s": len(latencies) / wall,
+    }
+
+
+def startup(bench):
+    """Starting a kernel until it is ready, then its first chat cell."""
+    ready = []
+    first_cell = []
+    with bench.server() as server:
+        for _ in range(bench.args.starts):
+            start = time.perf_counter()
+            kernel = BenchKernel(bench.spec_manager, server)
+            try:
+                ready.append(time.perf_counter() - start)
+                first_cell.append(kernel.execute("first cell")[0])
+            finally:
+                kernel.shutdown()
+    return {
+        "starts": len(ready),
+        "ready_p50_ms": percentile(ready, 50) * 1000,
+        "ready_p95_ms": percentile(ready, 95) * 1000,
+        "first_cell_p50_ms": percentile(first_cell, 50) * 1000,
+        "first_cell_p95_ms": percentile(first_cell, 95) * 1000,
+    }
+
+
+SCENARIOS = {
+    "small_cells": small_cells,
+    "long_history": long_history,
+    "large_images": large_images,
+    "concurrent_kernels": concurrent_kernels,
+    "startup": startup,
+}
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def compare(results, baseline, tolerance):
+    """Returns (scenario, metric, baseline, current) tuples of regressions."""
+    regressions = []
+    for scenario, metrics in results["scenarios"].items():
+        for metric, old in baseline.get("scenarios", {}).get(scenario, {}).items():
+            new = metrics.get(metric)
+            if new is None or old is None or metric in ("cells", "kernels", "starts"):
+                continue
+            change = old - new if higher_is_better(metric) else new - old
+            floor = next(
+                (v for suffix, v in NOISE_FLOORS.items() if metric.endswith(suffix)),
+                0,
+            )
+            if change > max(floor, abs(old) * tolerance):
+                regressions.append((scenario, metric, old, new))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenarios to run (all by default), can be repeated",
+    )
+    parser.add_argument("--cells", type=int, default=200, help="Cells per kernel")
+    parser.add_argument("--turns", type=int, default=1000, help="Long history turns")
+    parser.add_argument("--images", type=int, default=4, help="Images per cell")
+    parser.add_argument("--image-cells", type=int, default=5, help="Image cells")
+    parser.add_argument("--kernels", type=int, default=4, help="Concurrent kernels")
+    parser.add_argument("--starts", type=int, default=5, help="Kernel starts")
+    parser.add_argument("--stream", action="store_true", help="Stream chat answers")
+    parser.add_argument("--latency", type=float, default=0, help="Server latency")
+    parser.add_argument(
+        "--chunk-interval", type=float, default=0, help="Seconds between chunks"
+    )
+    parser.add_argument(
+        "--payload-size", type=int, default=0, help="Minimum answer length"
+    )
+    parser.add_argument("--error-rate", type=float, default=0, help="500 rate")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="429 rate")
+    parser.add_argument("--seed", type=int, default=0, help="Server random seed")
+    parser.add_argument("-o", "--output", help="Write the results to a JSON file")
+    parser.add_argument("-b", "--baseline", help="Compare against a results file")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative change allowed before a metric counts as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}
+    results = {"config": config, "scenarios": {}}
+    bench = Bench(args)
+    try:
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}...", file=sys.stderr)
+            results["scenarios"][name] = SCENARIOS[name](bench)
+    finally:
+        bench.close()
+
+    for name, metrics in results["scenarios"].items():
+        print(name)
+        for metric, value in metrics.items():
+            print(f"  {metric:<24} {value:.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for scenario, metric, old, new in regressions:
+            print(f"REGRESSION {scenario}.{metric}: {old:.2f} -> {new:.2f}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
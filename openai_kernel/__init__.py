@@ -1,3 +1,12 @@
 from .kernel import OpenAIKernel  # noqa
+from .magics import BackendMagic  # noqa
+from .magics import BatchMagic  # noqa
+from .magics import CacheMagic  # noqa
 from .magics import ClearHistoryMagic  # noqa
+from .magics import OverFileMagic  # noqa
+from .magics import RaceMagic  # noqa
+from .magics import SearchMagic  # noqa
+from .magics import SemanticCacheMagic  # noqa
+from .magics import StatsMagic  # noqa
+from .magics import ThreadMagic  # noqa
 from .magics import HistoryMagic, ModeMagic, OpenAIApiMagic, SetMagic
@@ -1,4 +1,19 @@
-from openai_kernel.kernel import OpenAIKernel
+import sys
 
 if __name__ == "__main__":
-    OpenAIKernel.run_as_main()
+    if "--profile-startup" in sys.argv[1:]:
+        from openai_kernel.startup import print_startup_profile
+
+        print_startup_profile()
+    elif sys.argv[1:2] == ["gateway"]:
+        from openai_kernel.gateway import main
+
+        sys.exit(main(sys.argv[2:]))
+    elif sys.argv[1:2] == ["run"]:
+        from openai_kernel.runner import main
+
+        sys.exit(main(sys.argv[2:]))
+    else:
+        from openai_kernel.kernel import OpenAIKernel
+
+        OpenAIKernel.run_as_main()
@@ -0,0 +1,174 @@
+import fnmatch
+import threading
+import time
+
+from .scheduler import is_retryable
+
+ROUTING_POLICIES = ("order", "latency")
+# weight of the newest sample in a backend's latency average
+LATENCY_ALPHA = 0.3
+
+
+def should_fall_back(e):
+    """Whether a failed request should be tried on the next backend."""
+    from openai import error
+
+    return is_retryable(e) or isinstance(e, error.Timeout)
+
+
+class Backend:
+    """
+    An OpenAI compatible server: its base URL, key, the models it serves
+    (glob patterns, all models when empty) and its health and latency.
+
+    The "openai" backend has no `api_base` and uses the openai library's
+    settings. Other backends never get the library's key, so an OpenAI key
+    isn't sent to a self-hosted server.
+    """
+
+    def __init__(self, name, api_base=None, api_key=None, models=(), priority=0):
+        self.name = name
+        self.api_base = api_base.rstrip("/") if api_base else None
+        self.api_key = api_key
+        self.models = tuple(models)
+        self.priority = priority
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_error = None
+
+    def serves(self, model):
+        return not self.models or any(
+            fnmatch.fnmatchcase(model, pattern) for pattern in self.models
+        )
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.down_until
+
+    def request_kwargs(self):
+        """The arguments sending an openai library request to this backend."""
+        if self.api_base is None:
+            return {}
+        return {"api_base": self.api_base, "api_key": self.api_key or "no-key"}
+
+    def record_success(self, latency):
+        self.failures = 0
+        self.down_until = 0.0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+
+    def record_failure(self, e, cooldown):
+        self.failures += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+        # back off longer from a backend that keeps failing
+        self.down_until = time.monotonic() + cooldown * min(self.failures, 10)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "api_base": self.api_base,
+            "models": list(self.models),
+            "priority": self.priority,
+            "healthy": self.healthy(),
+            "latency_ms": None if self.latency is None else self.latency * 1000,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class BackendRouter:
+    """
+    Picks the backends a chat request is sent to, in order, and falls back to
+    the next one when a backend fails with a connection error, a timeout, a
+    rate limit or a server error.
+
+    Only backends serving the request's model are candidates. With the
+    "order" policy they are tried by priority (lowest first, then in the
+    order they were added), with "latency" the fastest one (by a moving
+    average of its request and health check latencies) goes first. Failed
+    backends are tried last until their cooldown is over.
+    """
+
+    def __init__(self, policy="order", cooldown=30.0):
+        self.policy = policy
+        self.cooldown = cooldown
+        self.backends = {"openai": Backend("openai", priority=10)}
+        self._lock = threading.Lock()
+
+    def add(self, name, api_base, api_key=None, models=(), priority=0):
+        backend = Backend(name, api_base, api_key, models, priority)
+        with self._lock:
+            self.backends[name] = backend
+        return backend
+
+    def remove(self, name):
+        with self._lock:
+            if name not in self.backends:
+                raise ValueError(f"There is no backend named '{name}'")
+            del self.backends[name]
+
+    def candidates(self, model):
+        now = time.monotonic()
+        with self._lock:
+            backends = [b for b in self.backends.values() if b.serves(model)]
+        if self.policy == "latency":
+            backends.sort(key=lambda b: b.latency or 0.0)
+        else:
+            backends.sort(key=lambda b: b.priority)
+        return sorted(backends, key=lambda b: not b.healthy(now))
+
+    def call(self, fn, model):
+        """
+        Returns `fn(backend)` for the first backend that doesn't fail,
+        recording the latency and failures of the ones tried.
+        """
+        backends = self.candidates(model)
+        if not backends:
+            raise ValueError(f"No backend serves the model '{model}'")
+        for i, backend in enumerate(backends):
+            start = time.perf_counter()
+            try:
+                result = fn(backend)
+            except Exception as e:
+                fall_back = should_fall_back(e)
+                with self._lock:
+                    backend.requests += 1
+                    backend.errors += 1
+                    if fall_back:
+                        backend.record_failure(e, self.cooldown)
+                if not fall_back or i == len(backends) - 1:
+                    raise
+            else:
+                with self._lock:
+                    backend.requests += 1
+                    backend.record_success(time.perf_counter() - start)
+                return result
+
+    def check(self, backend, session, api_base, api_key, timeout=5):
+        """
+        Checks a backend is up by listing its models, `api_base` and `api_key`
+        being the openai library's settings for the "openai" backend.
+        """
+        base = backend.api_base or api_base.rstrip("/")
+        key = backend.api_key if backend.api_base else api_key
+        headers = {"Authorization": f"Bearer {key}"} if key else {}
+        start = time.perf_counter()
+        try:
+            resp = session.get(f"{base}/models", headers=headers, timeout=timeout)
+            resp.raise_for_status()
+        except Exception as e:
+            with self._lock:
+                backend.record_failure(e, self.cooldown)
+            return False
+        with self._lock:
+            backend.record_success(time.perf_counter() - start)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return [backend.stats() for backend in self.backends.values()]
@@ -0,0 +1,103 @@
+import json
+from concurrent import futures
+
+
+def parse_prompts(code):
+    """Returns the prompts of a cell: a JSON list, or one prompt per line."""
+    code = code.strip()
+    if code.startswith("["):
+        try:
+            prompts = json.loads(code)
+        except ValueError:
+            pass
+        else:
+            return [p if isinstance(p, str) else json.dumps(p) for p in prompts]
+    return [line.strip() for line in code.splitlines() if line.strip()]
+
+
+def run_batch(complete, prompts, concurrency=8, on_result=None):
+    """
+    Call `complete(prompt)` for every prompt on a pool of `concurrency`
+    threads. Returns the results in the order of the prompts, as ("ok",
+    answer) or ("error", message) tuples, and calls `on_result(index, result)`
+    on the calling thread as each one arrives. Pacing and retries are left to
+    the kernel's request scheduler.
+    """
+
+    def run(prompt):
+        try:
+            return ("ok", complete(prompt))
+        except Exception as e:
+            return ("error", str(e))
+
+    results = [None] * len(prompts)
+    executor = futures.ThreadPoolExecutor(max_workers=max(1, concurrency))
+    pending = {executor.submit(run, prompt): i for i, prompt in enumerate(prompts)}
+    try:
+        for future in futures.as_completed(pending):
+            index = pending[future]
+            results[index] = future.result()
+            if on_result is not None:
+                on_result(index, results[index])
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return results
+
+
+def run_bounded(fn, items, concurrency=8, on_result=None):
+    """
+    Call `fn(item)` for the items of an iterable on a pool of `concurrency`
+    threads, taking new items only as earlier ones finish so at most
+    2 * `concurrency` are held at once. Results are ("ok", value) or
+    ("error", message) tuples, passed to `on_result(item, result)` on the
+    calling thread as they arrive.
+    """
+
+    def run(item):
+        try:
+            return ("ok", fn(item))
+        except Exception as e:
+            return ("error", str(e) or type(e).__name__)
+
+    concurrency = max(1, concurrency)
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    pending = {}
+
+    def collect(return_when):
+        done, _ = futures.wait(pending, return_when=return_when)
+        for future in done:
+            item = pending.pop(future)
+            if on_result is not None:
+                on_result(item, future.result())
+
+    try:
+        for item in items:
+            while len(pending) >= 2 * concurrency:
+                collect(futures.FIRST_COMPLETED)
+            pending[executor.submit(run, item)] = item
+        while pending:
+            collect(futures.FIRST_COMPLETED)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _table_cell(text):
+    return text.replace("|", "\\|").replace("\n", "<br>")
+
+
+def format_results_table(prompts, results):
+    """Returns a markdown table of the prompts and their (pending) results."""
+    lines = ["| # | Prompt | Response |", "| --- | --- | --- |"]
+    for i, (prompt, result) in enumerate(zip(prompts, results)):
+        if result is None:
+            response = "…"
+        elif result[0] == "error":
+            response = f"**Error:** {result[1]}"
+        else:
+            response = result[1]
+        lines.append(f"| {i + 1} | {_table_cell(prompt)} | {_table_cell(response)} |")
+    return "\n".join(lines)
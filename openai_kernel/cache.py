@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.environ.get(
+        "OPENAI_KERNEL_CACHE_DIR", os.path.join(cache_home, "openai_kernel")
+    )
+
+
+class ResponseCache:
+    """
+    On-disk cache of chat and image responses, keyed by a hash of the request.
+
+    Each entry is a `<key>.json` file; image entries also store every image as
+    a raw `<key>-<i>.png` file so a hit needs no base64 decoding. Entries older
+    than `max_age` seconds are dropped when read, and the oldest entries are
+    evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 2**20, max_age=7 * 86400):
+        self.directory = directory or get_default_cache_dir()
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = None  # key -> [size, created, filenames]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**request):
+        data = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._scan()
+        return self._entries
+
+    @property
+    def size(self):
+        return sum(entry[0] for entry in self.entries.values())
+
+    def _scan(self):
+        entries = {}
+        if not os.path.isdir(self.directory):
+            return entries
+        for item in os.scandir(self.directory):
+            if not item.is_file() or item.name.endswith(".tmp"):
+                continue
+            key = item.name.split(".")[0].split("-")[0]
+            stat = item.stat()
+            entry = entries.setdefault(key, [0, stat.st_mtime, []])
+            entry[0] += stat.st_size
+            entry[1] = min(entry[1], stat.st_mtime)
+            entry[2].append(item.name)
+        return entries
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _write(self, filename, data):
+        path = self._path(filename)
+        with open(path + ".tmp", "wb") as fid:
+            fid.write(data)
+        os.replace(path + ".tmp", path)
+        return len(data)
+
+    def _read_meta(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.max_age:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(f"{key}.json"), "rb") as fid:
+                    meta = json.loads(fid.read())
+            except (OSError, ValueError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return meta
+
+    def _store(self, key, meta, images=()):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self._remove(key)
+            filenames = []
+            size = 0
+            for i, data in enumerate(images):
+                filenames.append(f"{key}-{i}.png")
+                size += self._write(filenames[-1], data)
+            filenames.append(f"{key}.json")
+            size += self._write(filenames[-1], json.dumps(meta).encode("utf-8"))
+            self.entries[key] = [size, time.time(), filenames]
+            self._evict()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for filename in entry[2]:
+            try:
+                os.remove(self._path(filename))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        size = self.size
+        if size <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda key: self.entries[key][1]):
+            size -= self.entries[key][0]
+            self._remove(key)
+            if size <= self.max_bytes:
+                break
+
+    def get_chat(self, key):
+        """Returns the cached {"content", "finish_reason"} of a chat request."""
+        return self._read_meta(key)
+
+    def put_chat(self, key, content, finish_reason):
+        self._store(key, {"content": content, "finish_reason": finish_reason})
+
+    def get_response(self, key):
+        """Returns the cached body of a raw API response, as bytes."""
+        meta = self._read_meta(key)
+        return None if meta is None else meta["response"].encode("utf-8")
+
+    def put_response(self, key, body):
+        self._store(key, {"response": body.decode("utf-8")})
+
+    def get_images(self, key):
+        """Returns the cached PNG bytes of an image request."""
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+        images = []
+        try:
+            for i in range(meta["n"]):
+                with open(self._path(f"{key}-{i}.png"), "rb") as fid:
+                    images.append(fid.read())
+        except OSError:
+            with self._lock:
+                self._remove(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return images
+
+    def put_images(self, key, images):
+        self._store(key, {"n": len(images)}, images)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "entries": len(self.entries),
+            "size_bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,218 @@
+import socket
+import threading
+import time
+from urllib.parse import quote, unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+from .payload import compress, splice_messages
+
+UNIX_SCHEME = "http+unix"
+
+
+def unix_socket_url(socket_path, path="/v1"):
+    """The URL of `path` on an HTTP server listening on a Unix socket."""
+    return f"{UNIX_SCHEME}://{quote(socket_path, safe='')}{path}"
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, *args, socket_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__("localhost", socket_path=socket_path, **kwargs)
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    Sends `http+unix://<quoted socket path>/...` requests over a Unix socket,
+    keeping a pool of keep-alive connections per socket.
+    """
+
+    def __init__(self, pool_size=10, **kwargs):
+        self.pool_size = pool_size
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        with self._pools_lock:
+            pool = self._pools.get(socket_path)
+            if pool is None:
+                pool = UnixHTTPConnectionPool(socket_path, maxsize=self.pool_size)
+                self._pools[socket_path] = pool
+        return pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+        super().close()
+
+
+class PayloadSession(requests.Session):
+    """
+    A session that can send chat messages serialized ahead of time. The
+    openai library still builds the request (with an empty message list)
+    and parses the response; the encoded messages are spliced into its body
+    just before sending, when the library sends it on this session (see
+    `ConnectionPool.is_installed`). Bodies are gzipped when `compress` is on, and the
+    bytes sent are counted.
+    """
+
+    def __init__(self, compress=False):
+        super().__init__()
+        self.compress = compress
+        self.bytes_sent = 0
+        self.body_bytes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def prepare_messages(self, encoded_messages):
+        """Send `encoded_messages` with the next request made on this thread."""
+        self._local.messages = encoded_messages
+        self._local.sent = None
+
+    def take_sent(self):
+        """Returns (and forgets) the body size of this thread's last request."""
+        self._local.messages = None
+        sent, self._local.sent = getattr(self._local, "sent", None), None
+        return sent
+
+    def encode_body(self, data, headers=None):
+        """
+        Returns the body and headers sent for `data`: with the prepared
+        messages spliced in, and gzipped when compression is on. Raises
+        ValueError rather than send a body without the empty message list
+        the prepared messages replace.
+        """
+        messages = getattr(self._local, "messages", None)
+        if messages is not None and data:
+            self._local.messages = None
+            data = splice_messages(data, messages)
+            if data is None:
+                raise ValueError("The request has no message list to splice into")
+        if isinstance(data, bytes):
+            body_bytes = len(data)
+            compressed = compress(data) if self.compress else None
+            if compressed is not None:
+                data = compressed
+                headers = {**(headers or {}), "Content-Encoding": "gzip"}
+            with self._lock:
+                self.bytes_sent += len(data)
+                self.body_bytes += body_bytes
+            self._local.sent = len(data)
+        return data, headers
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        data, headers = self.encode_body(data, headers)
+        return super().request(method, url, data=data, headers=headers, **kwargs)
+
+
+class ConnectionPool:
+    """
+    A requests session with a keep-alive connection pool, shared by every API
+    call the kernel makes so TLS handshakes and DNS lookups are paid once.
+    """
+
+    def __init__(self, pool_size=10, max_retries=2, proxy=None, compress=False):
+        self.session = PayloadSession(compress)
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries
+        )
+        self.unix_adapter = UnixSocketAdapter(pool_size, max_retries=max_retries)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.mount(f"{UNIX_SCHEME}://", self.unix_adapter)
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+
+    def install(self):
+        """
+        Make the openai library use this session on the current thread (it
+        keeps one session per thread in `api_requestor._thread_context`).
+        """
+        from openai import api_requestor
+
+        api_requestor._thread_context.session = self.session
+        # later openai releases replace a thread's session once it's older
+        # than their session lifetime, going by this
+        api_requestor._thread_context.session_create_time = time.time()
+
+    def is_installed(self):
+        """
+        Whether the openai library sends the current thread's requests on
+        this session, so messages prepared on it are sure to be sent.
+        """
+        from openai import api_requestor
+
+        context = api_requestor._thread_context
+        if getattr(context, "session", None) is not self.session:
+            return False
+        # later releases replace a session older than their session lifetime
+        lifetime = getattr(api_requestor, "MAX_SESSION_LIFETIME_SECS", None)
+        created = getattr(context, "session_create_time", 0)
+        return lifetime is None or time.time() - created < lifetime
+
+    def warm(self, url, background=True):
+        """Open a connection to `url` ahead of the first request."""
+
+        def connect():
+            try:
+                self.session.head(url, timeout=10).close()
+            except requests.exceptions.RequestException:
+                pass
+
+        if not background:
+            connect()
+            return None
+        thread = threading.Thread(target=connect, name="pool-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        stats = {
+            "hosts": 0,
+            "connections_opened": 0,
+            "requests": 0,
+            "bytes_sent": self.session.bytes_sent,
+            "body_bytes": self.session.body_bytes,
+        }
+        unix_pools = list(self.unix_adapter._pools.values())
+        for pool in [pools.get(key) for key in pools.keys()] + unix_pools:
+            if pool is None:
+                continue
+            stats["hosts"] += 1
+            stats["connections_opened"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+        return stats
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,257 @@
+import base64
+import hashlib
+import os
+import threading
+
+from .batch import run_bounded
+from .cache import get_default_cache_dir
+
+# the most inputs one request may have, and tokens one input may have
+MAX_BATCH_INPUTS = 2048
+MAX_INPUT_TOKENS = 8191
+
+
+def get_default_embedding_cache_path():
+    return os.path.join(get_default_cache_dir(), "embeddings.sqlite")
+
+
+def content_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+
+def decode_embeddings(embeddings, np):
+    """
+    Returns embeddings as the rows of a float32 array, from the base64 the
+    API sends when asked to or from lists of floats.
+    """
+    if embeddings and all(isinstance(e, str) for e in embeddings):
+        data = b"".join(base64.b64decode(e) for e in embeddings)
+        return np.frombuffer(data, dtype=np.float32).reshape(len(embeddings), -1)
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def pack_batches(counts, max_tokens, max_inputs=MAX_BATCH_INPUTS):
+    """
+    Groups consecutive inputs, given their token counts, into batches of up
+    to `max_tokens` tokens and `max_inputs` inputs. Returns lists of indices.
+    """
+    batches = []
+    batch = []
+    tokens = 0
+    for i, count in enumerate(counts):
+        if batch and (tokens + count > max_tokens or len(batch) >= max_inputs):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(i)
+        tokens += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class EmbeddingCache:
+    """
+    Embeddings stored by a hash of the model and the text, as float32 bytes
+    in an SQLite table, so the same text is only ever embedded once per
+    model. The database is opened the first time it is used.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or get_default_embedding_cache_path())
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key BLOB PRIMARY KEY, vector BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self._db = db
+        return self._db
+
+    def get_many(self, keys):
+        """Returns {key: float32 bytes} for the keys that are stored."""
+        found = {}
+        keys = list(keys)
+        requested = len(keys)
+        with self._lock:
+            while keys:
+                # stay below SQLite's limit on the number of parameters
+                chunk, keys = keys[:500], keys[500:]
+                marks = ", ".join("?" * len(chunk))
+                rows = self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", chunk
+                )
+                found.update(rows)
+            self.hits += len(found)
+            self.misses += requested - len(found)
+        return found
+
+    def put_many(self, items):
+        """Stores (key, float32 bytes) pairs."""
+        with self._lock, self.db as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", items
+            )
+
+    def clear(self):
+        with self._lock, self.db as db:
+            db.execute("DELETE FROM embeddings")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class EmbeddingJob:
+    """
+    Embeds a list of texts into the rows of a float32 array.
+
+    Texts already in the `cache` are taken from it, and the others (each
+    distinct text once) are packed into batches of up to `batch_tokens`
+    tokens that are sent `concurrency` at a time with `create(texts,
+    tokens)`, which returns the texts' embeddings (the rows of a float32
+    array) and the tokens used. With `path` the array is a memory-mapped
+    .npy file, written as the batches arrive.
+
+    `count(texts)` counts the tokens of texts, and `progress(job)` is called
+    as batches finish.
+    """
+
+    def __init__(
+        self,
+        texts,
+        model,
+        create,
+        count,
+        batch_tokens=100000,
+        concurrency=8,
+        cache=None,
+        path=None,
+        progress=None,
+    ):
+        import numpy as np
+
+        self.np = np
+        self.texts = texts
+        self.model = model
+        self.create = create
+        self.count = count
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+        self.cache = cache
+        self.path = path
+        self.progress = progress or (lambda job: None)
+        self.array = None
+        self.cached = 0
+        self.done = 0
+        self.batches = 0
+        self.tokens = 0
+        self.errors = []
+
+    def _store(self, rows, vectors):
+        """Writes `vectors[i]` to the rows of the array in `rows[i]`."""
+        np = self.np
+        if self.array is None:
+            shape = (len(self.texts), vectors.shape[1])
+            if self.path:
+                self.array = np.lib.format.open_memmap(
+                    self.path, mode="w+", dtype=np.float32, shape=shape
+                )
+            else:
+                self.array = np.zeros(shape, dtype=np.float32)
+        targets = []
+        sources = []
+        for i, text_rows in enumerate(rows):
+            targets.extend(text_rows)
+            sources.extend([i] * len(text_rows))
+        # one copy per batch, rather than one per row
+        self.array[targets] = vectors[sources]
+        self.done += len(targets)
+
+    def run(self):
+        """Returns the array, raising RuntimeError if batches failed."""
+        np = self.np
+        rows = {}  # key -> rows of the text
+        for row, text in enumerate(self.texts):
+            rows.setdefault(content_key(self.model, text), []).append(row)
+        missing = list(rows)
+        if self.cache is not None:
+            found = self.cache.get_many(missing)
+            if found:
+                data = b"".join(found.values())
+                vectors = np.frombuffer(data, dtype=np.float32).reshape(len(found), -1)
+                self._store([rows[key] for key in found], vectors)
+            self.cached = self.done
+            missing = [key for key in missing if key not in found]
+        if missing:
+            inputs = [self.texts[rows[key][0]] for key in missing]
+            counts = self.count(inputs)
+            too_long = [
+                rows[key][0] + 1
+                for key, n in zip(missing, counts)
+                if n > MAX_INPUT_TOKENS
+            ]
+            if too_long:
+                raise ValueError(
+                    f"Texts {too_long[:10]} (counting from 1) are longer than "
+                    f"the {MAX_INPUT_TOKENS} tokens an embedding can have"
+                )
+            batches = pack_batches(counts, self.batch_tokens)
+            self.batches = len(batches)
+            self.progress(self)
+
+            def on_result(batch, result):
+                if result[0] != "ok":
+                    self.errors.append(result[1])
+                    return
+                vectors, tokens = result[1]
+                self.tokens += tokens
+                keys = [missing[i] for i in batch]
+                self._store([rows[key] for key in keys], vectors)
+                if self.cache is not None:
+                    self.cache.put_many(
+                        (key, vector.tobytes()) for key, vector in zip(keys, vectors)
+                    )
+                self.progress(self)
+
+            def send(batch):
+                texts = [inputs[i] for i in batch]
+                return self.create(texts, sum(counts[i] for i in batch))
+
+            run_bounded(send, batches, self.concurrency, on_result)
+        if self.array is None:
+            self.array = np.zeros((0, 0), dtype=np.float32)
+        if self.path and isinstance(self.array, np.memmap):
+            self.array.flush()
+        if self.errors:
+            raise RuntimeError(
+                f"{len(self.errors)} of {self.batches} requests failed, run the cell "
+                "again to retry them:\n" + "\n".join(self.errors)
+            )
+        return self.array
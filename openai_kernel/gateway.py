@@ -0,0 +1,423 @@
+"""
+A gateway the kernels on one machine share to reach the OpenAI API.
+
+Kernels with the `gateway` variable set (or the OPENAI_KERNEL_GATEWAY
+environment variable) send their chat and image requests to the gateway over
+a Unix socket, and the gateway sends them on through one keep-alive
+connection pool. It paces requests per organization for every kernel at
+once, can answer from a shared response cache, and coalesces identical
+requests in flight so only one of them is sent. Only requests whose answer
+can be given twice are cached or coalesced: embeddings, chat completions at
+temperature 0, and requests from kernels with their own cache on.
+
+    python -m openai_kernel gateway --socket /tmp/openai.sock --rpm 3500
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+
+from . import tokenizer
+from .cache import ResponseCache, get_default_cache_dir
+from .connection_pool import ConnectionPool
+from .scheduler import RETRIED_HEADER, RequestScheduler
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# the api key kernels without one send, replaced with the gateway's key
+GATEWAY_KEY = "sk-gateway"
+# the request header of kernels that cache their answers themselves
+CACHE_HEADER = "OpenAI-Kernel-Cache"
+# request and response headers passed through the gateway
+REQUEST_HEADERS = ("Authorization", "OpenAI-Organization", "Content-Type")
+RESPONSE_HEADERS = (
+    "Content-Type",
+    "Retry-After",
+    "Retry-After-Ms",
+    "OpenAI-Model",
+    "OpenAI-Organization",
+    "OpenAI-Processing-Ms",
+    "X-Request-Id",
+)
+
+
+def get_default_socket_path():
+    return os.environ.get(
+        "OPENAI_KERNEL_GATEWAY", os.path.join(get_default_cache_dir(), "gateway.sock")
+    )
+
+
+def is_replayable(path, params, headers):
+    """
+    Whether the answer to a request may be given again to the same request:
+    an embedding is the same every time, a chat completion only without
+    sampling (temperature 0), and a kernel with its cache on opts in with
+    the CACHE_HEADER.
+    """
+    if headers.get(CACHE_HEADER) == "1":
+        return True
+    if path.rstrip("/").endswith("/embeddings"):
+        return True
+    return "messages" in params and params.get("temperature", 1) == 0
+
+
+def upstream_error(resp):
+    """
+    The openai library error for a failed response, so the scheduler retries
+    it (and pauses the organization on a 429) as it would in a kernel.
+    """
+    from openai import error
+
+    message = f"The API answered {resp.status_code}"
+    if resp.status_code == 429:
+        e = error.RateLimitError(message, http_status=429, headers=resp.headers)
+    else:
+        e = error.APIError(message, http_status=resp.status_code, headers=resp.headers)
+    e.response = resp
+    return e
+
+
+class GatewayServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_HEAD(self):
+        self.send_body(200, {}, b"")
+
+    def do_GET(self):
+        gateway = self.server.gateway
+        if self.path == "/gateway/stats":
+            stats = json.dumps(gateway.stats()).encode("utf-8")
+            self.send_body(200, {"Content-Type": "application/json"}, stats)
+        else:
+            self.send_body(*gateway.forward("GET", self.path, self.headers))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.gateway.handle(self, body)
+
+
+class Gateway:
+    """
+    Forwards the OpenAI API requests of many kernels, arriving on a Unix
+    socket, to `api_base`.
+
+    Requests are paced per organization (the OpenAI-Organization header, or
+    the api key without one) with the `rpm` and `tpm` limits, and retried
+    like a kernel's own requests, so a 429 backs off every kernel of the
+    organization; the errors left after the retries are marked with the
+    RETRIED_HEADER so the kernels don't retry them again. Identical
+    replayable requests (see `is_replayable`) from
+    the same credentials share one upstream request while it is in flight,
+    and, with `use_cache`, are answered from the response cache afterwards;
+    other requests are always sent. Streamed requests are
+    passed straight through. Kernels without an api key use the gateway's
+    `api_key`.
+    """
+
+    def __init__(
+        self,
+        socket_path=None,
+        api_base=DEFAULT_API_BASE,
+        api_key=None,
+        rpm=None,
+        tpm=None,
+        use_cache=False,
+        cache_dir=None,
+        pool_size=100,
+        request_retries=5,
+        timeout=(10, 600),
+    ):
+        self.socket_path = socket_path or get_default_socket_path()
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.limits = {"rpm": rpm, "tpm": tpm}
+        self.timeout = timeout
+        self.pool = ConnectionPool(pool_size=pool_size)
+        self.scheduler = RequestScheduler(max_retries=request_retries)
+        self.cache = ResponseCache(cache_dir) if use_cache else None
+        self.counters = {
+            "requests": 0,
+            "upstream_requests": 0,
+            "coalesced": 0,
+            "cache_hits": 0,
+            "streamed": 0,
+        }
+        self.server = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _url(self, path):
+        # the kernels' api_base ends in /v1 like the real one
+        if path.startswith("/v1/"):
+            path = path[3:]
+        return self.api_base + path
+
+    def _headers(self, headers):
+        forwarded = {name: headers[name] for name in REQUEST_HEADERS if name in headers}
+        auth = forwarded.get("Authorization")
+        if self.api_key and auth in (None, f"Bearer {GATEWAY_KEY}"):
+            forwarded["Authorization"] = f"Bearer {self.api_key}"
+        return forwarded
+
+    def _limit_key(self, headers):
+        """The organization whose limits a request counts against."""
+        key = headers.get("OpenAI-Organization")
+        if key is None:
+            auth = headers.get("Authorization", "").encode("utf-8")
+            key = "key-" + hashlib.sha256(auth).hexdigest()[:16]
+        if (self.limits["rpm"] or self.limits["tpm"]) and (
+            key not in self.scheduler.limits
+        ):
+            self.scheduler.set_limits(key, **self.limits)
+        return key
+
+    def forward(self, method, path, headers, body=None, params=None, stream=False):
+        """
+        Send a request upstream through the scheduler, returning the status,
+        headers and body of the answer (the response itself when streaming).
+        """
+        headers = self._headers(headers)
+        limit_key = self._limit_key(headers)
+        estimated_tokens = 0
+        if params and self.scheduler.wants_token_estimate(limit_key):
+            model = params.get("model", "")
+            estimated_tokens = params.get("max_tokens") or 512
+            if "messages" in params:
+                estimated_tokens += tokenizer.count_prompt_tokens(
+                    params["messages"], model
+                )
+
+        def send():
+            self._count("upstream_requests")
+            resp = self.pool.session.request(
+                method,
+                self._url(path),
+                data=body,
+                headers=headers,
+                timeout=self.timeout,
+                stream=stream,
+            )
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise upstream_error(resp)
+            return resp
+
+        # the kernels don't retry what the gateway has retried already
+        retried = {RETRIED_HEADER: "1"}
+        try:
+            resp = self.scheduler.run(send, limit_key, estimated_tokens)
+        except Exception as e:
+            resp = getattr(e, "response", None)
+            if resp is None:
+                error = {"message": f"Gateway error: {e}", "type": "gateway_error"}
+                body = json.dumps({"error": error}).encode("utf-8")
+                return 502, {"Content-Type": "application/json", **retried}, body
+        if stream and resp.status_code == 200:
+            return resp
+        resp_headers = {
+            name: resp.headers[name]
+            for name in RESPONSE_HEADERS
+            if name in resp.headers
+        }
+        if resp.status_code == 429 or resp.status_code >= 500:
+            resp_headers.update(retried)
+        return resp.status_code, resp_headers, resp.content
+
+    def handle(self, handler, body):
+        self._count("requests")
+        try:
+            params = json.loads(body or b"{}")
+        except ValueError:
+            params = {}
+        if params.get("stream"):
+            self._count("streamed")
+            self._stream(handler, body, params)
+            return
+
+        if not is_replayable(handler.path, params, handler.headers):
+            handler.send_body(
+                *self.forward("POST", handler.path, handler.headers, body, params)
+            )
+            return
+
+        credentials = [handler.headers.get(name) for name in REQUEST_HEADERS[:2]]
+        key = ResponseCache.make_key(
+            path=handler.path,
+            credentials=credentials,
+            body=hashlib.sha256(body).hexdigest(),
+        )
+        if self.cache is not None:
+            cached = self.cache.get_response(key)
+            if cached is not None:
+                self._count("cache_hits")
+                handler.send_body(200, {"Content-Type": "application/json"}, cached)
+                return
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if leader:
+            try:
+                result = self.forward(
+                    "POST", handler.path, handler.headers, body, params
+                )
+                if self.cache is not None and result[0] == 200:
+                    self.cache.put_response(key, result[2])
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+        handler.send_body(*future.result())
+
+    def _stream(self, handler, body, params):
+        resp = self.forward(
+            "POST", handler.path, handler.headers, body, params, stream=True
+        )
+        if isinstance(resp, tuple):
+            handler.send_body(*resp)
+            return
+        with resp:
+            handler.send_response(resp.status_code)
+            handler.send_header(
+                "Content-Type", resp.headers.get("Content-Type", "text/event-stream")
+            )
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+            for chunk in resp.iter_content(chunk_size=None):
+                if chunk:
+                    handler.send_chunk(chunk)
+            handler.wfile.write(b"0\r\n\r\n")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, in_flight=len(self._inflight))
+        stats["scheduler"] = dict(self.scheduler.stats)
+        stats["pool"] = self.pool.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def start(self):
+        """Listen on the socket, serving requests on a background thread."""
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # left behind by a gateway that is gone
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError(f"A gateway is listening on {self.socket_path}")
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        self.server = GatewayServer(self.socket_path, GatewayHandler)
+        self.server.gateway = self
+        threading.Thread(
+            target=self.server.serve_forever, name="gateway", daemon=True
+        ).start()
+        return self.socket_path
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+        self.pool.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m openai_kernel gateway", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--socket", default=None, help="Unix socket to listen on")
+    parser.add_argument(
+        "--api-base",
+        default=os.environ.get("OPENAI_API_BASE", DEFAULT_API_BASE),
+        help="API to forward requests to",
+    )
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get("OPENAI_API_KEY"),
+        help="Key for the requests of kernels without one",
+    )
+    parser.add_argument("--rpm", type=int, help="Requests per minute per organization")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute per organization")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Answer repeated embeddings and temperature 0 requests from a cache",
+    )
+    parser.add_argument("--cache-dir", help="Directory of the response cache")
+    parser.add_argument("--pool-size", type=int, default=100, help="Connections")
+    parser.add_argument("--retries", type=int, default=5, help="Request retries")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    gateway = Gateway(
+        args.socket,
+        args.api_base,
+        args.api_key,
+        args.rpm,
+        args.tpm,
+        args.cache,
+        args.cache_dir,
+        args.pool_size,
+        args.retries,
+    )
+    path = gateway.start()
+    print(f"Gateway listening on {path}, forwarding to {gateway.api_base}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import queue
+import threading
+import time
+
+from .metrics import percentile
+
+# the fewest past timings a percentile hedge delay is taken from
+HEDGE_MIN_SAMPLES = 20
+
+_DONE = object()
+
+
+def parse_hedge_after(value):
+    """
+    Returns the hedge policy of a `hedge_after` setting: ("seconds", delay),
+    ("percentile", q) for strings like 'p95', or None when hedging is off.
+    """
+    if value is None or value is False:
+        return None
+    if isinstance(value, str) and value.startswith("p"):
+        q = float(value[1:])
+        if not 0 < q <= 100:
+            raise ValueError(f"The percentile of '{value}' isn't between 0 and 100")
+        return ("percentile", q)
+    delay = float(value)
+    if delay < 0:
+        raise ValueError("The hedge delay can't be negative")
+    return ("seconds", delay)
+
+
+def hedge_delay(policy, samples, min_samples=HEDGE_MIN_SAMPLES):
+    """
+    Returns how long to wait for the first byte of a request before hedging
+    it, or None when it shouldn't be hedged: a percentile policy needs
+    `min_samples` past timings of requests of the same kind (times to first
+    byte of streamed requests, latencies of the others).
+    """
+    if policy is None:
+        return None
+    kind, value = policy
+    if kind == "seconds":
+        return value
+    if len(samples) < min_samples:
+        return None
+    return percentile(samples, value)
+
+
+def expected_saving(samples, elapsed):
+    """
+    Estimates the time a hedge that answered after `elapsed` seconds saved:
+    how much longer the first request would have taken, on average, going
+    by the past timings longer than `elapsed`. None without such samples.
+    """
+    slower = [s for s in samples if s > elapsed]
+    if not slower:
+        return None
+    return sum(slower) / len(slower) - elapsed
+
+
+class Racer:
+    """
+    One request of a race, and its timings in seconds from the start of the
+    race. `started` is None for a request that was never sent. A request
+    that lost is `cancelled` when its stream was closed, and `abandoned`
+    when it couldn't be stopped and its response is dropped.
+    """
+
+    def __init__(self, name, fn, delay=0.0):
+        self.name = name
+        self.fn = fn
+        self.delay = delay
+        self.started = None
+        self.first_byte = None
+        self.finished = None
+        self.error = None
+        self.cancelled = False
+        self.abandoned = False
+        self.result = None
+        self.done = threading.Event()
+        self._items = queue.Queue()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Stops reading the response, closing it, unless it's finished."""
+        self._cancel.set()
+        if self.started is not None and self.finished is None:
+            self.cancelled = True
+
+    def abandon(self):
+        """Drops the response of a request that can't be stopped once sent."""
+        self._cancel.set()
+        if self.started is not None and self.finished is None:
+            self.abandoned = True
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "first_byte": self.first_byte,
+            "finished": self.finished,
+            "error": None if self.error is None else type(self.error).__name__,
+            "cancelled": self.cancelled,
+            "abandoned": self.abandoned,
+        }
+
+
+class Race:
+    """
+    Sends the same request several ways and takes the first to answer.
+
+    Each `(name, fn)` call is started on its own daemon thread `delays[i]`
+    seconds after the start of the race, unless a call has answered by
+    then, and the first call to produce a byte wins: its response, or with
+    `stream` the first chunk of its iterable. The other calls are then
+    cancelled, closing their streams. A call that isn't streamed can't be
+    stopped once sent, so it is abandoned and its response dropped when it
+    arrives.
+
+    A failed call only loses, and the next call is started straight away
+    when every call sent has failed: the race fails, with the first call's
+    error, once every call has.
+    """
+
+    def __init__(self, calls, delays=None, stream=False):
+        delays = delays or [0.0] * len(calls)
+        self.racers = [
+            Racer(name, fn, delay) for (name, fn), delay in zip(calls, delays)
+        ]
+        self.stream = stream
+        self.winner = None
+        self._events = queue.Queue()
+        self._start = None
+
+    def _now(self):
+        return time.perf_counter() - self._start
+
+    def _launch(self, racer):
+        racer.started = self._now()
+        threading.Thread(target=self._run, args=(racer,), daemon=True).start()
+
+    def _run(self, racer):
+        try:
+            result = racer.fn()
+            if not self.stream:
+                racer.result = result
+                racer.first_byte = racer.finished = self._now()
+                self._events.put(racer)
+                return
+            try:
+                for item in result:
+                    if racer._cancel.is_set():
+                        return
+                    racer._items.put((item, None))
+                    if racer.first_byte is None:
+                        racer.first_byte = self._now()
+                        self._events.put(racer)
+            finally:
+                close = getattr(result, "close", None)
+                if racer._cancel.is_set() and close is not None:
+                    close()
+            racer.finished = self._now()
+            racer._items.put((_DONE, None))
+            if racer.first_byte is None:
+                racer.first_byte = racer.finished
+                self._events.put(racer)
+        except BaseException as e:
+            racer.error = e
+            racer.finished = self._now()
+            if racer.first_byte is None:
+                self._events.put(racer)
+            else:
+                racer._items.put((None, e))
+        finally:
+            racer.done.set()
+
+    def _iter(self, racer):
+        try:
+            while True:
+                item, error = racer._items.get()
+                if error is not None:
+                    raise error
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            racer.cancel()
+
+    def run(self, cancel=True):
+        """
+        Runs the race and returns the winning Racer, whose `result` is the
+        response (an iterator of its chunks with `stream`). With `cancel`
+        off the calls that were sent keep running, see `wait`.
+        """
+        self._start = time.perf_counter()
+        pending = sorted(self.racers, key=lambda racer: racer.delay)
+        try:
+            while self.winner is None:
+                # start every call that is due before waiting for answers
+                while pending and pending[0].delay <= self._now():
+                    self._launch(pending.pop(0))
+                timeout = None
+                if pending:
+                    timeout = max(0.0, pending[0].delay - self._now())
+                try:
+                    racer = self._events.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                if racer.error is None:
+                    self.winner = racer
+                    break
+                sent = [r for r in self.racers if r.started is not None]
+                if all(r.error is not None for r in sent):
+                    if not pending:
+                        raise sent[0].error
+                    self._launch(pending.pop(0))
+        except BaseException:
+            for racer in self.racers:
+                self._stop(racer)
+            raise
+        for racer in self.racers:
+            if racer is not self.winner and cancel:
+                self._stop(racer)
+        if self.stream:
+            self.winner.result = self._iter(self.winner)
+        return self.winner
+
+    def _stop(self, racer):
+        if self.stream:
+            racer.cancel()
+        else:
+            racer.abandon()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the calls that were sent to finish or be cancelled, and
+        for the abandoned ones that are still running.
+        """
+        for racer in self.racers:
+            if racer.started is not None and not racer.cancelled:
+                racer.done.wait(timeout)
+
+    def stats(self):
+        return [racer.stats() for racer in self.racers]
@@ -0,0 +1,287 @@
+import itertools
+import json
+import mmap
+import os
+import sys
+
+from .payload import encode_message
+from .tokenizer import count_message_tokens
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+def get_context_window(model):
+    """Returns the context window of a model, matching dated snapshots too."""
+    matches = [name for name in MODEL_CONTEXT_WINDOWS if model.startswith(name)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+class HistoryEntry:
+    """
+    A message of the history with its token count, an interned role and,
+    once it has been sent, its encoded JSON.
+    """
+
+    __slots__ = ("role", "content", "tokens", "extra", "_encoded")
+
+    def __init__(self, role, content, tokens, extra=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens
+        # any other fields of the message, e.g. name or function_call
+        self.extra = extra or None
+        self._encoded = None
+
+    @classmethod
+    def from_message(cls, message, tokens):
+        extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+        return cls(message["role"], message.get("content"), tokens, extra)
+
+    @property
+    def message(self):
+        message = {"role": self.role, "content": self.content}
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = encode_message(self.message)
+        return self._encoded
+
+
+class HistoryLog:
+    """
+    An append-only JSON lines log of history operations: one line per
+    appended message (with its token count) and a marker line whenever the
+    history is cleared. Loading memory-maps the file and only parses the
+    lines after the last clear; the log is compacted when most of it is
+    cleared history.
+    """
+
+    CLEAR = b'{"op": "clear"}\n'
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._file = None
+
+    def load(self):
+        """Returns the entries of the history as of the end of the log."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size == 0:
+            return []
+        with open(self.path, "rb") as fid:
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                index = mm.rfind(self.CLEAR)
+                start = 0 if index < 0 else index + len(self.CLEAR)
+                live = mm[start:]
+        entries = []
+        for line in live.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+            entries.append(
+                HistoryEntry(
+                    record["role"],
+                    record.get("content"),
+                    record["tokens"],
+                    record.get("extra"),
+                )
+            )
+        if len(live) < start:
+            self.compact(entries)
+        return entries
+
+    def _write(self, data):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "ab")
+        self._file.write(data)
+        self._file.flush()
+
+    def _encode(self, entry):
+        record = {"op": "append", "role": entry.role, "content": entry.content}
+        record["tokens"] = entry.tokens
+        if entry.extra:
+            record["extra"] = entry.extra
+        return json.dumps(record).encode("utf-8") + b"\n"
+
+    def append(self, entry):
+        self._write(self._encode(entry))
+
+    def clear(self):
+        self._write(self.CLEAR)
+
+    def compact(self, entries):
+        """Rewrite the log with only `entries`."""
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fid:
+            for entry in entries:
+                fid.write(self._encode(entry))
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class History:
+    """
+    Chat history that stores the token count of every message, computed once
+    when the message is appended. The window of recent messages that fits a
+    token budget is tracked incrementally, so assembling a prompt never
+    re-encodes the history. Given a `HistoryLog` the history is restored
+    from it and every change is appended to it.
+
+    Forking is O(1): a fork shares the entry lists of the history it came
+    from, up to their length at the time. Entry lists are only appended to
+    (clearing starts a new one), so shared prefixes never change.
+    """
+
+    def __init__(self, messages=(), model="gpt-3.5-turbo", log=None):
+        self.model = model
+        self.log = log
+        # (entries, length) prefixes shared with the history this was forked from
+        self._shared = ()
+        self._shared_len = 0
+        self._entries = log.load() if log is not None else []
+        self._start = 0
+        self._window_tokens = sum(entry.tokens for entry in self._entries)
+        self.extend(messages)
+
+    def fork(self):
+        """Returns a history that starts with, but doesn't change, this one."""
+        fork = History(model=self.model)
+        fork._shared = self._shared
+        if self._entries:
+            fork._shared += ((self._entries, len(self._entries)),)
+        fork._shared_len = len(self)
+        fork._start = self._start
+        fork._window_tokens = self._window_tokens
+        return fork
+
+    def append(self, message, tokens=None):
+        if tokens is None:
+            tokens = count_message_tokens(message, self.model)
+        entry = HistoryEntry.from_message(message, tokens)
+        self._entries.append(entry)
+        self._window_tokens += tokens
+        if self.log is not None:
+            self.log.append(entry)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        self._shared = ()
+        self._shared_len = 0
+        self._entries = []
+        self._start = 0
+        self._window_tokens = 0
+        if self.log is not None:
+            self.log.clear()
+
+    def _entry(self, index):
+        if index >= self._shared_len:
+            return self._entries[index - self._shared_len]
+        for entries, length in self._shared:
+            if index < length:
+                return entries[index]
+            index -= length
+
+    def _iter_entries(self):
+        for entries, length in self._shared:
+            yield from itertools.islice(entries, length)
+        yield from self._entries
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def __iter__(self):
+        return (entry.message for entry in self._iter_entries())
+
+    def __len__(self):
+        return self._shared_len + len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(len(self))[index]
+            return [self._entry(i).message for i in indices]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self._entry(index).message
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def entries(self, start=None, stop=None):
+        """Returns the (index, message, tokens) tuples of a slice of the history."""
+        entries = []
+        for i in range(len(self))[start:stop]:
+            entry = self._entry(i)
+            entries.append((i, entry.message, entry.tokens))
+        return entries
+
+    def encoded(self, start=0):
+        """Returns the JSON of the messages from `start` on, encoded once each."""
+        return [self._entry(i).encoded for i in range(len(self))[start:]]
+
+    @property
+    def tokens(self):
+        """Total number of tokens in the whole history."""
+        return sum(entry.tokens for entry in self._iter_entries())
+
+    def token_counts(self, start=0):
+        """Returns the cached token counts of the messages from `start` on."""
+        return [self._entry(i).tokens for i in range(len(self))[start:]]
+
+    def window(self, budget):
+        """
+        Returns the most recent messages whose token counts fit in `budget`,
+        dropping the oldest turns first.
+        """
+        start = self.window_start(budget)
+        return self[start:]
+
+    def window_start(self, budget):
+        """Returns the index of the first message of the budgeted window."""
+        length = len(self)
+        while self._start < length and self._window_tokens > budget:
+            self._window_tokens -= self._entry(self._start).tokens
+            self._start += 1
+        while (
+            self._start > 0
+            and self._window_tokens + self._entry(self._start - 1).tokens <= budget
+        ):
+            self._start -= 1
+            self._window_tokens += self._entry(self._start).tokens
+
+        start = self._start
+        # don't open the window with a reply whose question was trimmed
+        while start < length and self._entry(start).role == "assistant":
+            start += 1
+        return start
@@ -0,0 +1,90 @@
+import base64
+import hashlib
+import html
+import io
+import os
+import uuid
+
+IMAGE_DISPLAYS = ("inline", "thumbnail", "link")
+THUMBNAIL_SIZE = 256
+
+
+def get_default_image_dir():
+    """
+    The directory generated images are written to, relative to the working
+    directory (the notebook's directory) so notebooks can link to them.
+    """
+    return os.environ.get("OPENAI_KERNEL_IMAGE_DIR", "openai_images")
+
+
+def iter_decoded(data):
+    """
+    Decode the b64_json images of an image response one at a time, dropping
+    each base64 string once it is decoded so only one image is held twice.
+    """
+    for item in data:
+        b64_json, item["b64_json"] = item["b64_json"], None
+        image = base64.b64decode(b64_json)
+        del b64_json
+        yield image
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    """Returns a PNG downscaled to fit in `size` pixels, or None without Pillow."""
+    try:
+        from PIL import Image as PILImage
+    except ImportError:  # pragma: no cover
+        return None
+    with PILImage.open(io.BytesIO(data)) as image:
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+    return out.getvalue()
+
+
+class ImageStore:
+    """
+    Full resolution images, stored once under the sha256 of their content.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or get_default_image_dir()
+
+    def save(self, data):
+        """Write `data` to the store, if it isn't there yet, and return its path."""
+        path = os.path.join(self.directory, hashlib.sha256(data).hexdigest() + ".png")
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as fid:
+                fid.write(data)
+            os.replace(tmp_path, path)
+        return path
+
+
+def link_path(path):
+    """The path of a stored image as a notebook (relative, /-separated) link."""
+    try:
+        path = os.path.relpath(path)
+    except ValueError:
+        path = os.path.abspath(path)
+    return path.replace(os.sep, "/")
+
+
+def image_html(path, alt, thumbnail_of=None):
+    """
+    HTML linking to the image at `path`. Given the image's bytes in
+    `thumbnail_of` it shows a thumbnail, embedded when Pillow is installed
+    and otherwise scaled down by the browser; without them the browser loads
+    the file itself.
+    """
+    href = html.escape(link_path(path), quote=True)
+    alt = html.escape(alt, quote=True)
+    src = href
+    width = ""
+    if thumbnail_of is not None:
+        width = f' width="{THUMBNAIL_SIZE}"'
+        data = make_thumbnail(thumbnail_of)
+        if data is not None:
+            src = "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+    return f'<a href="{href}" target="_blank"><img src="{src}" alt="{alt}"{width}></a>'
@@ -1,17 +1,35 @@
-import base64
+import functools
+import importlib
 import json
 import os
+import pkgutil
 import sys
+import threading
+import time
 import traceback
+import uuid
 
-import openai
-import requests
-from IPython.display import Image
 from metakernel import ExceptionWrapper, MetaKernel
-from openai.error import AuthenticationError
 
+from . import magics, tokenizer
+from .backends import BackendRouter
+from .cache import ResponseCache
+from .embeddings import EmbeddingCache, EmbeddingJob, decode_embeddings
+from .hedging import Race, expected_saving, hedge_delay, parse_hedge_after
+from .history import History, HistoryLog, get_context_window
+from .images import IMAGE_DISPLAYS, ImageStore, image_html, iter_decoded
+from .metrics import ExecutionMetrics, MetricsRecorder, estimate_chat_cost
 from .outputs import MarkdownOutput
+from .payload import encode_message
+from .scheduler import RequestScheduler
+from .search import SearchIndex
+from .semantic_cache import SemanticCache
+from .startup import StartupProfile
 from .version import __version__
+from .workers import call_in_thread, iter_in_thread
+
+# the metakernel magics this kernel uses, the rest are never loaded
+METAKERNEL_MAGICS = ("get", "help", "lsmagic", "magic", "reload_magics")
 
 
 def get_kernel_json():
@@ -19,12 +37,17 @@ def get_kernel_json():
     here = os.path.dirname(__file__)
     default_json_file = os.path.join(here, "kernel.json")
     json_file = os.environ.get("OPENAI_KERNEL_JSON", default_json_file)
-    with open(json_file) as fid:
-        data = json.load(fid)
+    data = json.loads(_read_kernel_json(json_file))
     data["argv"][0] = sys.executable
     return data
 
 
+@functools.lru_cache(maxsize=None)
+def _read_kernel_json(json_file):
+    with open(json_file) as fid:
+        return fid.read()
+
+
 def get_default_api_key_path():
     home = os.path.expanduser("~")
     default_api_key_path = os.path.join(home, ".openai_api_key")
@@ -44,8 +67,16 @@ class OpenAIKernel(MetaKernel):
     banner = "OpenAI Kernel - An interface to OpenAI models"
 
     help_suffix = "??"
+    stream_update_interval = 0.1
+    warm_connections = True
 
     def __init__(self, *args, **kwargs):
+        self.startup_profile = StartupProfile()
+        self._openai = None
+        self._openai_lock = threading.Lock()
+        self._connection_pool = None
+        self._connection_pool_lock = threading.Lock()
+        self._kernel_json = None
         self.variables = {
             "system_prompt": "You are a helpful assistant.",
             "model": "gpt-3.5-turbo",
@@ -53,19 +84,165 @@ class OpenAIKernel(MetaKernel):
             "chat_kwargs": {},
             "size": "512x512",
             "n": 1,
+            "image_display": "inline",
+            "image_dir": None,
+            "embed_model": "text-embedding-ada-002",
+            "embed_batch_tokens": 100000,
+            "embed_concurrency": 8,
+            "embed_file": None,
+            "embed_cache": True,
+            "stream": False,
+            "hedge_after": None,
+            "hedge_model": None,
+            "context_window": None,
+            "history_file": os.environ.get("OPENAI_KERNEL_HISTORY_FILE"),
+            "search_index": os.environ.get("OPENAI_KERNEL_SEARCH_INDEX"),
+            "completion_tokens": 512,
+            "connect_timeout": 10,
+            "read_timeout": 600,
+            "pool_size": 10,
+            "max_retries": 2,
+            "proxy": None,
+            "compress_requests": False,
+            "gateway": os.environ.get("OPENAI_KERNEL_GATEWAY"),
+            "rate_limits": {},
+            "request_retries": 5,
+            "metrics_size": 1000,
+            "metrics_file": None,
         }
         super(OpenAIKernel, self).__init__(*args, **kwargs)
+        self.startup_profile.mark("metakernel")
         self.mode = "chat"
         self.use_history = True
-        self.openai = openai
-        self.kernel_json = get_kernel_json()
-        self._history = []
+        self.use_cache = False
+        self.response_cache = ResponseCache()
+        self.use_semantic_cache = False
+        self._semantic_cache = None
+        self.image_store = ImageStore(self.variables["image_dir"])
+        self.embedding_cache = self._open_embedding_cache(self.variables["embed_cache"])
+        self.embeddings = None
+        self.scheduler = RequestScheduler(
+            self.variables["rate_limits"], self.variables["request_retries"]
+        )
+        self.backends = BackendRouter()
+        self.hedge_policy = parse_hedge_after(self.variables["hedge_after"])
+        self.metrics = MetricsRecorder(
+            self.variables["metrics_size"], self.variables["metrics_file"]
+        )
+        self.startup_profile.mark("request pipeline")
+        self._history = self._open_history(self.variables["history_file"])
+        self.threads = {"main": self._history}
+        self.active_thread = "main"
+        self.session_id = uuid.uuid4().hex[:12]
+        self.search_index = self._open_search_index(self.variables["search_index"])
+        self._system_tokens = (None, None, 0)
+        self._system_encoded = (None, b"")
+        self.startup_profile.mark("history")
+        tokenizer.preload([self.variables["model"]])
+        if self.warm_connections:
+            # import the openai library and connect off the main thread
+            threading.Thread(target=self._warm_up, name="warm-up", daemon=True).start()
+        self.startup_profile.mark("background loading")
+
+    @property
+    def semantic_cache(self):
+        """The semantic cache, created (and NumPy imported) when first used."""
+        if self._semantic_cache is None:
+            self._semantic_cache = SemanticCache()
+        return self._semantic_cache
+
+    @semantic_cache.setter
+    def semantic_cache(self, cache):
+        self._semantic_cache = cache
+
+    def _warm_up(self):
+        self.connection_pool.warm(self.api_base_url, background=False)
+
+    @property
+    def api_base_url(self):
+        """Where requests for OpenAI go: the gateway when there is one."""
+        if self.variables["gateway"]:
+            from .connection_pool import unix_socket_url
+
+            return unix_socket_url(self.variables["gateway"])
+        return self.openai.api_base
+
+    def gateway_kwargs(self):
+        """The arguments sending an openai library request through the gateway."""
+        if not self.variables["gateway"]:
+            return {}
+        kwargs = {"api_base": self.api_base_url}
+        if self._default_api_key() is None:
+            from .gateway import GATEWAY_KEY
+
+            # the gateway sends its own key instead
+            kwargs["api_key"] = GATEWAY_KEY
+        if self.use_cache:
+            from .gateway import CACHE_HEADER
+
+            # answers the kernel caches may come from the gateway's cache too
+            kwargs["headers"] = {CACHE_HEADER: "1"}
+        return kwargs
+
+    @property
+    def gateway_stats(self):
+        if not self.variables["gateway"]:
+            return None
+        from .connection_pool import unix_socket_url
+
+        url = unix_socket_url(self.variables["gateway"], "/gateway/stats")
+        return self.connection_pool.session.get(url, timeout=10).json()
+
+    @property
+    def openai(self):
+        """The openai library, imported the first time it is needed."""
+        if self._openai is None:
+            with self._openai_lock:
+                if self._openai is None:
+                    self._openai = self._load_openai()
+        return self._openai
+
+    @openai.setter
+    def openai(self, module):
+        self._openai = module
+
+    def _load_openai(self):
+        import openai
+
+        if openai.api_key is None and openai.api_key_path is None:
+            openai.api_key_path = get_default_api_key_path()
+        return openai
+
+    @property
+    def kernel_json(self):
+        if self._kernel_json is None:
+            self._kernel_json = get_kernel_json()
+        return self._kernel_json
+
+    @kernel_json.setter
+    def kernel_json(self, kernel_json):
+        self._kernel_json = kernel_json
 
-        if self.openai.api_key is None and self.openai.api_key_path is None:
-            default_api_key_path = get_default_api_key_path()
-            if default_api_key_path:
-                self.openai.api_key_path = default_api_key_path
-                self.api_key_path = default_api_key_path
+    def reload_magics(self):
+        """
+        Load this kernel's magics and the few metakernel magics it uses,
+        rather than every magic metakernel ships (some of which start
+        processes when loaded).
+        """
+        self.startup_profile.mark("ipykernel")
+        self.line_magics = {}
+        self.cell_magics = {}
+        names = [f"metakernel.magics.{name}_magic" for name in METAKERNEL_MAGICS]
+        names += [
+            f"{magics.__name__}.{module.name}"
+            for module in pkgutil.iter_modules(magics.__path__)
+        ]
+        for name in names:
+            try:
+                importlib.import_module(name).register_magics(self)
+            except Exception as e:
+                self.log.error("Can't load '%s': error: %s" % (name, e))
+        self.startup_profile.mark("magics")
 
     @property
     def api_key(self):
@@ -95,19 +272,193 @@ class OpenAIKernel(MetaKernel):
     def organization(self, org):
         self.openai.organization = org
 
+    @property
+    def connection_pool(self):
+        """
+        The connection pool, created the first time it is needed so requests
+        and urllib3 aren't imported while the kernel starts.
+        """
+        if self._connection_pool is None:
+            with self._connection_pool_lock:
+                if self._connection_pool is None:
+                    self._connection_pool = self._make_connection_pool()
+        return self._connection_pool
+
+    @connection_pool.setter
+    def connection_pool(self, pool):
+        self._connection_pool = pool
+
+    def _make_connection_pool(self):
+        from .connection_pool import ConnectionPool
+
+        return ConnectionPool(
+            pool_size=self.variables["pool_size"],
+            max_retries=self.variables["max_retries"],
+            proxy=self.variables["proxy"],
+            compress=self.variables["compress_requests"],
+        )
+
+    @property
+    def pool_stats(self):
+        return self.connection_pool.stats()
+
+    @property
+    def scheduler_stats(self):
+        return self.scheduler.stats
+
+    @property
+    def request_timeout(self):
+        return (self.variables["connect_timeout"], self.variables["read_timeout"])
+
     @property
     def history(self):
-        msg_list = []
-        if self.variables["system_prompt"]:
-            msg_list.append(
-                {"role": "system", "content": self.variables["system_prompt"]}
+        return self.prompt_messages()
+
+    def prompt_messages(self, msg=None, msg_tokens=0):
+        """
+        Returns the messages to send: the system prompt, then as much recent
+        history as fits the model's token budget, then `msg` if given.
+        """
+        return [message for message, _ in self.prompt_entries(msg, msg_tokens)]
+
+    def prompt_entries(self, msg=None, msg_tokens=0):
+        """Returns the prompt messages paired with their token counts."""
+        entries = []
+        system_msg = self._system_message()
+        if system_msg:
+            entries.append((system_msg, self._system_prompt_tokens(system_msg)))
+        if self.use_history:
+            start = self._history_start(msg_tokens)
+            entries.extend(
+                (message, tokens) for _, message, tokens in self._history.entries(start)
             )
+        if msg is not None:
+            entries.append((msg, msg_tokens))
+        return entries
+
+    def prompt_encoded(self, msg=None, msg_tokens=0):
+        """
+        Returns the JSON of the messages `prompt_entries` returns. The system
+        prompt and history messages are only encoded the first time they
+        are sent.
+        """
+        encoded = []
+        system_msg = self._system_message()
+        if system_msg:
+            content, data = self._system_encoded
+            if content != system_msg["content"]:
+                data = encode_message(system_msg)
+                self._system_encoded = (system_msg["content"], data)
+            encoded.append(data)
         if self.use_history:
-            msg_list.extend(self._history)
-        return msg_list
+            encoded.extend(self._history.encoded(self._history_start(msg_tokens)))
+        if msg is not None:
+            encoded.append(encode_message(msg))
+        return encoded
+
+    def _system_message(self):
+        system_prompt = self.variables["system_prompt"]
+        if system_prompt:
+            return {"role": "system", "content": system_prompt}
+        return None
+
+    def _history_start(self, msg_tokens=0):
+        """Returns where the history window starts, leaving room for `msg_tokens`."""
+        budget = self.history_budget() - msg_tokens
+        system_msg = self._system_message()
+        if system_msg:
+            budget -= self._system_prompt_tokens(system_msg)
+        return self._history.window_start(budget)
+
+    def _system_prompt_tokens(self, system_msg):
+        content, model, tokens = self._system_tokens
+        if content != system_msg["content"] or model != self.variables["model"]:
+            model = self.variables["model"]
+            tokens = tokenizer.count_message_tokens(system_msg, model)
+            self._system_tokens = (system_msg["content"], model, tokens)
+        return tokens
+
+    def history_budget(self):
+        """
+        Returns the number of prompt tokens available for the history: the
+        context window minus the room left for the completion.
+        """
+        context_window = self.variables["context_window"] or get_context_window(
+            self.variables["model"]
+        )
+        chat_kwargs = self.variables.get("chat_kwargs", {})
+        completion_tokens = (
+            chat_kwargs.get("max_tokens") or self.variables["completion_tokens"]
+        )
+        return context_window - completion_tokens - tokenizer.REPLY_PRIMING_TOKENS
+
+    @property
+    def chat_history(self):
+        """The whole stored chat history, not only what fits the prompt."""
+        return self._history
 
     def clear_history(self):
-        self._history = []
+        self._history.clear()
+
+    def new_thread(self, name, fork=False):
+        """
+        Start a conversation thread named `name` and make it the active one.
+        With `fork` it starts with (and shares) the active thread's history.
+        """
+        if name in self.threads:
+            raise ValueError(f"There is already a thread named '{name}'")
+        if fork:
+            self.threads[name] = self._history.fork()
+        else:
+            self.threads[name] = History(model=self.variables["model"])
+        self.switch_thread(name)
+
+    def switch_thread(self, name):
+        if name not in self.threads:
+            raise ValueError(f"There is no thread named '{name}'")
+        self.active_thread = name
+        self._history = self.threads[name]
+
+    def drop_thread(self, name):
+        if name not in self.threads:
+            raise ValueError(f"There is no thread named '{name}'")
+        if name == self.active_thread:
+            raise ValueError("The active thread can't be dropped, switch first")
+        del self.threads[name]
+
+    def _open_history(self, path):
+        """
+        Returns a history persisted to (and restored from) the log at `path`,
+        or kept in memory only when `path` is None.
+        """
+        log = HistoryLog(path) if path else None
+        return History(model=self.variables["model"], log=log)
+
+    def _open_embedding_cache(self, path):
+        if not path:
+            return None
+        return EmbeddingCache(None if path is True else path)
+
+    def _open_search_index(self, path):
+        if not path:
+            return None
+        return SearchIndex(None if path is True else path)
+
+    def append_turn(self, msg, answer, msg_tokens=None):
+        """
+        Append a turn, the user's message and the answer, to the active
+        thread's history and to the search index.
+        """
+        self._history.append(msg, msg_tokens)
+        self._history.append(answer)
+        if self.search_index is not None:
+            try:
+                self.search_index.add_turn(
+                    self.session_id, self.active_thread, [msg, answer]
+                )
+            except Exception as e:
+                # the answer is in the history, missing the index isn't fatal
+                self.log.error("Can't index the turn: error: %s" % e)
 
     def get_variable(self, name):
         if hasattr(self, name):
@@ -125,67 +476,590 @@ class OpenAIKernel(MetaKernel):
         elif name == "use_history":
             self.use_history = bool(value)
         elif name == "history":
-            self._history = value
+            self._history.clear()
+            self._history.extend(value)
+        elif name == "history_file":
+            self.variables[name] = value
+            history = self._open_history(value)
+            if not len(history):
+                # start the new log with the current history
+                for _, message, tokens in self._history.entries():
+                    history.append(message, tokens)
+            if self._history.log is not None:
+                self._history.log.close()
+            self._history = history
+            self.threads[self.active_thread] = history
+        elif name == "search_index":
+            self.variables[name] = value
+            if self.search_index is not None:
+                self.search_index.close()
+            self.search_index = self._open_search_index(value)
+        elif name in ("pool_size", "max_retries", "proxy"):
+            self.variables[name] = value
+            if self._connection_pool is not None:
+                self._connection_pool.close()
+                self.connection_pool = None
+        elif name == "hedge_after":
+            try:
+                self.hedge_policy = parse_hedge_after(value)
+            except ValueError as e:
+                self.Error(
+                    f"hedge_after must be None, a number of seconds or a "
+                    f"percentile like p95: {e}"
+                )
+            else:
+                self.variables[name] = value
+        elif name == "compress_requests":
+            self.variables[name] = bool(value)
+            if self._connection_pool is not None:
+                self._connection_pool.session.compress = bool(value)
+        elif name == "rate_limits":
+            self.variables[name] = value
+            for model, limits in value.items():
+                self.scheduler.set_limits(model, **limits)
+        elif name == "request_retries":
+            self.variables[name] = value
+            self.scheduler.max_retries = value
+        elif name == "metrics_size":
+            self.variables[name] = value
+            self.metrics.resize(value)
+        elif name == "metrics_file":
+            self.variables[name] = value
+            if value:
+                self.metrics.export(value)
+            else:
+                self.metrics.close()
+                self.metrics.export_path = None
+        elif name == "image_display":
+            if value in IMAGE_DISPLAYS:
+                self.variables[name] = value
+            else:
+                choices = ", ".join(IMAGE_DISPLAYS)
+                self.Error(f"image_display must be one of {choices}")
+        elif name == "image_dir":
+            self.variables[name] = value
+            self.image_store = ImageStore(value)
+        elif name == "embed_cache":
+            self.variables[name] = value
+            if self.embedding_cache is not None:
+                self.embedding_cache.close()
+            self.embedding_cache = self._open_embedding_cache(value)
         elif name == "mode":
-            if value == "chat":
-                self.mode = "chat"
-            elif value == "image":
-                self.mode = "image"
+            if value in ("chat", "image", "embed"):
+                self.mode = value
         else:
             self.variables[name] = value
 
+    def _finish_message(self, finish_reason, message_content):
+        if finish_reason == "length":
+            message_content = (
+                "This response was truncated due to the token limit. To get a "
+                "complete response, you can try clearing the chat history with "
+                "`%clear_history`, setting the history manually with `%set "
+                'history [{"role": "user", "content": "your content here"}, '
+                '{"role": "assistant", "content": "example response"}]`, or '
+                "turning off history with `%set use_history False`. You can "
+                "view history with `%history`\n"
+            ) + message_content
+        elif finish_reason == "content_filter":
+            message_content = "This message was flagged for inappropriate content"
+        return message_content
+
+    def send_markdown(self, text, display_id, update=False):
+        """Display markdown, or replace the display with the same display_id."""
+        content = {
+            "data": {"text/plain": text, "text/markdown": text},
+            "metadata": {},
+            "transient": {"display_id": display_id},
+        }
+        msg_type = "update_display_data" if update else "display_data"
+        self.send_response(self.iopub_socket, msg_type, content)
+
+    def create_chat_completion(
+        self,
+        messages,
+        stream=False,
+        prompt_tokens=None,
+        metrics=None,
+        encoded=None,
+        model=None,
+    ):
+        """
+        Make a chat completion request with the current settings (or another
+        `model`) on the calling thread, through the kernel's connection pool
+        and scheduler, to the first backend that answers.
+        `encoded` can hold the messages' JSON, see `prompt_encoded`.
+        """
+        model = model or self.variables["model"]
+        chat_kwargs = {
+            "request_timeout": self.request_timeout,
+            **self.variables.get("chat_kwargs", {}),
+        }
+        chat_kwargs.pop("stream", None)
+
+        estimated_tokens = 0
+        if self.scheduler.wants_token_estimate(model):
+            if prompt_tokens is None:
+                prompt_tokens = tokenizer.count_prompt_tokens(messages, model)
+            estimated_tokens = prompt_tokens + (
+                chat_kwargs.get("max_tokens") or self.variables["completion_tokens"]
+            )
+
+        if encoded is None:
+            encoded = [encode_message(message) for message in messages]
+
+        def send(backend):
+            session = self.connection_pool.session
+            if metrics is not None:
+                metrics.backend = backend.name
+
+            def request(request_messages):
+                return self.openai.ChatCompletion.create(
+                    model=model,
+                    messages=request_messages,
+                    temperature=self.variables["temperature"],
+                    stream=stream,
+                    **(backend.request_kwargs() or self.gateway_kwargs()),
+                    **chat_kwargs,
+                )
+
+            if not self.connection_pool.is_installed():
+                # the openai library uses a session of its own
+                return request(messages)
+            # the session sends the encoded messages in place of the empty list
+            session.prepare_messages(encoded)
+            try:
+                return request([])
+            finally:
+                sent = session.take_sent()
+                if metrics is not None and sent is not None:
+                    metrics.request_bytes += sent
+
+        def create():
+            self.connection_pool.install()
+            return self.backends.call(send, model)
+
+        return self.scheduler.run(create, model, estimated_tokens, metrics)
+
+    def request_chat(
+        self, messages, stream=False, prompt_tokens=None, metrics=None, encoded=None
+    ):
+        """
+        Sends a chat completion request on another thread, returning the model
+        that answered and its response (an iterator of chunks when streamed).
+
+        With hedging on ('%set hedge_after p95') a duplicate request, to the
+        hedge model when there is one, is sent if the first one hasn't
+        produced a byte within the hedge delay, and the first to answer is
+        used while the other is cancelled. The delay is taken from past
+        requests of the same kind: the times to first byte of streamed ones,
+        or the latencies of the others. A hedge is recorded on `metrics`
+        with its estimated saving and the cost of the losing request: its
+        prompt, and the completion it is billed for when it couldn't be
+        cancelled (the winner's, as an estimate).
+        """
+        model = self.variables["model"]
+        request = functools.partial(
+            self.create_chat_completion,
+            messages,
+            stream=stream,
+            prompt_tokens=prompt_tokens,
+            encoded=encoded,
+        )
+        if stream:
+            samples = self.metrics.values("ttfb", model, streamed=True)
+        else:
+            samples = self.metrics.values("latency", model, streamed=False)
+        delay = hedge_delay(self.hedge_policy, samples)
+        if delay is None:
+            request = functools.partial(request, metrics=metrics)
+            if stream:
+                return model, iter_in_thread(request)
+            return model, call_in_thread(request)
+
+        names = [model, self.variables["hedge_model"] or model]
+        racer_metrics = [None, None]
+        if metrics is not None:
+            # each request records its own backend, bytes sent and queue time
+            racer_metrics = [ExecutionMetrics(metrics.mode, name) for name in names]
+        race = Race(
+            [
+                (name, functools.partial(request, model=name, metrics=m))
+                for name, m in zip(names, racer_metrics)
+            ],
+            [0.0, delay],
+            stream,
+        )
+        winner = race.run()
+        hedge = race.racers[1]
+        if metrics is not None:
+            metrics.add_request(racer_metrics[race.racers.index(winner)])
+            if hedge.started is not None:
+                won = winner is hedge
+                saved = expected_saving(samples, winner.first_byte) if won else None
+                loser = names[0] if won else names[1]
+                # a streamed loser is cancelled, one that isn't runs to the end
+                completion_tokens = 0
+                if not stream:
+                    usage = winner.result.get("usage") or {}
+                    completion_tokens = usage.get("completion_tokens", 0)
+                cost = estimate_chat_cost(loser, prompt_tokens or 0, completion_tokens)
+                metrics.add_hedge(won, saved, cost)
+        return winner.name, winner.result
+
+    def prompt_only_messages(self, prompt):
+        """The messages of a single prompt: the system prompt and the prompt."""
+        messages = []
+        if self.variables["system_prompt"]:
+            messages.append(
+                {"role": "system", "content": self.variables["system_prompt"]}
+            )
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def complete_prompt(self, prompt):
+        """
+        Returns the answer to a single prompt, sent with the system prompt but
+        without (and without adding to) the chat history.
+        """
+        resp = self.create_chat_completion(self.prompt_only_messages(prompt))
+        return resp["choices"][0]["message"]["content"]
+
+    def _default_api_key(self):
+        """The api key the openai library sends, if it has one."""
+        api_key = self.openai.api_key
+        if api_key is None and self.openai.api_key_path:
+            try:
+                with open(self.openai.api_key_path) as fid:
+                    api_key = fid.read().strip()
+            except OSError:
+                pass
+        return api_key
+
+    def check_backends(self, names=None):
+        """
+        Health check the named backends, or all of them, returning whether
+        each one is up.
+        """
+        api_key = self.gateway_kwargs().get("api_key") or self._default_api_key()
+        results = {}
+        for name in names or list(self.backends.backends):
+            backend = self.backends.backends[name]
+            api_base = self.api_base_url
+            results[name] = self.backends.check(
+                backend, self.connection_pool.session, api_base, api_key
+            )
+        return results
+
+    def create_image(self, prompt, metrics=None):
+        """Make an image generation request on the calling thread."""
+
+        def create():
+            self.connection_pool.install()
+            return self.openai.Image.create(
+                prompt=prompt,
+                n=self.variables["n"],
+                size=self.variables["size"],
+                response_format="b64_json",
+                request_timeout=self.request_timeout,
+                **self.gateway_kwargs(),
+            )
+
+        return self.scheduler.run(create, "image", metrics=metrics)
+
+    def create_embeddings(self, texts, tokens=0):
+        """
+        Make an embeddings request on the calling thread, returning the
+        float32 embeddings of the texts and the tokens used.
+        """
+        import numpy as np
+
+        model = self.variables["embed_model"]
+
+        def create():
+            self.connection_pool.install()
+            return self.openai.Embedding.create(
+                input=texts,
+                model=model,
+                # decoded straight into arrays rather than lists of floats
+                encoding_format="base64",
+                request_timeout=self.request_timeout,
+                **self.gateway_kwargs(),
+            )
+
+        resp = self.scheduler.run(create, model, tokens)
+        data = sorted(resp["data"], key=lambda item: item["index"])
+        vectors = decode_embeddings([item["embedding"] for item in data], np)
+        return vectors, resp["usage"]["total_tokens"]
+
+    def _stream_chat(
+        self, messages, silent=False, prompt_tokens=None, metrics=None, encoded=None
+    ):
+        """
+        Request a chat completion with stream=True and keep a single display
+        updated with the partial markdown as the token deltas arrive. Returns
+        the model that answered, the finish reason and the full content.
+        """
+        model, resp = self.request_chat(
+            messages,
+            stream=True,
+            prompt_tokens=prompt_tokens,
+            metrics=metrics,
+            encoded=encoded,
+        )
+        display_id = None
+        parts = []
+        finish_reason = None
+        last_update = 0
+        for chunk in resp:
+            if metrics is not None:
+                metrics.first_byte()
+            choice = chunk["choices"][0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            delta = choice.get("delta", {}).get("content")
+            if not delta:
+                continue
+            parts.append(delta)
+            if silent:
+                continue
+            now = time.monotonic()
+            if display_id is None:
+                display_id = uuid.uuid4().hex
+                self.send_markdown("".join(parts), display_id)
+                last_update = now
+            elif now - last_update >= self.stream_update_interval:
+                self.send_markdown("".join(parts), display_id, update=True)
+                last_update = now
+
+        content = "".join(parts)
+        if not silent:
+            message_content = self._finish_message(finish_reason, content)
+            if display_id is None:
+                self.send_markdown(message_content, uuid.uuid4().hex)
+            else:
+                self.send_markdown(message_content, display_id, update=True)
+        return model, finish_reason, content
+
+    def _chat(
+        self, messages, silent=False, prompt_tokens=None, metrics=None, encoded=None
+    ):
+        """
+        Returns the finish reason and content of a chat completion, from the
+        response cache or the semantic cache when they are on. Streamed
+        responses display themselves.
+        Timings and token usage are recorded on `metrics` when given.
+        """
+        stream = self.variables["stream"]
+        cache_key = None
+        if self.use_cache:
+            cache_key = self.response_cache.make_key(
+                mode="chat",
+                model=self.variables["model"],
+                messages=messages,
+                temperature=self.variables["temperature"],
+                chat_kwargs=self.variables.get("chat_kwargs", {}),
+            )
+            cached = self.response_cache.get_chat(cache_key)
+            if cached is not None:
+                if metrics is not None:
+                    metrics.cached = True
+                return cached["finish_reason"], cached["content"], False
+        semantic_key = None
+        if self.use_semantic_cache:
+            semantic_key = self.semantic_cache.make_key(
+                messages,
+                model=self.variables["model"],
+                temperature=self.variables["temperature"],
+                chat_kwargs=self.variables.get("chat_kwargs", {}),
+            )
+            content = self.semantic_cache.get(*semantic_key)
+            if content is not None:
+                if metrics is not None:
+                    metrics.cached = True
+                return "stop", content, False
+
+        usage = None
+        if metrics is not None:
+            metrics.streamed = stream
+        if stream:
+            model, finish_reason, content = self._stream_chat(
+                messages, silent, prompt_tokens, metrics, encoded
+            )
+        else:
+            model, resp = self.request_chat(
+                messages,
+                prompt_tokens=prompt_tokens,
+                metrics=metrics,
+                encoded=encoded,
+            )
+            # the response arrives all at once, so it has no time to first byte
+            choice = resp["choices"][0]
+            finish_reason = choice["finish_reason"]
+            content = choice["message"]["content"]
+            usage = resp.get("usage")
+        if metrics is not None:
+            if usage:
+                metrics.add_chat_usage(
+                    model, usage["prompt_tokens"], usage["completion_tokens"]
+                )
+            else:
+                # streamed responses don't report usage
+                completion_tokens = tokenizer.count_tokens(content, model)
+                metrics.add_chat_usage(model, prompt_tokens, completion_tokens)
+        if cache_key is not None and finish_reason == "stop":
+            self.response_cache.put_chat(cache_key, content, finish_reason)
+        if semantic_key is not None and finish_reason == "stop":
+            self.semantic_cache.put(*semantic_key, content)
+        return finish_reason, content, stream
+
+    def _images(self, prompt, metrics=None):
+        """
+        Yields the PNG bytes of the generated images, decoding them one at a
+        time.
+        """
+        cache_key = None
+        if self.use_cache:
+            cache_key = self.response_cache.make_key(
+                mode="image",
+                prompt=prompt,
+                n=self.variables["n"],
+                size=self.variables["size"],
+            )
+            images = self.response_cache.get_images(cache_key)
+            if images is not None:
+                if metrics is not None:
+                    metrics.cached = True
+                yield from images
+                return
+
+        resp = call_in_thread(self.create_image, prompt, metrics)
+        if metrics is not None:
+            metrics.decode_time = 0.0
+            metrics.add_image_usage(self.variables["size"], len(resp["data"]))
+        # the cache needs every image, otherwise they're dropped once displayed
+        images = [] if cache_key is not None else None
+        decoded = iter_decoded(resp["data"])
+        while True:
+            decode_start = time.perf_counter()
+            data = next(decoded, None)
+            if metrics is not None:
+                metrics.decode_time += time.perf_counter() - decode_start
+            if data is None:
+                break
+            if images is not None:
+                images.append(data)
+            yield data
+        if cache_key is not None:
+            self.response_cache.put_images(cache_key, images)
+
+    def _embed(self, code, silent=False, metrics=None):
+        """
+        Embeds every non-blank line of `code`, returning the float32 array of
+        their embeddings (also kept as the `embeddings` variable).
+        """
+        texts = [line for line in code.splitlines() if line.strip()]
+        model = self.variables["embed_model"]
+        encoding = tokenizer.get_encoding_for_model(model)
+        display_id = uuid.uuid4().hex
+        last_update = 0.0
+
+        def progress(job):
+            nonlocal last_update
+            now = time.monotonic()
+            if not silent and now - last_update >= self.stream_update_interval:
+                status = f"Embedding: {job.done} of {len(job.texts)} lines"
+                self.send_markdown(status, display_id, update=last_update > 0)
+                last_update = now
+
+        job = EmbeddingJob(
+            texts,
+            model,
+            self.create_embeddings,
+            encoding.count_batch,
+            self.variables["embed_batch_tokens"],
+            self.variables["embed_concurrency"],
+            self.embedding_cache,
+            self.variables["embed_file"],
+            progress,
+        )
+        try:
+            self.embeddings = job.run()
+        finally:
+            if metrics is not None:
+                metrics.cached = job.cached == len(texts)
+                metrics.add_chat_usage(model, job.tokens, 0)
+        shape = " x ".join(str(n) for n in self.embeddings.shape)
+        summary = (
+            f"Embedded {len(texts)} lines ({job.cached} from the cache) in "
+            f"{job.batches} requests: a {shape} float32 array"
+        )
+        if self.variables["embed_file"]:
+            summary += f" written to `{self.variables['embed_file']}`"
+        summary += ", see it with `%get embeddings`"
+        if last_update > 0:
+            self.send_markdown(summary, display_id, update=True)
+            return None
+        return MarkdownOutput(summary)
+
+    def display_image(self, data, alt):
+        """
+        Display a PNG inline, or write it to the image directory and show a
+        thumbnail of it or a link to it, depending on the image_display setting.
+        """
+        image_display = self.variables["image_display"]
+        from IPython.display import HTML, Image
+
+        if image_display == "inline":
+            self.Display(Image(data=data, format="png", alt=alt))
+            return
+        path = self.image_store.save(data)
+        thumbnail_of = data if image_display == "thumbnail" else None
+        self.Display(HTML(image_html(path, alt, thumbnail_of)))
+
     def do_execute_direct(self, code, silent=False):
         resp_content = None
+        if self.mode == "chat":
+            model = self.variables["model"]
+        elif self.mode == "embed":
+            model = self.variables["embed_model"]
+        else:
+            model = "image"
+        metrics = ExecutionMetrics(self.mode, model)
         try:
             if self.mode == "chat":
                 msg = {"role": "user", "content": code}
-                chat_kwargs = self.variables.get("chat_kwargs", {})
-                messages = self.history + [msg]
+                msg_tokens = tokenizer.count_message_tokens(
+                    msg, self.variables["model"]
+                )
+                entries = self.prompt_entries(msg, msg_tokens)
+                messages = [message for message, _ in entries]
+                prompt_tokens = sum(tokens for _, tokens in entries)
+                prompt_tokens += tokenizer.REPLY_PRIMING_TOKENS
 
-                resp = self.openai.ChatCompletion.create(
-                    model=self.variables["model"],
-                    messages=messages,
-                    temperature=self.variables["temperature"],
-                    **chat_kwargs,
+                encoded = self.prompt_encoded(msg, msg_tokens)
+                finish_reason, content, streamed = self._chat(
+                    messages, silent, prompt_tokens, metrics, encoded
                 )
-                choice = resp["choices"][0]
-                finish_reason = choice["finish_reason"]
-                message_content = choice["message"]["content"]
-                if finish_reason == "length":
-                    message_content = (
-                        "This response was truncated due to the token limit. To get a "
-                        "complete response, you can try clearing the chat history with "
-                        "`%clear_history`, setting the history manually with `%set "
-                        'history [{"role": "user", "content": "your content here"}, '
-                        '{"role": "assistant", "content": "example response"}]`, or '
-                        "turning off history with `%set use_history False`. You can "
-                        "view history with `%history`\n"
-                    ) + message_content
-                elif finish_reason == "content_filter":
-                    message_content = (
-                        "This message was flagged for inappropriate content"
-                    )
-                resp_content = MarkdownOutput(message_content)
-                self._history += [msg]
-                self._history += [{"role": "assistant", "content": message_content}]
-            elif self.mode == "image":
-                resp = openai.Image.create(
-                    prompt=code,
-                    n=self.variables["n"],
-                    size=self.variables["size"],
-                    response_format="b64_json",
+                message_content = self._finish_message(finish_reason, content)
+                if not streamed:
+                    resp_content = MarkdownOutput(message_content)
+                self.append_turn(
+                    msg, {"role": "assistant", "content": message_content}, msg_tokens
                 )
-                for i, img in enumerate(resp["data"]):
-                    self.Display(
-                        Image(
-                            data=base64.b64decode(img["b64_json"]),
-                            format="png",
-                            alt=f"{code} generated image {i}",
-                        )
-                    )
+            elif self.mode == "image":
+                for i, data in enumerate(self._images(code, metrics)):
+                    self.display_image(data, f"{code} generated image {i}")
+            elif self.mode == "embed":
+                resp_content = self._embed(code, silent, metrics)
+
+        except (Exception, KeyboardInterrupt) as e:
+            import requests
+            from openai import error
 
-        except Exception as e:
-            if isinstance(e, AuthenticationError):
+            metrics.error = type(e).__name__
+            if isinstance(e, KeyboardInterrupt):
+                message_content = "The request to the OpenAI API was cancelled"
+            elif isinstance(e, error.AuthenticationError):
                 if "No API key provided" in e.user_message:
                     message_content = (
                         "No OpenAI API key provided, set your API key by using the "
@@ -201,6 +1075,19 @@ class OpenAIKernel(MetaKernel):
                     "Something went wrong communicating with the OpenAI API, "
                     "please try again"
                 )
+            elif isinstance(e, error.RateLimitError):
+                message_content = (
+                    "The OpenAI API rate limit was hit and retrying didn't help, "
+                    "please wait a moment and try again. Requests can be paced "
+                    'with \'%set rate_limits {"gpt-3.5-turbo": {"rpm": 3500, '
+                    '"tpm": 90000}}\''
+                )
+            elif isinstance(e, error.Timeout):
+                message_content = (
+                    "The OpenAI API did not respond in time, you can change the "
+                    "timeouts (in seconds) with '%set connect_timeout 10' and "
+                    "'%set read_timeout 600'"
+                )
             else:
                 message_content = str(e)
             resp_content = ExceptionWrapper(
@@ -208,6 +1095,8 @@ class OpenAIKernel(MetaKernel):
                 str(e),
                 [message_content + "\n"] + traceback.format_tb(e.__traceback__),
             )
+        metrics.finish()
+        self.metrics.record(metrics)
         if not silent:
             return resp_content
 
@@ -221,11 +1110,34 @@ This kernel has 2 modes, "chat" and "image". You can change the mode via the mod
 In chat mode you can talk to Chat GPT by typing your query in a cell and running it.
 You can tweak the settings with the following magic commands.
 Set the model to use with '%set model gpt-3.5-turbo', set the temperature with '%set temperature 1' (between 0-1). Set the initial system message using '%set system_prompt you are a bot' (you can also set it to None to remove it).
-By default the kernel sends chat history with each request, contibuting to the models token limit. View chat history using '%history'. Clear chat history with '%clear_history'.
+By default the kernel sends chat history with each request, contibuting to the models token limit. The oldest turns are left out once the history no longer fits the model's context window, leaving room for a reply of '%set completion_tokens 512' tokens (override the window with '%set context_window 8192'). View chat history using '%history' (add '--tokens' to see token counts, '--last 20' or '--range 100:120' to page through the whole stored history). Clear chat history with '%clear_history'.
 You can disable history using '%set use_history False'.
+Keep several conversations with '%thread new NAME', '%thread fork NAME' (starts from the current conversation), '%thread switch NAME', '%thread drop NAME' and '%thread list'. Cells, '%history' and '%clear_history' use the active thread.
+Keep the history across kernel restarts with '%set history_file ~/chat_history.jsonl' (or the OPENAI_KERNEL_HISTORY_FILE environment variable), every message is appended to it and it is restored on startup.
+Search the chat history of every session with '%search connection pool' once turns are indexed with '%set search_index True' (or a path, or the OPENAI_KERNEL_SEARCH_INDEX environment variable). It shows the best matching messages with their session, thread and time, and '%search --load 1042,1187' adds the turns of those messages back to the history.
 You can also set the history manually using '%set history [{"role": "user", "content": "hello bot"}, {"role": "assistant", "content": "hi user"}]'. The history commands can be useful if you hit the model's token limit (https://help.openai.com/en/articles/4936856-what-are-tokens-and-how-to-count-them#).
 Any other chat arguments you wish to set can be set with '%set chat_kwargs {"frequency_penalty": 1}'
+Stream responses into the cell as they are generated with '%set stream True'.
+Requests run in the background, so interrupting the kernel cancels a pending request. Set the request timeouts (in seconds) with '%set connect_timeout 10' and '%set read_timeout 600'.
+Rate limited or failed requests are retried up to '%set request_retries 5' times. Pace requests client-side per model with '%set rate_limits {"gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000}}', and see the scheduler's counters with '%get scheduler_stats'.
+Cut the tail latency of chat cells by hedging slow requests with '%set hedge_after p95': when a request hasn't sent back a byte within the 95th percentile of the recent times to first byte for the model (of latencies when not streaming, or within a number of seconds, '%set hedge_after 2.5'), the same request is sent again, to '%set hedge_model gpt-3.5-turbo' if set, the first answer is used and the other request is cancelled. '%stats' shows how often requests were hedged, the time saved and the extra cost (at least: a cancelled stream is billed for the tokens it got too). Race models against each other with '%%race gpt-4 gpt-3.5-turbo' on the first line of a cell.
+Request bodies larger than 1KB can be gzipped with '%set compress_requests True', if your endpoint accepts compressed requests.
+Requests share a pool of keep-alive connections, configure it with '%set pool_size 10', '%set max_retries 2' and '%set proxy http://proxy:3128'. See its usage with '%get pool_stats'.
+Kernels on the same machine can share one gateway process ('python -m openai_kernel gateway --rpm 3500 --cache'), which owns the connection pool, paces requests per organization for all of them, and caches and sends once the requests whose answer can be repeated (embeddings, temperature 0, or kernels with '%cache on'). Use it with '%set gateway /path/to/gateway.sock' (or the OPENAI_KERNEL_GATEWAY environment variable) and see its counters with '%get gateway_stats'.
+Send chat requests to self-hosted OpenAI compatible servers (llama.cpp, vLLM, ...) with '%backend add local http://localhost:8080/v1 --models llama*' (add '--key KEY' if it needs one). Backends are tried by '--priority' (OpenAI's is 10, added backends default to 0), or fastest first with '%backend policy latency', and a backend that fails or times out is skipped for a while and the next one is used. '%backend check' runs health checks, '%backend list' shows each backend's latency, requests and errors.
 
 In image mode you can generate images by typing a prompt in a cell and running it.
 Set image size using '%set size 1024x1024' (one of 256x256, 512x512, or 1024x1024).
-Set number of images generated using '%set n 5' (between 1-10)"""  # noqa
+Set number of images generated using '%set n 5' (between 1-10)
+Large images make large notebooks. With '%set image_display thumbnail' full size images are written to the 'openai_images' directory (change it with '%set image_dir PATH') and shown as linked thumbnails (downscaled with Pillow when installed), '%set image_display link' only links to them, and '%set image_display inline' embeds them again.
+
+In embed mode ('%mode embed') every line of a cell is embedded with '%set embed_model text-embedding-ada-002' (needs NumPy), and the embeddings are available as a float32 array with '%get embeddings'. The lines are packed into requests of up to '%set embed_batch_tokens 100000' tokens, sent '%set embed_concurrency 8' at a time, and the array is written to a memory-mapped file with '%set embed_file embeddings.npy'. Lines embedded before are taken from a cache (turn it off with '%set embed_cache None' or move it with '%set embed_cache PATH').
+
+Run many prompts concurrently with the '%%batch --concurrency 8' cell magic, one prompt per line (or a JSON list of prompts). They use the current model and system prompt, don't use or change the chat history, and the answers are available with '%get batch_results'.
+
+Ask about files too large for one prompt with the '%%over_file PATH --chunk-tokens 3000 --overlap 200' cell magic: the cell's instruction is answered for every chunk of the file concurrently and the answers are combined into one, which is added to the chat history. Answers are checkpointed, so running an interrupted cell again resumes it.
+
+Every cell records its queue time, time to first byte, latency, token usage, bytes sent and estimated cost, '%stats' shows the session totals and p50/p95 timings. Keep the last '%set metrics_size 1000' executions, and write them as JSON lines to a file with '%stats --export metrics.jsonl' (or '%set metrics_file metrics.jsonl').
+
+Identical chat and image requests can be answered from a local response cache, turn it on with '%cache on' (and off with '%cache off'). '%cache stats' shows hits and misses, '%cache clear' empties it.
+Rephrased questions can be answered from a semantic cache, which compares prompts by their embeddings in the same context (model, settings, system prompt and the last messages), turn it on with '%semantic_cache on' (needs NumPy) and tune it with '--threshold 0.9', '--capacity 1000' and '--context 2'. '%semantic_cache stats' shows the hit rate."""  # noqa
@@ -1,5 +1,14 @@
+from .backend_magic import BackendMagic
+from .batch_magic import BatchMagic
+from .cache_magic import CacheMagic
 from .clear_history_magic import ClearHistoryMagic
 from .history_magic import HistoryMagic
 from .mode_magic import ModeMagic
 from .openai_api_magic import OpenAIApiMagic
+from .over_file_magic import OverFileMagic
+from .race_magic import RaceMagic
+from .search_magic import SearchMagic
+from .semantic_cache_magic import SemanticCacheMagic
 from .set_magic import SetMagic
+from .stats_magic import StatsMagic
+from .thread_magic import ThreadMagic
@@ -0,0 +1,126 @@
+from metakernel import Magic, option
+
+from openai_kernel.backends import ROUTING_POLICIES
+from openai_kernel.outputs import MarkdownOutput
+
+
+def _latency(value):
+    return "-" if value is None else f"{value:.0f} ms"
+
+
+class BackendMagic(Magic):
+    @option(
+        "-k",
+        "--key",
+        action="store",
+        default=None,
+        help="API key of the backend",
+    )
+    @option(
+        "-m",
+        "--models",
+        action="store",
+        default=None,
+        help="Comma separated models (glob patterns) the backend serves",
+    )
+    @option(
+        "-p",
+        "--priority",
+        action="store",
+        type=int,
+        default=0,
+        help="Backends with a lower priority are tried first (openai has 10)",
+    )
+    @option(
+        "-r",
+        "--raw",
+        action="store_true",
+        default=False,
+        help="Return the backends' stats as a list of dicts",
+    )
+    def line_backend(
+        self,
+        action="list",
+        name=None,
+        url=None,
+        key=None,
+        models=None,
+        priority=0,
+        raw=False,
+    ):
+        """
+        %backend add|remove|list|check|policy - route chat requests to
+        OpenAI compatible servers
+
+        Chat requests go to the first backend serving the model that
+        answers, falling back to the next one on connection errors,
+        timeouts, rate limits and server errors. The "openai" backend uses
+        the api key and base of the openai library, and is tried after the
+        backends added with the default priority. 'policy latency' tries the
+        fastest backend first instead, 'policy order' goes by priority.
+
+        Examples:
+            %backend add local http://localhost:8080/v1 --models llama*,mistral*
+            %backend add vllm http://gpu-box:8000/v1 --key secret --priority 5
+            %backend check
+            %backend policy latency
+            %backend remove local
+            %backend list
+        """
+        router = self.kernel.backends
+        self.retval = None
+        self.raw = raw
+        if action == "add":
+            if not name or not url:
+                self.kernel.Error("Usage: %backend add NAME URL [--key KEY]")
+                return
+            models = [model.strip() for model in (models or "").split(",")]
+            router.add(name, url, key, [model for model in models if model], priority)
+        elif action == "remove":
+            try:
+                router.remove(name)
+            except ValueError as e:
+                self.kernel.Error(str(e))
+        elif action == "check":
+            if name is not None and name not in router.backends:
+                self.kernel.Error(f"There is no backend named '{name}'")
+                return
+            self.kernel.check_backends([name] if name else None)
+            self.retval = router.stats()
+        elif action == "policy":
+            if name is None:
+                self.retval = router.policy
+            elif name in ROUTING_POLICIES:
+                router.policy = name
+            else:
+                self.kernel.Error(
+                    f"Unknown routing policy '{name}', use one of {ROUTING_POLICIES}"
+                )
+        elif action == "list":
+            self.retval = router.stats()
+        else:
+            self.kernel.Error(f"Unknown backend action '{action}'")
+
+    def post_process(self, retval):
+        stats = self.retval
+        if self.raw or not isinstance(stats, list):
+            return stats
+        lines = [
+            f"Routing policy: {self.kernel.backends.policy}",
+            "",
+            "| Backend | URL | Models | Priority | Up | Latency | Requests | Errors |",
+            "| --- | --- | --- | --- | --- | --- | --- | --- |",
+        ]
+        for backend in stats:
+            lines.append(
+                f"| {backend['name']} | {backend['api_base'] or 'openai'} "
+                f"| {', '.join(backend['models']) or 'all'} | {backend['priority']} "
+                f"| {'yes' if backend['healthy'] else 'no'} "
+                f"| {_latency(backend['latency_ms'])} | {backend['requests']} "
+                f"| {backend['errors']} |"
+            )
+        return MarkdownOutput(str(stats), "\n".join(lines))
+
+
+def register_magics(kernel):
+    kernel.register_magics(BackendMagic)
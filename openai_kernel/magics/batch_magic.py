@@ -0,0 +1,66 @@
+import time
+import uuid
+
+from metakernel import Magic, option
+
+from openai_kernel.batch import format_results_table, parse_prompts, run_batch
+
+
+class BatchMagic(Magic):
+    @option(
+        "-c",
+        "--concurrency",
+        action="store",
+        type=int,
+        default=8,
+        help="Number of requests to run at the same time",
+    )
+    def cell_batch(self, concurrency=8):
+        """
+        %%batch [--concurrency N] - send every line of the cell as its own prompt
+
+        The prompts (one per line, or a JSON list) are sent concurrently with
+        the current model, temperature, system prompt and chat_kwargs, without
+        the chat history. Results are shown in order in a table as they
+        arrive, and stored as the `batch_results` variable.
+
+        Example:
+            %%batch --concurrency 4
+            Translate 'cat' to French
+            Translate 'dog' to French
+        """
+        self.evaluate = False
+        prompts = parse_prompts(self.code)
+        results = [None] * len(prompts)
+        display_id = uuid.uuid4().hex
+        self.kernel.send_markdown(format_results_table(prompts, results), display_id)
+        last_update = time.monotonic()
+
+        def on_result(index, result):
+            nonlocal last_update
+            results[index] = result
+            now = time.monotonic()
+            if now - last_update >= self.kernel.stream_update_interval:
+                table = format_results_table(prompts, results)
+                self.kernel.send_markdown(table, display_id, update=True)
+                last_update = now
+
+        try:
+            run_batch(
+                self.kernel.complete_prompt,
+                prompts,
+                concurrency=concurrency,
+                on_result=on_result,
+            )
+        except KeyboardInterrupt:
+            self.kernel.Error("Batch interrupted")
+        table = format_results_table(prompts, results)
+        self.kernel.send_markdown(table, display_id, update=True)
+        self.kernel.set_variable(
+            "batch_results",
+            [result[1] if result else None for result in results],
+        )
+
+
+def register_magics(kernel):
+    kernel.register_magics(BatchMagic)
@@ -0,0 +1,68 @@
+from metakernel import Magic, option
+
+from openai_kernel.cache import ResponseCache
+
+
+class CacheMagic(Magic):
+    @option(
+        "-d",
+        "--dir",
+        action="store",
+        default=None,
+        help="Directory to keep the cached responses in",
+    )
+    @option(
+        "-s",
+        "--max-mb",
+        action="store",
+        type=float,
+        default=None,
+        help="Evict the oldest entries once the cache is larger than this",
+    )
+    @option(
+        "-a",
+        "--max-age-days",
+        action="store",
+        type=float,
+        default=None,
+        help="Drop entries older than this many days",
+    )
+    def line_cache(self, action="stats", dir=None, max_mb=None, max_age_days=None):
+        """
+        %cache on|off|clear|stats - manage the local response cache
+
+        Identical chat and image requests are answered from an on-disk
+        cache while it is on.
+
+        Examples:
+            %cache on
+            %cache on --dir /tmp/openai_cache --max-mb 100 --max-age-days 1
+            %cache stats
+        """
+        cache = self.kernel.response_cache
+        if dir is not None:
+            cache = ResponseCache(dir, cache.max_bytes, cache.max_age)
+            self.kernel.response_cache = cache
+        if max_mb is not None:
+            cache.max_bytes = int(max_mb * 2**20)
+        if max_age_days is not None:
+            cache.max_age = max_age_days * 86400
+
+        self.retval = None
+        if action == "on":
+            self.kernel.use_cache = True
+        elif action == "off":
+            self.kernel.use_cache = False
+        elif action == "clear":
+            cache.clear()
+        elif action == "stats":
+            self.retval = dict(enabled=self.kernel.use_cache, **cache.stats())
+        else:
+            self.kernel.Error(f"Unknown cache action '{action}'")
+
+    def post_process(self, retval):
+        return self.retval
+
+
+def register_magics(kernel):
+    kernel.register_magics(CacheMagic)
@@ -1,6 +1,13 @@
 from metakernel import Magic, option
 
 from openai_kernel.outputs import MarkdownOutput
+from openai_kernel.tokenizer import REPLY_PRIMING_TOKENS
+
+
+def parse_range(text):
+    """Parses a 'start:stop' range (either side optional) into a slice."""
+    start, _, stop = text.partition(":")
+    return slice(int(start) if start else None, int(stop) if stop else None)
 
 
 class HistoryMagic(Magic):
@@ -11,21 +18,75 @@ class HistoryMagic(Magic):
         default=False,
         help="Print history in a raw format",
     )
-    def line_history(self, raw=False):
+    @option(
+        "-t",
+        "--tokens",
+        action="store_true",
+        default=False,
+        help="Show the token count of each message",
+    )
+    @option(
+        "-l",
+        "--last",
+        action="store",
+        type=int,
+        default=None,
+        help="Show the last N messages of the whole stored history",
+    )
+    @option(
+        "-g",
+        "--range",
+        action="store",
+        default=None,
+        help="Show messages START:STOP of the whole stored history",
+    )
+    def line_history(self, raw=False, tokens=False, last=None, range=None):
         """
         %history - Show OpenAI chat history
+
+        Shows the messages sent with the next prompt: the system prompt and
+        the recent history that fits the token budget. --last and --range
+        page through the whole stored history instead, by message index.
+
+        Examples:
+            %history --tokens
+            %history --last 20
+            %history --range 100:120
         """
-        self.retval = self.kernel.history
+        self.indexed = last is not None or range is not None
+        if self.indexed:
+            if range is not None:
+                window = parse_range(range)
+            else:
+                window = slice(-last, None) if last > 0 else slice(0, 0)
+            self.entries = self.kernel.chat_history.entries(window.start, window.stop)
+        else:
+            self.entries = [
+                (None, msg, num_tokens)
+                for msg, num_tokens in self.kernel.prompt_entries()
+            ]
+        self.retval = [msg for _, msg, _ in self.entries]
         self.raw = raw
+        self.tokens = tokens
 
     def post_process(self, retval):
-        if not self.raw:
-            markdown = ""
-            for msg in self.retval:
-                markdown += f"{msg}  \n"
-            return MarkdownOutput(str(retval), markdown)
-        else:
+        if self.raw:
             return self.retval
+        lines = []
+        for index, msg, num_tokens in self.entries:
+            line = f"{msg}  "
+            if self.tokens:
+                line = f"`{num_tokens} tokens` {line}"
+            if index is not None:
+                line = f"`[{index}]` {line}"
+            lines.append(line)
+        if self.tokens:
+            total = sum(num_tokens for _, _, num_tokens in self.entries)
+            if not self.indexed:
+                total += REPLY_PRIMING_TOKENS
+            lines.append(f"**Total: {total} tokens**  ")
+        markdown = "".join(line + "\n" for line in lines)
+        return MarkdownOutput(str(retval), markdown)
 
 
 def register_magics(kernel):
@@ -4,7 +4,7 @@ from metakernel import Magic
 class ModeMagic(Magic):
     def line_mode(self, value):
         """
-        %mode MODE - set the mode of this kernel, e.g. chat or image.
+        %mode MODE - set the mode of this kernel, e.g. chat, image or embed.
         """
         self.kernel.mode = value
 
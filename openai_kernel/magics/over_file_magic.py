@@ -0,0 +1,138 @@
+import time
+import uuid
+
+from metakernel import Magic, option
+
+from openai_kernel import tokenizer
+from openai_kernel.outputs import MarkdownOutput
+from openai_kernel.over_file import FileJob
+
+
+def format_progress(job):
+    resumed = f" ({job.resumed} from the checkpoint)" if job.resumed else ""
+    if job.stage == "reading":
+        status = f"Reading `{job.path}`: {job.done} chunks answered{resumed}"
+    elif job.stage == "combining":
+        status = (
+            f"Combining the answers, round {job.level}: "
+            f"{job.done} of {job.total}{resumed}"
+        )
+    else:
+        status = f"Answered over `{job.path}`"
+    if job.errors:
+        status += f", {len(job.errors)} failed"
+    return status
+
+
+class OverFileMagic(Magic):
+    @option(
+        "-t",
+        "--chunk-tokens",
+        action="store",
+        type=int,
+        default=3000,
+        help="Tokens of the file sent with each request",
+    )
+    @option(
+        "-o",
+        "--overlap",
+        action="store",
+        type=int,
+        default=200,
+        help="Tokens each chunk repeats from the end of the one before",
+    )
+    @option(
+        "-c",
+        "--concurrency",
+        action="store",
+        type=int,
+        default=8,
+        help="Number of requests to run at the same time",
+    )
+    @option(
+        "-d",
+        "--checkpoint-dir",
+        action="store",
+        default=None,
+        help="Directory to keep the answers of unfinished jobs in",
+    )
+    def cell_over_file(
+        self, path, chunk_tokens=3000, overlap=200, concurrency=8, checkpoint_dir=None
+    ):
+        """
+        %%over_file PATH - answer the cell's instruction over a large file
+
+        The file is read in overlapping chunks of --chunk-tokens tokens, the
+        instruction is answered for every chunk concurrently (with the
+        system prompt, without the chat history) and the answers are
+        combined until one is left. The file is never held in memory at
+        once. Answers are checkpointed as they arrive, so running the cell
+        again after an interrupt or a failed request only sends what is
+        missing. The instruction and the final answer are added to the
+        chat history.
+
+        Example:
+            %%over_file server.log --chunk-tokens 3000
+            List the distinct errors in this log and how often they occur
+        """
+        self.evaluate = False
+        self.retval = None
+        instruction = self.code.strip()
+        model = self.kernel.variables["model"]
+        display_id = uuid.uuid4().hex
+        last_update = 0.0
+
+        def progress(job, force=False):
+            nonlocal last_update
+            now = time.monotonic()
+            if force or now - last_update >= self.kernel.stream_update_interval:
+                self.kernel.send_markdown(
+                    format_progress(job), display_id, update=last_update > 0
+                )
+                last_update = now
+
+        try:
+            job = FileJob(
+                path,
+                instruction,
+                self.kernel.complete_prompt,
+                lambda text: tokenizer.count_tokens(text, model),
+                chunk_tokens,
+                overlap,
+                concurrency,
+                checkpoint_dir,
+                settings={
+                    name: self.kernel.variables.get(name)
+                    for name in ("model", "temperature", "system_prompt", "chat_kwargs")
+                },
+                progress=progress,
+            )
+        except OSError as e:
+            self.kernel.Error(f"Can't read '{path}': {e}")
+            return
+        progress(job, force=True)
+        try:
+            answer = job.run()
+        except KeyboardInterrupt:
+            progress(job, force=True)
+            self.kernel.Error("Interrupted, run the cell again to resume")
+            return
+        except RuntimeError as e:
+            progress(job, force=True)
+            self.kernel.Error(str(e))
+            return
+        progress(job, force=True)
+        self.kernel.append_turn(
+            {"role": "user", "content": f"{instruction}\n\n(over the file '{path}')"},
+            {"role": "assistant", "content": answer},
+        )
+        self.retval = answer
+
+    def post_process(self, retval):
+        if self.retval is None:
+            return None
+        return MarkdownOutput(self.retval)
+
+
+def register_magics(kernel):
+    kernel.register_magics(OverFileMagic)
@@ -0,0 +1,112 @@
+import functools
+
+from metakernel import Magic, option
+
+from openai_kernel.hedging import Race
+from openai_kernel.outputs import MarkdownOutput
+
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.3f}s"
+
+
+def _result(racer, winner):
+    if racer is winner:
+        return "**won**"
+    if racer.started is None:
+        return "not sent"
+    if racer.error is not None:
+        return f"failed: {type(racer.error).__name__}"
+    if racer.cancelled:
+        return "cancelled"
+    if racer.abandoned:
+        return "abandoned"
+    return "lost"
+
+
+def format_race_table(race):
+    lines = [
+        "| Model | First byte | Finished | Result |",
+        "| --- | --- | --- | --- |",
+    ]
+    for racer in race.racers:
+        lines.append(
+            f"| {racer.name} | {_seconds(racer.first_byte)} "
+            f"| {_seconds(racer.finished)} | {_result(racer, race.winner)} |"
+        )
+    return "\n".join(lines)
+
+
+class RaceMagic(Magic):
+    @option(
+        "-w",
+        "--wait",
+        action="store_true",
+        default=False,
+        help="Let every model finish instead of cancelling the ones that lose",
+    )
+    def cell_race(self, models="", wait=False):
+        """
+        %%race MODEL MODEL... - send the cell to several models, take the fastest
+
+        The prompt is sent to every model at once (with the system prompt,
+        without the chat history) as a streamed request, and the first model
+        to send back a token wins: its answer is shown, and the requests to
+        the other models are cancelled. A table shows the time to the first
+        token and to the end of each answer, in seconds from the start, and
+        is stored as the `race_results` variable. With --wait the other
+        models finish too, so every model's latency is shown.
+
+        Example:
+            %%race gpt-4 gpt-3.5-turbo
+            Summarize the plot of Hamlet in one sentence
+        """
+        self.evaluate = False
+        self.retval = None
+        names = str(models).replace(",", " ").split()
+        if len(names) < 2:
+            self.kernel.Error(
+                "Race at least two models, e.g. '%%race gpt-4 gpt-3.5-turbo'"
+            )
+            return
+        messages = self.kernel.prompt_only_messages(self.code.strip())
+        request = functools.partial(
+            self.kernel.create_chat_completion, messages, stream=True
+        )
+        race = Race(
+            [(name, functools.partial(request, model=name)) for name in names],
+            stream=True,
+        )
+        try:
+            winner = race.run(cancel=not wait)
+            parts = []
+            for chunk in winner.result:
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+            if wait:
+                race.wait()
+        except KeyboardInterrupt:
+            self.kernel.Error("Race interrupted")
+            return
+        except Exception as e:
+            self.kernel.Error(f"The race failed: {type(e).__name__}: {e}")
+            return
+        finally:
+            self.kernel.set_variable(
+                "race_results",
+                [
+                    dict(racer.stats(), won=racer is race.winner)
+                    for racer in race.racers
+                ],
+            )
+        self.retval = "".join(parts) + "\n\n" + format_race_table(race)
+
+    def post_process(self, retval):
+        if self.retval is None:
+            return None
+        return MarkdownOutput(self.retval)
+
+
+def register_magics(kernel):
+    kernel.register_magics(RaceMagic)
@@ -0,0 +1,114 @@
+import re
+
+from metakernel import Magic, option
+
+from openai_kernel.outputs import MarkdownOutput
+
+
+def _cell(text):
+    return " ".join(str(text).split()).replace("|", "\\|")
+
+
+class SearchMagic(Magic):
+    @option(
+        "-n",
+        "--limit",
+        action="store",
+        type=int,
+        default=10,
+        help="Number of matching messages to show",
+    )
+    @option(
+        "-s",
+        "--session",
+        action="store",
+        default=None,
+        help="Only search one session ('current' for this kernel's)",
+    )
+    @option(
+        "-l",
+        "--load",
+        action="store",
+        default=None,
+        help="Append the turns of these comma separated message ids to the history",
+    )
+    @option(
+        "-c",
+        "--clear",
+        action="store_true",
+        default=False,
+        help="Remove every message (or those of --session) from the index",
+    )
+    @option(
+        "-r",
+        "--raw",
+        action="store_true",
+        default=False,
+        help="Return the matching messages as a list of dicts",
+    )
+    def line_search(
+        self, query="", limit=10, session=None, load=None, clear=False, raw=False
+    ):
+        """
+        %search QUERY - search the chat history of every session
+
+        Shows the messages with all the words of the query, best match first,
+        with the session, thread and time (in milliseconds since the epoch)
+        they were said. End a word with * to match the words starting with
+        it. --load adds the turns of the given message ids (the question and
+        its answer) to the active thread's history. Without a query it shows
+        the size of the index.
+
+        Turns are indexed as they happen once '%set search_index True' (or
+        '%set search_index PATH') is set.
+
+        Examples:
+            %search connection pool
+            %search tokeni* --session current --limit 20
+            %search --load 1042,1187
+        """
+        self.retval = None
+        self.raw = raw
+        index = self.kernel.search_index
+        if index is None:
+            self.kernel.Error(
+                "There is no search index, start one with '%set search_index True'"
+            )
+            return
+        if session == "current":
+            session = self.kernel.session_id
+        if clear:
+            index.clear(session)
+        elif load is not None:
+            ids = [int(i) for i in re.findall(r"\d+", str(load))]
+            messages = index.turn_messages(ids)
+            if not messages:
+                self.kernel.Error(f"There are no messages with the ids {load}")
+                return
+            self.kernel.chat_history.extend(messages)
+            self.retval = f"Loaded {len(messages)} messages into the history"
+        elif str(query).strip():
+            self.retval = index.search(str(query), limit, session)
+        else:
+            self.retval = index.stats()
+
+    def post_process(self, retval):
+        hits = self.retval
+        if self.raw or not isinstance(hits, list):
+            return hits
+        if not hits:
+            return "No messages match"
+        lines = [
+            "| Id | Session | Thread | Role | Time (ms) | Message |",
+            "| --- | --- | --- | --- | --- | --- |",
+        ]
+        for hit in hits:
+            lines.append(
+                f"| {hit['id']} | {_cell(hit['session'])} | {_cell(hit['thread'])} "
+                f"| {hit['role']} | {hit['timestamp_ms']} | {_cell(hit['snippet'])} |"
+            )
+        return MarkdownOutput(str(hits), "\n".join(lines))
+
+
+def register_magics(kernel):
+    kernel.register_magics(SearchMagic)
@@ -0,0 +1,113 @@
+from metakernel import Magic, option
+
+from openai_kernel.semantic_cache import SemanticCache, load_embedder
+
+
+class SemanticCacheMagic(Magic):
+    @option(
+        "-t",
+        "--threshold",
+        action="store",
+        type=float,
+        default=None,
+        help="Cosine similarity a stored prompt needs to answer a new one",
+    )
+    @option(
+        "-c",
+        "--capacity",
+        action="store",
+        type=int,
+        default=None,
+        help="Replace the least recently used entries past this many",
+    )
+    @option(
+        "-x",
+        "--context",
+        action="store",
+        type=int,
+        default=None,
+        help="Number of previous messages a hit must share with the prompt",
+    )
+    @option(
+        "-d",
+        "--dir",
+        action="store",
+        default=None,
+        help="Directory to keep the cache in",
+    )
+    @option(
+        "-e",
+        "--embedder",
+        action="store",
+        default=None,
+        help="Embedder to use instead of the hashing one, as module:attribute",
+    )
+    def line_semantic_cache(
+        self,
+        action="stats",
+        threshold=None,
+        capacity=None,
+        context=None,
+        dir=None,
+        embedder=None,
+    ):
+        """
+        %semantic_cache on|off|clear|stats - manage the semantic cache
+
+        While it is on, a chat prompt similar enough to one answered before,
+        in the same context, gets the stored answer without a request. The
+        prompts are compared by their embeddings, from a hashing embedder by
+        default or from any embedder given as 'module:attribute' (an object
+        with a `name`, a `dim` and an `embed(texts)` method). Needs NumPy.
+
+        Examples:
+            %semantic_cache on
+            %semantic_cache on --threshold 0.95 --capacity 5000
+            %semantic_cache on --embedder my_embeddings:MiniLMEmbedder
+            %semantic_cache stats
+        """
+        self.retval = None
+        try:
+            cache = self.kernel.semantic_cache
+            if dir is not None or embedder is not None:
+                cache = SemanticCache(
+                    dir or cache.directory,
+                    cache.capacity,
+                    cache.threshold,
+                    load_embedder(embedder) if embedder else cache.embedder,
+                    cache.context_messages,
+                )
+                self.kernel.semantic_cache.close()
+                self.kernel.semantic_cache = cache
+        except ImportError as e:
+            self.kernel.Error(
+                f"The semantic cache needs NumPy and the embedder's dependencies: {e}"
+            )
+            return
+        except (AttributeError, ValueError) as e:
+            self.kernel.Error(str(e))
+            return
+        if threshold is not None:
+            cache.threshold = threshold
+        if capacity is not None:
+            cache.resize(capacity)
+        if context is not None:
+            cache.context_messages = context
+
+        if action == "on":
+            self.kernel.use_semantic_cache = True
+        elif action == "off":
+            self.kernel.use_semantic_cache = False
+        elif action == "clear":
+            cache.clear()
+        elif action == "stats":
+            self.retval = dict(enabled=self.kernel.use_semantic_cache, **cache.stats())
+        else:
+            self.kernel.Error(f"Unknown semantic cache action '{action}'")
+
+    def post_process(self, retval):
+        return self.retval
+
+
+def register_magics(kernel):
+    kernel.register_magics(SemanticCacheMagic)
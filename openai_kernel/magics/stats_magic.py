@@ -0,0 +1,98 @@
+from metakernel import Magic, option
+
+from openai_kernel.outputs import MarkdownOutput
+
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.3f}s"
+
+
+class StatsMagic(Magic):
+    @option(
+        "-r",
+        "--raw",
+        action="store_true",
+        default=False,
+        help="Return the summary as a dict",
+    )
+    @option(
+        "-e",
+        "--export",
+        action="store",
+        default=None,
+        help="Append the recorded metrics, and all new ones, to a JSON lines file",
+    )
+    @option(
+        "-c",
+        "--clear",
+        action="store_true",
+        default=False,
+        help="Forget the recorded metrics and reset the session totals",
+    )
+    def line_stats(self, raw=False, export=None, clear=False):
+        """
+        %stats - show latency, token and cost metrics of this session
+
+        Every chat and image cell records its queue time, time to first
+        byte (streamed chat cells only, other responses arrive all at once),
+        total latency, image decode time, token usage, bytes sent and
+        estimated cost. Shows the session totals and p50/p95 timings of the recent
+        executions, and how often chat requests were hedged (see '%set
+        hedge_after'), how much time the hedges saved and at least what they
+        cost (a cancelled stream is billed for the tokens it received, which
+        aren't counted).
+
+        Examples:
+            %stats
+            %stats --export metrics.jsonl
+            %stats --clear
+        """
+        metrics = self.kernel.metrics
+        if export is not None:
+            metrics.export(export)
+            self.kernel.variables["metrics_file"] = export
+        if clear:
+            metrics.reset()
+        self.retval = metrics.summary()
+        self.raw = raw
+
+    def post_process(self, retval):
+        summary = self.retval
+        if self.raw:
+            return summary
+        lines = [
+            f"**Executions:** {summary['executions']} "
+            f"({summary['errors']} errors, {summary['cache_hits']} cached)  ",
+            f"**Tokens:** {summary['prompt_tokens']} prompt, "
+            f"{summary['completion_tokens']} completion  ",
+            f"**Sent:** {summary['request_bytes'] / 1024:.1f} KB  ",
+            f"**Estimated cost:** {summary['cost']:.4f} USD",
+        ]
+        if summary["hedges"]:
+            lines[-1] += "  "
+            lines.append(
+                f"**Hedged:** {summary['hedges']} "
+                f"({summary['hedge_rate']:.1%} of executions), "
+                f"{summary['hedge_wins']} answered first, saving about "
+                f"{summary['hedge_saved']:.1f}s for at least "
+                f"{summary['hedge_cost']:.4f} USD"
+            )
+        lines += [
+            "",
+            "| | p50 | p95 |",
+            "| --- | --- | --- |",
+        ]
+        for name, label in (
+            ("queue_time", "Queue time"),
+            ("ttfb", "Time to first byte (streamed)"),
+            ("latency", "Total latency"),
+            ("decode_time", "Image decode"),
+        ):
+            p50 = _seconds(summary[f"{name}_p50"])
+            p95 = _seconds(summary[f"{name}_p95"])
+            lines.append(f"| {label} | {p50} | {p95} |")
+        return MarkdownOutput(str(summary), "\n".join(lines))
+
+
+def register_magics(kernel):
+    kernel.register_magics(StatsMagic)
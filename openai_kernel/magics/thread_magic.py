@@ -0,0 +1,57 @@
+from metakernel import Magic
+
+from openai_kernel.outputs import MarkdownOutput
+
+
+class ThreadMagic(Magic):
+    def line_thread(self, action="list", name=None):
+        """
+        %thread new|fork|switch|drop|list [NAME] - manage conversation threads
+
+        Every thread has its own chat history, cells continue the active
+        one. A fork starts with the active thread's history and shares it
+        instead of copying it.
+
+        Examples:
+            %thread fork shorter
+            %thread switch main
+            %thread drop shorter
+            %thread list
+        """
+        self.retval = None
+        if action == "list":
+            self.retval = {
+                thread: len(history) for thread, history in self.kernel.threads.items()
+            }
+            return
+        if name is None:
+            self.kernel.Error(f"'%thread {action}' needs a thread name")
+            return
+        try:
+            if action == "new":
+                self.kernel.new_thread(name)
+            elif action == "fork":
+                self.kernel.new_thread(name, fork=True)
+            elif action == "switch":
+                self.kernel.switch_thread(name)
+            elif action == "drop":
+                self.kernel.drop_thread(name)
+            else:
+                self.kernel.Error(f"Unknown thread action '{action}'")
+        except ValueError as e:
+            self.kernel.Error(str(e))
+
+    def post_process(self, retval):
+        if self.retval is None:
+            return None
+        lines = []
+        for thread, messages in self.retval.items():
+            line = f"{thread} ({messages} messages)"
+            if thread == self.kernel.active_thread:
+                line = f"**{line}**"
+            lines.append(f"- {line}")
+        return MarkdownOutput(str(self.retval), "\n".join(lines))
+
+
+def register_magics(kernel):
+    kernel.register_magics(ThreadMagic)
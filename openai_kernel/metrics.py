@@ -0,0 +1,232 @@
+import json
+import threading
+import time
+from collections import deque
+
+# USD per 1K (prompt, completion) tokens, matched by longest model prefix
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+# USD per image
+IMAGE_PRICES = {"256x256": 0.016, "512x512": 0.018, "1024x1024": 0.02}
+
+
+def estimate_chat_cost(model, prompt_tokens, completion_tokens):
+    matches = [name for name in MODEL_PRICES if model.startswith(name)]
+    if not matches:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def estimate_image_cost(size, n):
+    price = IMAGE_PRICES.get(size)
+    return price * n if price is not None else None
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of `values` by nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[index]
+
+
+class ExecutionMetrics:
+    """Timings (in seconds), token counts and cost of one cell execution."""
+
+    __slots__ = (
+        "timestamp",
+        "start",
+        "mode",
+        "model",
+        "backend",
+        "streamed",
+        "cached",
+        "error",
+        "queue_time",
+        "ttfb",
+        "latency",
+        "decode_time",
+        "prompt_tokens",
+        "completion_tokens",
+        "cost",
+        "request_bytes",
+        "hedged",
+        "hedge_won",
+        "hedge_saved",
+        "hedge_cost",
+    )
+
+    def __init__(self, mode, model):
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.mode = mode
+        self.model = model
+        self.backend = None
+        self.streamed = None
+        self.cached = False
+        self.error = None
+        self.queue_time = 0.0
+        self.ttfb = None
+        self.latency = None
+        self.decode_time = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cost = None
+        self.request_bytes = 0
+        self.hedged = False
+        self.hedge_won = False
+        self.hedge_saved = None
+        self.hedge_cost = None
+
+    def first_byte(self):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+
+    def add_chat_usage(self, model, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        if prompt_tokens is not None:
+            self.cost = estimate_chat_cost(model, prompt_tokens, completion_tokens)
+            if self.cost is not None and self.hedge_cost:
+                self.cost += self.hedge_cost
+
+    def add_request(self, other):
+        """Takes the backend, bytes sent and queue time of another request's metrics."""
+        self.backend = other.backend
+        self.request_bytes += other.request_bytes
+        self.queue_time += other.queue_time
+
+    def add_hedge(self, won, saved, cost):
+        """
+        Records that a duplicate request was sent, whether it answered first,
+        the time it saved and the extra cost, which the chat usage adds. The
+        cost of a streamed request that lost is a lower bound: it doesn't
+        count the tokens it received before it was cancelled.
+        """
+        self.hedged = True
+        self.hedge_won = won
+        self.hedge_saved = saved
+        self.hedge_cost = cost
+
+    def add_image_usage(self, size, n):
+        self.cost = estimate_image_cost(size, n)
+
+    def finish(self):
+        self.latency = time.perf_counter() - self.start
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        del data["start"]
+        return data
+
+
+class MetricsRecorder:
+    """
+    Keeps the metrics of the last `size` executions in a ring buffer, running
+    totals for the whole session, and optionally appends every record to a
+    JSON lines file.
+    """
+
+    def __init__(self, size=1000, export_path=None):
+        self.records = deque(maxlen=size)
+        self.export_path = export_path
+        self.totals = {}
+        self._export_file = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+            self.totals = {
+                "executions": 0,
+                "errors": 0,
+                "cache_hits": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cost": 0.0,
+                "request_bytes": 0,
+                "hedges": 0,
+                "hedge_wins": 0,
+                "hedge_saved": 0.0,
+                "hedge_cost": 0.0,
+            }
+
+    def resize(self, size):
+        with self._lock:
+            self.records = deque(self.records, maxlen=size)
+
+    def record(self, metrics):
+        with self._lock:
+            self.records.append(metrics)
+            totals = self.totals
+            totals["executions"] += 1
+            totals["errors"] += metrics.error is not None
+            totals["cache_hits"] += metrics.cached
+            totals["prompt_tokens"] += metrics.prompt_tokens or 0
+            totals["completion_tokens"] += metrics.completion_tokens or 0
+            totals["cost"] += metrics.cost or 0.0
+            totals["request_bytes"] += metrics.request_bytes
+            totals["hedges"] += metrics.hedged
+            totals["hedge_wins"] += metrics.hedge_won
+            totals["hedge_saved"] += metrics.hedge_saved or 0.0
+            totals["hedge_cost"] += metrics.hedge_cost or 0.0
+            if self.export_path:
+                self._write([metrics])
+
+    def export(self, path):
+        """Write the buffered records to `path` and append new ones as they come."""
+        with self._lock:
+            self.close()
+            self.export_path = path
+            self._write(self.records)
+
+    def _write(self, records):
+        if self._export_file is None:
+            self._export_file = open(self.export_path, "a")
+        for metrics in records:
+            self._export_file.write(json.dumps(metrics.to_dict()) + "\n")
+        self._export_file.flush()
+
+    def close(self):
+        if self._export_file is not None:
+            self._export_file.close()
+            self._export_file = None
+
+    def values(self, name, model=None, streamed=None):
+        """
+        Returns the `name` timings of the buffered records that weren't cached
+        or failed, only those of `model` and of streamed (or not) requests
+        when given.
+        """
+        with self._lock:
+            records = list(self.records)
+        return [
+            getattr(m, name)
+            for m in records
+            if getattr(m, name) is not None
+            and not m.cached
+            and m.error is None
+            and (model is None or m.model == model)
+            and (streamed is None or m.streamed == streamed)
+        ]
+
+    def summary(self):
+        """Returns the session totals and p50/p95 timings of the buffered records."""
+        with self._lock:
+            records = list(self.records)
+            summary = dict(self.totals)
+        executions = summary["executions"]
+        summary["hedge_rate"] = summary["hedges"] / executions if executions else None
+        for name in ("latency", "ttfb", "queue_time", "decode_time"):
+            values = [getattr(m, name) for m in records if getattr(m, name) is not None]
+            summary[f"{name}_p50"] = percentile(values, 50)
+            summary[f"{name}_p95"] = percentile(values, 95)
+        return summary
@@ -1,10 +1,26 @@
+import base64
+import gzip
+import json
+import re
+import struct
+import time
 from unittest.mock import MagicMock
 
+import openai
 import requests
-from openai.error import AuthenticationError
+from openai import api_requestor
+from openai.error import AuthenticationError, RateLimitError, Timeout
 from openai.openai_object import OpenAIObject
 
+from .connection_pool import PayloadSession
 from .kernel import OpenAIKernel
+from .stand_in import StandInServer, make_embedding
+
+# a 1x1 PNG
+MOCK_IMAGE_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9"
+    "awAAAABJRU5ErkJggg=="
+)
 
 
 class MockOpenAIKernel(OpenAIKernel):
@@ -14,6 +30,12 @@ class MockOpenAIKernel(OpenAIKernel):
     """
 
     app_name = "mock_openai_kernel"
+    warm_connections = False
+    stand_in = None
+    # sizes of the request bodies the mock was sent
+    payload_sizes = ()
+    # number of texts in each embeddings request
+    embedding_batches = ()
 
     def __init__(self, *args, **kwargs):
         super(MockOpenAIKernel, self).__init__(*args, **kwargs)
@@ -33,16 +55,84 @@ class MockOpenAIKernel(OpenAIKernel):
         mock_openai = MagicMock()
         mock_openai.api_key = None
         mock_openai.api_key_path = None
+        rate_limited = set()
+        self.payload_sizes = []
+        self.embedding_batches = []
+
+        def chat_completion_stream(openai_msg):
+            chunk = {
+                "created": 1682546524,
+                "id": "chatcmpl-79hV6JNgzMPhWx4cQgcr7j853bTIn",
+                "model": "gpt-3.5-turbo-0301",
+                "object": "chat.completion.chunk",
+            }
+            deltas = [{"role": "assistant"}]
+            deltas += [{"content": t} for t in re.findall(r"\s*\S+", openai_msg)]
+            for delta in deltas:
+                yield OpenAIObject.construct_from(
+                    {
+                        **chunk,
+                        "choices": [
+                            {"delta": delta, "finish_reason": None, "index": 0}
+                        ],
+                    }
+                )
+            yield OpenAIObject.construct_from(
+                {
+                    **chunk,
+                    "choices": [{"delta": {}, "finish_reason": "stop", "index": 0}],
+                }
+            )
 
-        def chat_completion_create(model, messages, **kwargs):
+        def chat_completion_create(model, messages, stream=False, **kwargs):
+            params = {"model": model, "messages": messages, "stream": stream}
+            params.update(kwargs)
+            params.pop("request_timeout", None)
+            body = json.dumps(params).encode("utf-8")
+            # the body goes through the thread's session, as with the library
+            session = getattr(api_requestor._thread_context, "session", None)
+            if isinstance(session, PayloadSession):
+                body, headers = session.encode_body(body, {})
+                self.payload_sizes.append(len(body))
+                if (headers or {}).get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                messages = json.loads(body)["messages"]
+            else:
+                self.payload_sizes.append(len(body))
+            if not messages:
+                raise openai.error.InvalidRequestError(
+                    "[] is too short - 'messages'", "messages"
+                )
+            if "unknown" in model:
+                raise openai.error.InvalidRequestError(
+                    f"The model '{model}' does not exist", "model"
+                )
             content = messages[-1]["content"]
 
             if "no_api_key" in content:
                 raise AuthenticationError("No API key provided, please set it")
             elif "connection_error" in content:
                 raise requests.exceptions.ConnectionError()
+            elif "rate_limited" in content and content not in rate_limited:
+                rate_limited.add(content)
+                raise RateLimitError(
+                    "Rate limit reached for requests",
+                    http_status=429,
+                    headers={"retry-after": "0.1"},
+                )
+            elif "slow_response" in content:
+                delay = 3
+                request_timeout = kwargs.get("request_timeout") or (None, None)
+                if request_timeout[1] is not None and request_timeout[1] < delay:
+                    time.sleep(request_timeout[1])
+                    raise Timeout("Request timed out")
+                time.sleep(delay)
+            if "slow" in model:
+                time.sleep(1)
 
             openai_msg = f"you said '{content}'"
+            if stream:
+                return chat_completion_stream(openai_msg)
             openai_resp = OpenAIObject.construct_from(
                 {
                     "choices": [
@@ -67,8 +157,68 @@ class MockOpenAIKernel(OpenAIKernel):
 
         mock_openai.ChatCompletion.create.side_effect = chat_completion_create
 
+        def image_create(prompt, n=1, size="512x512", **kwargs):
+            return OpenAIObject.construct_from(
+                {
+                    "created": 1682546524,
+                    "data": [{"b64_json": MOCK_IMAGE_B64} for _ in range(n)],
+                }
+            )
+
+        mock_openai.Image.create.side_effect = image_create
+
+        def embedding_create(input, model, encoding_format=None, **kwargs):
+            self.embedding_batches.append(len(input))
+            if any("connection_error" in text for text in input):
+                raise requests.exceptions.ConnectionError()
+            data = []
+            for i, text in enumerate(input):
+                vector = make_embedding(text, 8)
+                if encoding_format == "base64":
+                    embedding = base64.b64encode(vector).decode("ascii")
+                else:
+                    embedding = list(struct.unpack("<8f", vector))
+                data.append({"object": "embedding", "index": i, "embedding": embedding})
+            tokens = sum(len(text) // 4 + 1 for text in input)
+            return OpenAIObject.construct_from(
+                {
+                    "object": "list",
+                    "data": data,
+                    "model": model,
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+                }
+            )
+
+        mock_openai.Embedding.create.side_effect = embedding_create
+
+        self.mock_openai = mock_openai
         self.openai = mock_openai
 
+    @property
+    def stand_in_stats(self):
+        return self.stand_in.stats() if self.stand_in is not None else None
+
+    def use_stand_in(self, enabled=True):
+        """
+        Send requests through the real openai library to a local stand-in
+        server instead of the mock.
+        """
+        if enabled and self.stand_in is None:
+            self.stand_in = StandInServer()
+            openai.api_base = self.stand_in.start()
+            openai.api_key = "sk-stand-in"
+            self.openai = openai
+        elif not enabled and self.stand_in is not None:
+            self.stand_in.stop()
+            self.stand_in = None
+            self.openai = self.mock_openai
+
+    def set_variable(self, name, value):
+        if name == "stand_in":
+            self.use_stand_in(bool(value))
+        else:
+            super(MockOpenAIKernel, self).set_variable(name, value)
+
 
 if __name__ == "__main__":
     MockOpenAIKernel.run_as_main()
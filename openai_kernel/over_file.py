@@ -0,0 +1,325 @@
+import functools
+import json
+import os
+from collections import deque
+
+from .batch import run_bounded
+from .cache import ResponseCache, get_default_cache_dir
+
+HEADER_EXTENSIONS = (".csv", ".tsv")
+# the most characters of a line read at once
+READ_CHARS = 2**16
+
+MAP_PROMPT = """{instruction}
+
+Answer for this part of the file '{name}' (lines {first}-{last}); it is one \
+of several parts answered separately:
+
+{text}"""
+
+REDUCE_PROMPT = """{instruction}
+
+The file was too long to read at once, so it was split into parts and the \
+instruction above was answered for each one. Combine these answers into a \
+single answer:
+
+{answers}"""
+
+
+def get_default_checkpoint_dir():
+    return os.path.join(get_default_cache_dir(), "over_file")
+
+
+def _split_line(line, max_tokens, count):
+    """
+    Splits a line too long for one chunk into pieces that fit, breaking
+    after a space where there is one rather than inside a word.
+    """
+    tokens = count(line)
+    if tokens <= max_tokens:
+        return [(line, tokens)]
+    size = max(1, len(line) * max_tokens // tokens)
+    pieces = []
+    while line:
+        piece = line[:size]
+        if len(piece) < len(line):
+            # up to and with the last space
+            end = max(piece.rfind(" "), piece.rfind("\t")) + 1
+            if end > 1:
+                piece = piece[:end]
+        piece_tokens = count(piece)
+        if piece_tokens > max_tokens and len(piece) > 1:
+            # the characters were denser in tokens than the line on average
+            size = max(1, len(piece) * max_tokens // piece_tokens)
+            continue
+        pieces.append((piece, piece_tokens))
+        taken = len(piece)
+        line = line[taken:]
+    return pieces
+
+
+def read_lines(fid, size=READ_CHARS):
+    """
+    Reads a text file line by line, in pieces of at most `size` characters
+    so a file without newlines isn't read at once.
+    """
+    return iter(functools.partial(fid.readline, size), "")
+
+
+def iter_chunks(lines, chunk_tokens, overlap_tokens, count, header=None):
+    """
+    Groups an iterable of lines into chunks of about `chunk_tokens` tokens,
+    each starting with the last `overlap_tokens` tokens of lines of the one
+    before (and with `header`, the first line of a CSV file, when given).
+    Lines longer than a chunk are split into pieces, and a line may come in
+    several parts (a line only ends with its newline). Yields (first line
+    number, last line number, text); only the current chunk is held in
+    memory.
+    """
+    header_tokens = count(header) if header else 0
+    budget = max(1, chunk_tokens - header_tokens)
+    overlap_tokens = min(overlap_tokens, budget // 2)
+    chunk = deque()  # (line number, text, tokens)
+    tokens = 0
+    fresh = False
+
+    def emit():
+        text = "".join(piece for _, piece, _ in chunk)
+        return chunk[0][0], chunk[-1][0], (header or "") + text
+
+    number = 1
+    for line in lines:
+        for piece, piece_tokens in _split_line(line, budget, count):
+            if fresh and tokens + piece_tokens > budget:
+                yield emit()
+                fresh = False
+                # keep the tail of this chunk as the start of the next one
+                kept = 0
+                overlap = deque()
+                while chunk and kept + chunk[-1][2] <= overlap_tokens:
+                    kept += chunk[-1][2]
+                    overlap.appendleft(chunk.pop())
+                chunk, tokens = overlap, kept
+            chunk.append((number, piece, piece_tokens))
+            tokens += piece_tokens
+            fresh = True
+        if line.endswith("\n"):
+            number += 1
+    if fresh:
+        yield emit()
+
+
+def pack_answers(answers, max_tokens, count):
+    """
+    Groups consecutive answers into groups of about `max_tokens` tokens, with
+    at least two answers per group so every round of reduction shrinks.
+    """
+    groups = []
+    group = []
+    tokens = 0
+    for answer in answers:
+        answer_tokens = count(answer)
+        if len(group) >= 2 and tokens + answer_tokens > max_tokens:
+            groups.append(group)
+            group, tokens = [], 0
+        group.append(answer)
+        tokens += answer_tokens
+    if len(group) == 1 and groups:
+        groups[-1].append(group[0])
+    elif group:
+        groups.append(group)
+    return groups
+
+
+class Checkpoint:
+    """
+    The answers of a job's chunks and reductions, appended to a JSON lines
+    file as they arrive so an interrupted job picks up where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.answers = {}
+        try:
+            with open(path, "rb") as fid:
+                for line in fid:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupt
+                        continue
+                    self.answers[record["key"]] = record["answer"]
+        except FileNotFoundError:
+            pass
+        self._file = None
+
+    def add(self, key, answer):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "ab")
+        record = {"key": key, "answer": answer}
+        self._file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self._file.flush()
+        self.answers[key] = answer
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FileJob:
+    """
+    Answers an instruction over a file too long for one prompt: the file is
+    read line by line into overlapping, token bounded chunks, the instruction
+    is answered for each chunk concurrently, and the answers are combined
+    level by level until one is left. Every answer is checkpointed, so
+    running the same job again (same file, instruction and settings) only
+    sends what is missing.
+
+    `complete(prompt)` answers one prompt and `count(text)` counts tokens.
+    `progress(job)` is called as chunks and reductions finish.
+    """
+
+    def __init__(
+        self,
+        path,
+        instruction,
+        complete,
+        count,
+        chunk_tokens=3000,
+        overlap_tokens=200,
+        concurrency=8,
+        checkpoint_dir=None,
+        settings=None,
+        progress=None,
+    ):
+        self.path = path
+        self.instruction = instruction
+        self.complete = complete
+        self.count = count
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.concurrency = concurrency
+        self.progress = progress or (lambda job: None)
+        stat = os.stat(path)
+        key = ResponseCache.make_key(
+            path=os.path.abspath(path),
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            instruction=instruction,
+            chunk_tokens=chunk_tokens,
+            overlap_tokens=overlap_tokens,
+            settings=settings,
+        )
+        directory = checkpoint_dir or get_default_checkpoint_dir()
+        self.checkpoint = Checkpoint(os.path.join(directory, key + ".jsonl"))
+        self.stage = "reading"
+        self.level = 0
+        self.done = 0
+        self.resumed = 0
+        self.total = None
+        self.errors = []
+
+    def _run(self, prompts, keys):
+        """Answers the (key, prompt) items not in the checkpoint yet."""
+
+        def pending():
+            for key, prompt in prompts:
+                if key in self.checkpoint.answers:
+                    self.resumed += 1
+                    self.done += 1
+                    self.progress(self)
+                else:
+                    yield key, prompt
+
+        def on_result(item, result):
+            self.done += 1
+            if result[0] == "ok":
+                self.checkpoint.add(item[0], result[1])
+            else:
+                self.errors.append(f"{item[0]}: {result[1]}")
+            self.progress(self)
+
+        run_bounded(
+            lambda item: self.complete(item[1]),
+            pending(),
+            self.concurrency,
+            on_result,
+        )
+        return [self.checkpoint.answers.get(key) for key in keys]
+
+    def _map(self):
+        header = None
+        name = os.path.basename(self.path)
+        with open(self.path, encoding="utf-8", errors="replace") as fid:
+            if self.path.lower().endswith(HEADER_EXTENSIONS):
+                header = fid.readline(READ_CHARS)
+                if not header.endswith("\n"):
+                    # a single line, rather than a header
+                    header = None
+                    fid.seek(0)
+            keys = []
+
+            def prompts():
+                chunks = iter_chunks(
+                    read_lines(fid),
+                    self.chunk_tokens,
+                    self.overlap_tokens,
+                    self.count,
+                    header,
+                )
+                offset = 1 if header else 0
+                for i, (first, last, text) in enumerate(chunks):
+                    keys.append(f"map-{i}")
+                    prompt = MAP_PROMPT.format(
+                        instruction=self.instruction,
+                        name=name,
+                        first=first + offset,
+                        last=last + offset,
+                        text=text,
+                    )
+                    yield keys[-1], prompt
+
+            answers = self._run(prompts(), keys)
+        self.total = len(keys)
+        return answers
+
+    def run(self):
+        """Returns the final answer, raising RuntimeError if parts failed."""
+        try:
+            answers = self._map()
+            while not self.errors and len(answers) > 1:
+                self.stage = "combining"
+                self.level += 1
+                groups = pack_answers(answers, self.chunk_tokens, self.count)
+                self.done, self.resumed, self.total = 0, 0, len(groups)
+                keys = [f"reduce-{self.level}-{i}" for i in range(len(groups))]
+                prompts = [
+                    (key, self._reduce_prompt(group))
+                    for key, group in zip(keys, groups)
+                ]
+                answers = self._run(prompts, keys)
+            if self.errors:
+                raise RuntimeError(
+                    f"{len(self.errors)} requests failed, run the cell again to "
+                    "retry them:\n" + "\n".join(self.errors)
+                )
+        finally:
+            self.checkpoint.close()
+        self.checkpoint.remove()
+        self.stage = "done"
+        return answers[0] if answers else ""
+
+    def _reduce_prompt(self, answers):
+        parts = [f"Answer {i + 1}:\n{answer}" for i, answer in enumerate(answers)]
+        return REDUCE_PROMPT.format(
+            instruction=self.instruction, answers="\n\n".join(parts)
+        )
@@ -0,0 +1,37 @@
+import gzip
+import json
+
+# bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+
+def encode_message(message):
+    """Returns the compact JSON of a chat message, as sent in a request body."""
+    return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+
+def splice_messages(body, encoded_messages):
+    """
+    Returns the request `body` (JSON bytes) with its "messages" replaced by
+    the already encoded messages, so they don't have to be serialized again.
+    Only a body with an empty message list, the placeholder for them, is
+    changed, otherwise it returns None.
+    """
+    try:
+        params = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(params, dict) or params.get("messages") != []:
+        return None
+    del params["messages"]
+    messages = b'{"messages":[' + b",".join(encoded_messages) + b"]"
+    if not params:
+        return messages + b"}"
+    return messages + b"," + json.dumps(params, separators=(",", ":")).encode()[1:]
+
+
+def compress(body):
+    """Returns the gzipped body, or None when it's too small to be worth it."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return None
+    return gzip.compress(body, compresslevel=6)
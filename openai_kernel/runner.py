@@ -0,0 +1,342 @@
+"""
+Runs notebooks and prompt files through the kernel in-process, without Jupyter.
+
+Every file gets a fresh kernel in one of a pool of worker processes, and its
+cells are passed straight to the kernel's `do_execute`, so magics like %set,
+%mode and %clear_history behave as they do in a notebook. The workers send
+their requests through one gateway (see gateway.py), which paces them for
+all workers at once and can cache the responses.
+
+Notebooks are written back with their outputs. Prompt files have one cell
+per line (or per JSON lines record, a string or {"code": ...}) and are
+written as JSON lines, one record of outputs per cell.
+
+    python -m openai_kernel run nightly/*.ipynb prompts.txt --jobs 8 --rpm 3500
+"""
+import argparse
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent import futures
+
+from .gateway import Gateway
+
+NOTEBOOK_EXTENSION = ".ipynb"
+DEFAULT_KERNEL = "openai_kernel.kernel:OpenAIKernel"
+
+# set in each worker process by _init_worker
+_worker = {}
+
+
+class HeadlessKernel:
+    """
+    Mixed into a kernel class to run cells without a Jupyter session: the
+    messages the kernel would send on iopub are collected as the cell's
+    nbformat outputs instead.
+    """
+
+    warm_connections = False
+
+    def send_response(self, stream, msg_or_type, content=None, *args, **kwargs):
+        outputs = self.cell_outputs
+        content = content or {}
+        display_id = content.get("transient", {}).get("display_id")
+        if msg_or_type == "stream":
+            if outputs and outputs[-1].get("name") == content["name"]:
+                outputs[-1]["text"] += content["text"]
+            else:
+                outputs.append({"output_type": "stream", **content})
+        elif msg_or_type in ("display_data", "execute_result"):
+            output = {
+                "output_type": msg_or_type,
+                "data": content["data"],
+                "metadata": content.get("metadata", {}),
+            }
+            if msg_or_type == "execute_result":
+                output["execution_count"] = self.execution_count
+            outputs.append(output)
+            if display_id is not None:
+                self.cell_displays[display_id] = output
+        elif msg_or_type == "update_display_data":
+            output = self.cell_displays.get(display_id)
+            if output is not None:
+                output["data"] = content["data"]
+                output["metadata"] = content.get("metadata", {})
+        elif msg_or_type == "error":
+            outputs.append(
+                {
+                    "output_type": "error",
+                    "ename": content["ename"],
+                    "evalue": content["evalue"],
+                    "traceback": content["traceback"],
+                }
+            )
+        elif msg_or_type == "clear_output":
+            del outputs[:]
+
+    def run_cell(self, code):
+        """Runs a cell, returning its status ('ok' or 'error') and outputs."""
+        self.cell_outputs = []
+        self.cell_displays = {}
+        self.execution_count += 1
+        reply = self.do_execute(code)
+        return reply["status"], self.cell_outputs
+
+
+def load_kernel_class(spec):
+    """Returns the kernel class named by `spec`, as 'module:Class'."""
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"Kernels are named 'module:Class', not '{spec}'")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+@functools.lru_cache(maxsize=None)
+def headless_kernel_class(spec):
+    kernel_class = load_kernel_class(spec)
+    return type(f"Headless{kernel_class.__name__}", (HeadlessKernel, kernel_class), {})
+
+
+def _source(source):
+    return "".join(source) if isinstance(source, list) else source
+
+
+def read_cells(path):
+    """Returns the file's contents (a notebook, or None) and its cells' code."""
+    with open(path, encoding="utf-8") as fid:
+        if path.endswith(NOTEBOOK_EXTENSION):
+            notebook = json.load(fid)
+            cells = [
+                _source(cell["source"])
+                for cell in notebook["cells"]
+                if cell["cell_type"] == "code"
+            ]
+            return notebook, cells
+        if path.endswith(".jsonl"):
+            records = [json.loads(line) for line in fid if line.strip()]
+            return None, [
+                record if isinstance(record, str) else record["code"]
+                for record in records
+            ]
+        return None, [line.rstrip("\n") for line in fid if line.strip()]
+
+
+def output_path(path, output_dir=None):
+    """
+    Where the results of a file go: the same name in `output_dir`, or a
+    '.out' file next to it.
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    if extension != NOTEBOOK_EXTENSION:
+        extension = ".jsonl"
+    if output_dir is None:
+        return os.path.join(os.path.dirname(path), f"{stem}.out{extension}")
+    return os.path.join(output_dir, stem + extension)
+
+
+def write_results(path, notebook, results):
+    """Writes the (code, status, outputs) of every cell that ran."""
+    suffix = f".{os.getpid()}.tmp"
+    with open(path + suffix, "w", encoding="utf-8") as fid:
+        if notebook is not None:
+            code_cells = [c for c in notebook["cells"] if c["cell_type"] == "code"]
+            for cell, (count, _, _, outputs) in zip(code_cells, results):
+                cell["execution_count"] = count
+                cell["outputs"] = outputs
+            json.dump(notebook, fid, indent=1, ensure_ascii=False)
+            fid.write("\n")
+        else:
+            for count, code, status, outputs in results:
+                record = {
+                    "execution_count": count,
+                    "code": code,
+                    "status": status,
+                    "outputs": outputs,
+                }
+                fid.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(path + suffix, path)
+
+
+def run_file(path, output_dir=None, setup=(), allow_errors=False):
+    """
+    Runs the cells of a file in a new kernel and writes the results, returning
+    a report of the run. Without `allow_errors` it stops at the first error.
+    """
+    start = time.perf_counter()
+    notebook, cells = read_cells(path)
+    kernel = headless_kernel_class(_worker.get("kernel", DEFAULT_KERNEL))()
+    try:
+        if _worker.get("gateway"):
+            kernel.set_variable("gateway", _worker["gateway"])
+        for code in setup:
+            kernel.run_cell(code)
+        kernel.execution_count = 0
+        results = []
+        for code in cells:
+            status, outputs = kernel.run_cell(code)
+            results.append((kernel.execution_count, code, status, outputs))
+            if status != "ok" and not allow_errors:
+                break
+        totals = dict(kernel.metrics.totals)
+    finally:
+        kernel.connection_pool.close()
+        kernel.metrics.close()
+    output = output_path(path, output_dir)
+    write_results(output, notebook, results)
+    return {
+        "path": path,
+        "output": output,
+        "cells": len(results),
+        "skipped": len(cells) - len(results),
+        "errors": sum(status != "ok" for _, _, status, _ in results),
+        "tokens": totals["prompt_tokens"] + totals["completion_tokens"],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _init_worker(kernel, gateway):
+    _worker.update(kernel=kernel, gateway=gateway)
+
+
+def format_report(report):
+    seconds = report["seconds"]
+    line = (
+        f"{report['path']}: {report['cells']} cells in {seconds:.1f} s "
+        f"({report['cells'] / seconds if seconds else 0:.1f} cells/s, "
+        f"{report['tokens']} tokens), {report['errors']} errors"
+    )
+    if report["skipped"]:
+        line += f", {report['skipped']} cells not run"
+    return line + f" -> {report['output']}"
+
+
+def run_files(
+    paths,
+    jobs=None,
+    output_dir=None,
+    setup=(),
+    allow_errors=False,
+    kernel=DEFAULT_KERNEL,
+    gateway=None,
+    report=print,
+):
+    """
+    Runs the files in a pool of `jobs` processes, calling `report` with the
+    line of each file as it finishes and the totals at the end. Returns the
+    files' reports; files that couldn't be run have an 'error'.
+    """
+    jobs = jobs or min(len(paths), os.cpu_count() or 1)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    reports = []
+    context = multiprocessing.get_context("spawn")
+    with futures.ProcessPoolExecutor(
+        max(jobs, 1), context, _init_worker, (kernel, gateway)
+    ) as pool:
+        pending = {
+            pool.submit(run_file, path, output_dir, setup, allow_errors): path
+            for path in paths
+        }
+        for future in futures.as_completed(pending):
+            try:
+                file_report = future.result()
+            except Exception as e:
+                file_report = {"path": pending[future], "error": str(e)}
+                report(f"{pending[future]}: failed: {type(e).__name__}: {e}")
+            else:
+                report(format_report(file_report))
+            reports.append(file_report)
+    wall = time.perf_counter() - start
+    done = [r for r in reports if "error" not in r]
+    cells = sum(r["cells"] for r in done)
+    tokens = sum(r["tokens"] for r in done)
+    report(
+        f"{len(done)} of {len(paths)} files, {cells} cells in {wall:.1f} s: "
+        f"{cells / wall:.1f} cells/s, {tokens / wall:.0f} tokens/s"
+    )
+    return reports
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m openai_kernel run", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("paths", nargs="+", help="Notebooks and prompt files")
+    parser.add_argument("-j", "--jobs", type=int, help="Worker processes")
+    parser.add_argument(
+        "-o", "--output-dir", help="Directory for the results (default: '.out' files)"
+    )
+    parser.add_argument(
+        "-s",
+        "--setup",
+        action="append",
+        default=[],
+        help="A cell to run before each file, e.g. '%%set model gpt-4'",
+    )
+    parser.add_argument(
+        "--allow-errors",
+        action="store_true",
+        help="Keep running a file's cells after one fails",
+    )
+    parser.add_argument(
+        "--kernel", default=DEFAULT_KERNEL, help="Kernel class, as module:Class"
+    )
+    parser.add_argument(
+        "--gateway", help="Socket of a running gateway to use instead of starting one"
+    )
+    parser.add_argument(
+        "--api-base",
+        default=os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1"),
+        help="API the gateway forwards requests to",
+    )
+    parser.add_argument("--rpm", type=int, help="Requests per minute per organization")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute per organization")
+    parser.add_argument(
+        "--cache", action="store_true", help="Answer repeated requests from a cache"
+    )
+    parser.add_argument("--cache-dir", help="Directory of the response cache")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    gateway = None
+    socket_path = args.gateway
+    if socket_path is None:
+        directory = tempfile.mkdtemp(prefix="openai_kernel-")
+        gateway = Gateway(
+            os.path.join(directory, "gateway.sock"),
+            args.api_base,
+            os.environ.get("OPENAI_API_KEY"),
+            args.rpm,
+            args.tpm,
+            args.cache,
+            args.cache_dir,
+        )
+        socket_path = gateway.start()
+    try:
+        reports = run_files(
+            args.paths,
+            args.jobs,
+            args.output_dir,
+            args.setup,
+            args.allow_errors,
+            args.kernel,
+            socket_path,
+        )
+    finally:
+        if gateway is not None:
+            gateway.stop()
+            os.rmdir(os.path.dirname(socket_path))
+    failed = any("error" in r or r["errors"] for r in reports)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import random
+import threading
+import time
+
+# the response header of a gateway that has retried the request already
+RETRIED_HEADER = "OpenAI-Kernel-Retried"
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `per_minute` tokens a minute. Reservations are
+    taken immediately, even into debt, so callers are served in order and each
+    one only has to wait until the debt ahead of it is paid off.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Takes `amount` tokens and returns how long to wait before using them."""
+        self._refill(now)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def is_retryable(e):
+    from openai import error
+
+    headers = getattr(e, "headers", None) or {}
+    if any(name.lower() == RETRIED_HEADER.lower() for name in headers):
+        # retrying what a gateway retried would multiply the attempts
+        return False
+    if isinstance(
+        e,
+        (
+            error.RateLimitError,
+            error.ServiceUnavailableError,
+            error.TryAgain,
+            error.APIConnectionError,
+        ),
+    ):
+        return True
+    if isinstance(e, error.APIError):
+        return (e.http_status or 0) >= 500
+    return False
+
+
+def get_retry_after(e):
+    """Returns the delay in seconds the server asked for, if any."""
+    headers = getattr(e, "headers", None) or {}
+    for name in ("retry-after-ms", "Retry-After-Ms"):
+        if name in headers:
+            try:
+                return float(headers[name]) / 1000
+            except ValueError:
+                pass
+    for name in ("retry-after", "Retry-After"):
+        if name in headers:
+            try:
+                return float(headers[name])
+            except ValueError:
+                pass
+    return None
+
+
+class RequestScheduler:
+    """
+    Sits between the kernel and the openai library. Requests are paced with
+    per-model token buckets for requests and tokens per minute, and failed
+    requests (429, 5xx, connection errors) are retried with
+    jittered exponential back-off, honoring Retry-After. A rate limit error
+    pauses every request for that model, so concurrent cells and batch jobs
+    back off together instead of piling up more 429s.
+    """
+
+    def __init__(self, limits=None, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limits = {}
+        self._buckets = {}
+        self._resume_at = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "queued_seconds": 0.0,
+        }
+        for model, limit in (limits or {}).items():
+            self.set_limits(model, **limit)
+
+    def set_limits(self, model, rpm=None, tpm=None):
+        """Set the requests and tokens per minute allowed for `model`."""
+        with self._lock:
+            self.limits[model] = {"rpm": rpm, "tpm": tpm}
+            self._buckets[model] = (
+                TokenBucket(rpm) if rpm else None,
+                TokenBucket(tpm) if tpm else None,
+            )
+
+    def wants_token_estimate(self, model):
+        limit = self.limits.get(model)
+        return bool(limit and limit.get("tpm"))
+
+    def _acquire(self, model, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._resume_at.get(model, 0) - now)
+            requests_bucket, tokens_bucket = self._buckets.get(model, (None, None))
+            if requests_bucket is not None:
+                wait = max(wait, requests_bucket.reserve(1, now))
+            if tokens_bucket is not None and tokens:
+                wait = max(wait, tokens_bucket.reserve(tokens, now))
+            self.stats["requests"] += 1
+            self.stats["queued_seconds"] += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _reconcile(self, model, estimated_tokens, result):
+        usage = getattr(result, "get", lambda key: None)("usage")
+        if not usage or not estimated_tokens:
+            return
+        with self._lock:
+            tokens_bucket = self._buckets.get(model, (None, None))[1]
+            if tokens_bucket is not None:
+                tokens_bucket.refund(estimated_tokens - usage["total_tokens"])
+
+    def _backoff(self, model, attempt, e):
+        from openai import error
+
+        delay = get_retry_after(e)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2**attempt)
+            delay *= random.uniform(0.5, 1.0)
+        if isinstance(e, error.RateLimitError):
+            with self._lock:
+                self.stats["rate_limited"] += 1
+                resume_at = time.monotonic() + delay
+                self._resume_at[model] = max(self._resume_at.get(model, 0), resume_at)
+        return delay
+
+    def run(self, fn, model, estimated_tokens=0, metrics=None):
+        """
+        Call `fn()` once the limits of `model` allow it, retrying retryable
+        errors up to `max_retries` times. The time spent waiting is added to
+        `metrics.queue_time` when given.
+        """
+        attempt = 0
+        while True:
+            wait = self._acquire(model, estimated_tokens)
+            if metrics is not None:
+                metrics.queue_time += wait
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(model, attempt, e)
+                with self._lock:
+                    self.stats["retries"] += 1
+                attempt += 1
+                time.sleep(delay)
+            else:
+                self._reconcile(model, estimated_tokens, result)
+                return result
@@ -0,0 +1,198 @@
+import os
+import re
+import threading
+import time
+
+from .cache import get_default_cache_dir
+
+TERM_RE = re.compile(r"\w+\*?")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    turn INTEGER NOT NULL,
+    session TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp_ms INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_turn ON messages (turn);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='porter unicode61'
+);
+"""
+
+
+def get_default_search_index_path():
+    return os.path.join(get_default_cache_dir(), "search.sqlite")
+
+
+def match_expression(query):
+    """
+    Turns a query into an FTS5 expression matching messages with all of its
+    words (a trailing * matches any word starting with it), so punctuation
+    and FTS5 operators in a query are searched for as plain text.
+    """
+    terms = []
+    for term in TERM_RE.findall(query):
+        prefix = term.endswith("*")
+        terms.append(f'"{term.rstrip("*")}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """
+    A full-text index of chat turns, shared by the sessions of every kernel
+    using the same `path`: an SQLite table of messages with an FTS5 index of
+    their content.
+
+    Turns are added as they happen, each in one small transaction, and a
+    search is a ranked (bm25) lookup in the FTS5 index that reads only the
+    matching rows, so it stays fast as the index grows. The database is
+    opened the first time it is used.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or get_default_search_index_path())
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            # other kernels may read and write the index at the same time
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def add_turn(self, session, thread, messages, timestamp_ms=None):
+        """
+        Indexes the messages of a turn, returning the turn's id (the id of
+        its first message).
+        """
+        if timestamp_ms is None:
+            timestamp_ms = int(time.time() * 1000)
+        turn = None
+        with self._lock, self.db as db:
+            for message in messages:
+                cursor = db.execute(
+                    "INSERT INTO messages (turn, session, thread, role, content, "
+                    "timestamp_ms) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        turn or 0,
+                        session,
+                        thread,
+                        message["role"],
+                        message.get("content") or "",
+                        timestamp_ms,
+                    ),
+                )
+                if turn is None:
+                    turn = cursor.lastrowid
+                    db.execute(
+                        "UPDATE messages SET turn = ? WHERE id = ?", (turn, turn)
+                    )
+                db.execute(
+                    "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                    (cursor.lastrowid, message.get("content") or ""),
+                )
+        return turn
+
+    def search(self, query, limit=10, session=None, candidates=5000):
+        """
+        Returns the best `limit` messages matching `query`, best first, as
+        dicts with the message, where it was said and a snippet of it. Only
+        the latest `candidates` matches are ranked, which keeps searches for
+        common words from slowing down as the index grows.
+        """
+        expression = match_expression(query)
+        if not expression:
+            return []
+        matches = (
+            "FROM messages_fts JOIN messages AS m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ?"
+        )
+        params = [expression]
+        if session is not None:
+            matches += " AND m.session = ?"
+            params.append(session)
+        latest = (
+            f"SELECT min(rowid) FROM (SELECT messages_fts.rowid {matches} "
+            "ORDER BY messages_fts.rowid DESC LIMIT ?)"
+        )
+        sql = (
+            "SELECT m.id, m.turn, m.session, m.thread, m.role, m.content, "
+            "m.timestamp_ms, snippet(messages_fts, 0, '**', '**', '...', 16) "
+            f"{matches} AND messages_fts.rowid >= ? "
+            "ORDER BY messages_fts.rank LIMIT ?"
+        )
+        with self._lock:
+            first = self.db.execute(latest, params + [candidates]).fetchone()[0]
+            if first is None:
+                return []
+            rows = self.db.execute(sql, params + [first, limit]).fetchall()
+        names = ("id", "turn", "session", "thread", "role", "content", "timestamp_ms")
+        return [dict(zip(names, row), snippet=row[-1]) for row in rows]
+
+    def turn_messages(self, ids):
+        """
+        Returns the messages of the turns the messages with the given ids
+        belong to, in the order they were said.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        marks = ", ".join("?" * len(ids))
+        sql = (
+            "SELECT role, content FROM messages WHERE turn IN "
+            f"(SELECT turn FROM messages WHERE id IN ({marks})) ORDER BY id"
+        )
+        with self._lock:
+            rows = self.db.execute(sql, ids).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def clear(self, session=None):
+        """Removes every message, or those of one session, from the index."""
+        with self._lock, self.db as db:
+            if session is None:
+                db.execute("DELETE FROM messages")
+                db.execute(
+                    "INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')"
+                )
+                return
+            rows = db.execute(
+                "SELECT id, content FROM messages WHERE session = ?", (session,)
+            ).fetchall()
+            db.executemany(
+                "INSERT INTO messages_fts (messages_fts, rowid, content) "
+                "VALUES ('delete', ?, ?)",
+                rows,
+            )
+            db.execute("DELETE FROM messages WHERE session = ?", (session,))
+
+    def stats(self):
+        with self._lock:
+            messages, turns, sessions = self.db.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT turn), COUNT(DISTINCT session) "
+                "FROM messages"
+            ).fetchone()
+        return {
+            "path": self.path,
+            "messages": messages,
+            "turns": turns,
+            "sessions": sessions,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
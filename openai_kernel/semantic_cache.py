@@ -0,0 +1,373 @@
+import base64
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+import zlib
+from collections import deque
+
+from .cache import get_default_cache_dir
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+")
+LOG_FILENAME = "entries.jsonl"
+LOCK_FILENAME = "entries.lock"
+
+
+def get_default_semantic_cache_dir():
+    return os.path.join(get_default_cache_dir(), "semantic")
+
+
+def load_embedder(spec):
+    """
+    Returns the embedder named by `spec`, a 'module:attribute' string naming a
+    class or factory that takes no arguments.
+    """
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"Embedders are named 'module:attribute', not '{spec}'")
+    return getattr(importlib.import_module(module_name), attribute)()
+
+
+def fingerprint(**context):
+    """A signed 64 bit hash of the request settings and recent context."""
+    data = json.dumps(context, sort_keys=True, default=str).encode("utf-8")
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], "little", signed=True)
+
+
+class HashingEmbedder:
+    """
+    A deterministic, dependency free embedder: the words of a text and their
+    character trigrams are hashed into `dim` signed buckets. Rewordings that
+    share most of their words land close together, which is enough to catch
+    near-duplicate prompts without a model.
+
+    Other embedders need the same interface: a `name` that changes whenever
+    their vectors do, the `dim` of the vectors and `embed(texts)`, returning
+    an array (or nested lists) of shape (len(texts), dim).
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def features(self, text):
+        words = WORD_RE.findall(text.lower())
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for trigram in zip(padded, padded[1:], padded[2:]):
+                yield "".join(trigram), 0.5
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self.features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                vectors[row, h % self.dim] += sign * weight
+        return vectors
+
+
+class SemanticCache:
+    """
+    Chat answers looked up by the meaning of the prompt rather than its exact
+    text.
+
+    Prompts are embedded into the rows of a matrix held in memory, and a
+    lookup is one matrix-vector product over the entries made in the same
+    context (the request settings, the system prompt and the last
+    `context_messages` messages, see `make_key`); the most similar one is a
+    hit when its cosine similarity is at least `threshold`. Once `capacity`
+    entries are stored the least recently used one is replaced.
+
+    Entries are appended to a JSON lines log in `directory` as they are
+    added, and the log is loaded back the first time the cache is used. When
+    replaced entries make up most of it, or it was written by another
+    embedder, the log is rewritten with only the current entries, to a
+    temporary file that then replaces it.
+
+    A directory belongs to one kernel at a time: the first to write to it
+    holds a lock on it (where `fcntl` is available) until `close`, and other
+    kernels using the directory load its entries but keep their own in
+    memory only.
+    """
+
+    def __init__(
+        self,
+        directory=None,
+        capacity=1000,
+        threshold=0.9,
+        embedder=None,
+        context_messages=2,
+    ):
+        import numpy as np
+
+        self.np = np
+        self.directory = directory or get_default_semantic_cache_dir()
+        self.capacity = capacity
+        self.threshold = threshold
+        self.context_messages = context_messages
+        self.embedder = embedder or HashingEmbedder()
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+        self._clock = 0
+        # preallocated for `capacity` entries, the first len(self) rows are used
+        self._vectors = np.zeros((capacity, self.embedder.dim), dtype=np.float32)
+        self._contexts = np.zeros(capacity, dtype=np.int64)
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        self._answers = []
+        self._log = None
+        self._log_records = 0
+        self._owner = None  # the file locking the directory, False without it
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._answers)
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _allocate(self, capacity):
+        np = self.np
+        count = min(len(self._answers), capacity)
+        vectors = np.zeros((capacity, self.embedder.dim), dtype=np.float32)
+        vectors[:count] = self._vectors[:count]
+        contexts = np.zeros(capacity, dtype=np.int64)
+        contexts[:count] = self._contexts[:count]
+        last_used = np.zeros(capacity, dtype=np.int64)
+        last_used[:count] = self._last_used[:count]
+        self._vectors, self._contexts, self._last_used = vectors, contexts, last_used
+
+    def _record(self, row):
+        vector = self._vectors[row].tobytes()
+        return {
+            "row": row,
+            "context": int(self._contexts[row]),
+            "last_used": int(self._last_used[row]),
+            "answer": self._answers[row],
+            "vector": base64.b64encode(vector).decode("ascii"),
+        }
+
+    def _header(self):
+        return {"embedder": self.embedder.name, "dim": self.embedder.dim}
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self._path(LOG_FILENAME), "rb") as fid:
+                lines = fid.read().splitlines()
+        except OSError:
+            return
+        records = []
+        truncated = False
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # the last write was cut short
+                truncated = True
+                break
+        if not records or records[0] != self._header():
+            # the vectors of another embedder can't be compared with ours, so
+            # the log starts over
+            self._compact()
+            return
+        # the latest record of each row is its entry
+        rows = {record["row"]: record for record in records[1:]}
+        entries = sorted(rows.values(), key=lambda record: -record["last_used"])
+        entries = entries[: self.capacity]
+        for row, record in enumerate(entries):
+            vector = base64.b64decode(record["vector"])
+            self._vectors[row] = self.np.frombuffer(vector, dtype=self.np.float32)
+            self._contexts[row] = record["context"]
+            self._last_used[row] = record["last_used"]
+            self._answers.append(record["answer"])
+        self._clock = max((record["last_used"] for record in entries), default=0)
+        self._log_records = len(records) - 1
+        if (
+            truncated
+            or len(entries) != len(rows)
+            or any(record["row"] != row for row, record in enumerate(entries))
+        ):
+            self._compact()
+
+    def _owns_log(self):
+        """Whether this cache writes the log, taking the directory's lock."""
+        if self._owner is None:
+            os.makedirs(self.directory, exist_ok=True)
+            owner = open(self._path(LOCK_FILENAME), "ab")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    owner.close()
+                    owner = False
+                    log.warning(
+                        "The semantic cache in %s is used by another kernel, "
+                        "new entries are kept in memory only",
+                        self.directory,
+                    )
+            self._owner = owner
+        return self._owner is not False
+
+    def _append(self, row):
+        """Appends the entry in `row` to the log."""
+        if not self._owns_log():
+            return
+        if self._log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._log = open(self._path(LOG_FILENAME), "ab")
+            if self._log.tell() == 0:
+                self._log.write(json.dumps(self._header()).encode("utf-8") + b"\n")
+        self._log.write(json.dumps(self._record(row)).encode("utf-8") + b"\n")
+        self._log.flush()
+        self._log_records += 1
+        if self._log_records > 2 * max(len(self._answers), 1):
+            self._compact()
+
+    def _compact(self):
+        """Rewrites the log with only the current entries."""
+        if not self._owns_log():
+            return
+        self._close_log()
+        path = self._path(LOG_FILENAME)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as fid:
+            fid.write(json.dumps(self._header()).encode("utf-8") + b"\n")
+            for row in range(len(self._answers)):
+                fid.write(json.dumps(self._record(row)).encode("utf-8") + b"\n")
+        os.replace(tmp, path)
+        self._log_records = len(self._answers)
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def close(self):
+        """Closes the log and gives up the directory to other kernels."""
+        with self._lock:
+            self._close_log()
+            if self._owner:
+                self._owner.close()
+            self._owner = None
+
+    def embed(self, text):
+        """Returns the unit length embedding of `text`."""
+        vector = self.np.asarray(self.embedder.embed([text]), dtype=self.np.float32)[0]
+        norm = self.np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def make_key(self, messages, **settings):
+        """
+        Returns the (embedding, context fingerprint) key of a chat request:
+        the embedding of its last message and a hash of everything before it
+        that the answer depends on.
+        """
+        *earlier, prompt = messages
+        system = [msg for msg in earlier if msg["role"] == "system"]
+        history = [msg for msg in earlier if msg["role"] != "system"]
+        recent = list(deque(history, maxlen=self.context_messages))
+        context = fingerprint(system=system, recent=recent, **settings)
+        return self.embed(prompt["content"]), context
+
+    def get(self, vector, context):
+        """Returns the answer stored for the most similar prompt, if any."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            best = None
+            count = len(self._answers)
+            if count:
+                similarity = self._vectors[:count] @ vector
+                similarity[self._contexts[:count] != context] = -1.0
+                best = int(similarity.argmax())
+                if similarity[best] < self.threshold:
+                    best = None
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._last_used[best] = self._clock
+            return self._answers[best]
+
+    def put(self, vector, context, answer):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._clock += 1
+            if len(self._answers) < self.capacity:
+                row = len(self._answers)
+                self._answers.append(answer)
+            else:
+                row = int(self._last_used.argmin())
+                self._answers[row] = answer
+            self._vectors[row] = vector
+            self._contexts[row] = context
+            self._last_used[row] = self._clock
+            self._append(row)
+
+    def resize(self, capacity):
+        """Change the capacity, dropping the least recently used extra entries."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self.capacity = capacity
+            count = len(self._answers)
+            if count > capacity:
+                keep = self.np.sort(
+                    self.np.argsort(-self._last_used[:count])[:capacity]
+                )
+                self._vectors[:capacity] = self._vectors[keep]
+                self._contexts[:capacity] = self._contexts[keep]
+                self._last_used[:capacity] = self._last_used[keep]
+                self._answers = [self._answers[i] for i in keep]
+            self._allocate(capacity)
+            if count > capacity:
+                self._compact()
+
+    def clear(self):
+        with self._lock:
+            self._close_log()
+            self._answers = []
+            self._loaded = True
+            self._log_records = 0
+            self.hits = 0
+            self.misses = 0
+            if not self._owns_log():
+                return
+            try:
+                os.remove(self._path(LOG_FILENAME))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            lookups = self.hits + self.misses
+            return {
+                "directory": self.directory,
+                "embedder": self.embedder.name,
+                "entries": len(self._answers),
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
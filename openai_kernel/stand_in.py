@@ -0,0 +1,318 @@
+import base64
+import gzip
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a 1x1 PNG
+STAND_IN_IMAGE_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9"
+    "awAAAABJRU5ErkJggg=="
+)
+
+FILLER_WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit".split()
+
+
+def make_png(width, height, rng=random):
+    """Returns a `width`x`height` RGB PNG of noise, which doesn't compress."""
+    # every row starts with filter type 0
+    row_bytes = width * 3
+    raw = b"".join(
+        # Random.randbytes only exists from Python 3.9
+        b"\x00" + rng.getrandbits(row_bytes * 8).to_bytes(row_bytes, "little")
+        for _ in range(height)
+    )
+
+    def chunk(kind, data):
+        checksum = zlib.crc32(kind + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", checksum)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+# the high byte of a float32 with the sign of `byte` and a magnitude in [1/8, 1/2)
+EMBEDDING_HIGH_BYTES = bytes((byte & 0x80) | 0x3E for byte in range(256))
+
+
+def make_embedding(text, dim):
+    """Returns a deterministic embedding of `text`, as float32 bytes."""
+    data = bytearray(hashlib.shake_256(text.encode("utf-8")).digest(dim * 4))
+    # the random bits make any float, keep them to small finite ones
+    data[3::4] = data[3::4].translate(EMBEDDING_HIGH_BYTES)
+    return bytes(data)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # answer without waiting for the client's delayed ACKs, which would add
+    # about 40ms to every request the benchmarks count as kernel overhead
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.endswith("/models"):
+            models = [{"id": "gpt-3.5-turbo", "object": "model"}]
+            self.send_json(200, {"object": "list", "data": models})
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        self.server.count_request()
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.count_payload(length, len(body))
+        params = json.loads(body or b"{}")
+        failure = self.server.pick_failure()
+        if failure == "rate_limited":
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                {"Retry-After": str(self.server.retry_after)},
+            )
+        elif failure == "error":
+            self.send_json(
+                500, {"error": {"message": "Stand-in error", "type": "server_error"}}
+            )
+        elif self.path.endswith("/chat/completions"):
+            self.chat_completion(params)
+        elif self.path.endswith("/images/generations"):
+            self.image_generation(params)
+        elif self.path.endswith("/embeddings"):
+            self.embeddings(params)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+        self.server.count_busy(time.perf_counter() - start)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def chat_completion(self, params):
+        if not params.get("messages"):
+            error = {"message": "[] is too short - 'messages'", "param": "messages"}
+            self.send_json(400, {"error": {**error, "type": "invalid_request_error"}})
+            return
+        time.sleep(self.server.latency)
+        content = f"you said '{params['messages'][-1]['content']}'"
+        if len(content) < self.server.payload_size:
+            words = FILLER_WORDS * (self.server.payload_size // 6 + 1)
+            content += " " + " ".join(words)[: self.server.payload_size - len(content)]
+        base = {
+            "created": int(time.time()),
+            "id": "chatcmpl-stand-in",
+            "model": params.get("model", "gpt-3.5-turbo"),
+        }
+        if not params.get("stream"):
+            prompt_tokens = len(json.dumps(params["messages"])) // 4
+            completion_tokens = len(content.split())
+            self.send_json(
+                200,
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "finish_reason": "stop",
+                            "index": 0,
+                            "message": {"content": content, "role": "assistant"},
+                        }
+                    ],
+                    "usage": {
+                        "completion_tokens": completion_tokens,
+                        "prompt_tokens": prompt_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        deltas = [{"role": "assistant"}]
+        deltas += [{"content": t} for t in re.findall(r"\s*\S+", content)]
+        for i, delta in enumerate(deltas + [{}]):
+            choice = {
+                "delta": delta,
+                "finish_reason": "stop" if i == len(deltas) else None,
+                "index": 0,
+            }
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [choice]}
+            self.send_chunk(b"data: %s\n\n" % json.dumps(chunk).encode("utf-8"))
+            time.sleep(self.server.chunk_interval)
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def image_generation(self, params):
+        time.sleep(self.server.latency)
+        b64_json = self.server.image_b64(params.get("size", "1x1"))
+        data = [{"b64_json": b64_json} for _ in range(params.get("n", 1))]
+        self.send_json(200, {"created": int(time.time()), "data": data})
+
+    def embeddings(self, params):
+        time.sleep(self.server.latency)
+        texts = params["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+        dim = self.server.embedding_dim
+        data = []
+        for i, text in enumerate(texts):
+            vector = make_embedding(text, dim)
+            if params.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector).decode("ascii")
+            else:
+                embedding = list(struct.unpack(f"<{dim}f", vector))
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        usage = {"prompt_tokens": tokens, "total_tokens": tokens}
+        self.send_json(
+            200,
+            {"object": "list", "data": data, "model": params["model"], "usage": usage},
+        )
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A local HTTP server that speaks enough of the OpenAI chat completions,
+    image generation and embeddings endpoints to run the kernel without
+    network access. It
+    counts the connections, requests and request bytes (as received, and
+    decompressed) it receives and the time spent answering them.
+
+    Responses take `latency` seconds, streamed chunks are `chunk_interval`
+    seconds apart, and chat answers are padded to `payload_size` characters.
+    Images are noise PNGs of the requested size, and embeddings have
+    `embedding_dim` dimensions derived from a hash of the text. A random
+    `error_rate` of requests fail with a 500 and `rate_limit_rate` with a
+    429 asking to retry after `retry_after` seconds; pass a `seed` for
+    reproducible runs.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        chunk_interval=0,
+        payload_size=0,
+        error_rate=0,
+        rate_limit_rate=0,
+        retry_after=0,
+        seed=None,
+        embedding_dim=1536,
+    ):
+        super().__init__((host, port), StandInHandler)
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.payload_size = payload_size
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.connections_opened = 0
+        self.requests = 0
+        self.failures = 0
+        self.bytes_received = 0
+        self.body_bytes = 0
+        self.busy_seconds = 0.0
+        self._random = random.Random(seed)
+        self._images = {"1x1": STAND_IN_IMAGE_B64}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def get_request(self):
+        request = super().get_request()
+        with self._lock:
+            self.connections_opened += 1
+        return request
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def count_payload(self, received, body):
+        with self._lock:
+            self.bytes_received += received
+            self.body_bytes += body
+
+    def count_busy(self, seconds):
+        with self._lock:
+            self.busy_seconds += seconds
+
+    def pick_failure(self):
+        """Returns "rate_limited", "error" or None for the next request."""
+        with self._lock:
+            draw = self._random.random()
+            failure = None
+            if draw < self.rate_limit_rate:
+                failure = "rate_limited"
+            elif draw < self.rate_limit_rate + self.error_rate:
+                failure = "error"
+            self.failures += failure is not None
+        return failure
+
+    def image_b64(self, size):
+        with self._lock:
+            if size not in self._images:
+                width, height = (int(x) for x in size.split("x"))
+                png = make_png(width, height, self._random)
+                self._images[size] = base64.b64encode(png).decode("ascii")
+            return self._images[size]
+
+    def stats(self):
+        return {
+            "connections_opened": self.connections_opened,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes_received": self.bytes_received,
+            "body_bytes": self.body_bytes,
+            "busy_seconds": self.busy_seconds,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+import time
+
+
+class StartupProfile:
+    """The wall time of each phase of the kernel's startup, marked as it ends."""
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+
+def profile_imports(module="openai_kernel.kernel"):
+    """
+    Returns the cumulative import time in seconds of `module` and of every
+    top-level package it pulls in, measured with `python -X importtime` in a
+    fresh interpreter. The packages are sorted slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    total = 0.0
+    packages = {}
+    # the interpreter imports site before running anything
+    skip = {module.split(".")[0], "site"}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            seconds = int(cumulative) / 1e6
+        except ValueError:
+            # the header line
+            continue
+        name = name.strip()
+        if name == module:
+            total = seconds
+        elif "." not in name and not name.startswith("_") and name not in skip:
+            packages[name] = max(packages.get(name, 0.0), seconds)
+    return total, sorted(packages.items(), key=lambda item: -item[1])
+
+
+def format_profile(import_total, packages, profile, top=10):
+    lines = [f"Importing the kernel: {import_total * 1000:8.1f} ms"]
+    for name, seconds in packages[:top]:
+        lines.append(f"  {name:<24} {seconds * 1000:8.1f} ms")
+    lines.append(f"Starting the kernel:  {profile.total * 1000:8.1f} ms")
+    for name, seconds in profile.phases:
+        lines.append(f"  {name:<24} {seconds * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+
+def print_startup_profile(kernel_class=None):
+    """
+    Print where the time goes when a kernel starts: importing it, broken
+    down by package, and the phases of creating it.
+    """
+    import_total, packages = profile_imports()
+    if kernel_class is None:
+        from .kernel import OpenAIKernel as kernel_class
+    kernel = kernel_class()
+    print(format_profile(import_total, packages, kernel.startup_profile))
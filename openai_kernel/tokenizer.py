@@ -0,0 +1,174 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# model prefix -> encoding name, the longest matching prefix wins
+MODEL_ENCODINGS = {
+    "gpt-4": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+    "text-embedding-ada-002": "cl100k_base",
+    "text-davinci-003": "p50k_base",
+    "text-davinci-002": "p50k_base",
+}
+
+# model prefix -> (tokens per message, tokens per name field)
+MESSAGE_OVERHEAD = {
+    "gpt-3.5-turbo-0301": (4, -1),
+    "gpt-3.5-turbo": (3, 1),
+    "gpt-4": (3, 1),
+}
+DEFAULT_MESSAGE_OVERHEAD = (3, 1)
+
+# every reply is primed with <|start|>assistant<|message|>
+REPLY_PRIMING_TOKENS = 3
+
+# Process-wide encoder cache. Encoders are loaded once per encoding name; when
+# tiktoken or its BPE files are unavailable (e.g. offline) counts are estimated.
+_encodings = {}
+_lock = threading.Lock()
+
+
+class ApproximateEncoding:
+    """Stand-in encoding that estimates roughly 4 characters per token."""
+
+    name = "approximate"
+
+    def count(self, text):
+        return (len(text) + 3) // 4
+
+    def count_batch(self, texts):
+        return [self.count(text) for text in texts]
+
+
+class TiktokenEncoding:
+    """A tiktoken encoding that only exposes token counts."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = encoding.name
+
+    def count(self, text):
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_batch(self, texts):
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+
+def _lookup(table, model, default):
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    if not matches:
+        return default
+    return table[max(matches, key=len)]
+
+
+def encoding_name_for_model(model):
+    return _lookup(MODEL_ENCODINGS, model, DEFAULT_ENCODING)
+
+
+def message_overhead(model):
+    """Returns (tokens per message, tokens per name field) for a model."""
+    return _lookup(MESSAGE_OVERHEAD, model, DEFAULT_MESSAGE_OVERHEAD)
+
+
+def get_encoding(name=DEFAULT_ENCODING):
+    """
+    Returns the cached encoding called `name`, loading it on first use.
+    Falls back to an `ApproximateEncoding` if it can't be loaded.
+    """
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+    with _lock:
+        if name not in _encodings:
+            _encodings[name] = _load_encoding(name)
+        return _encodings[name]
+
+
+def _load_encoding(name):
+    try:
+        import tiktoken
+    except ImportError:  # pragma: no cover
+        return ApproximateEncoding()
+    try:
+        return TiktokenEncoding(tiktoken.get_encoding(name))
+    except Exception as e:
+        log.warning("Could not load tiktoken encoding %s, approximating: %s", name, e)
+        return ApproximateEncoding()
+
+
+def get_encoding_for_model(model):
+    return get_encoding(encoding_name_for_model(model))
+
+
+def preload(models=("gpt-3.5-turbo",), background=True):
+    """
+    Load the encodings used by `models` into the cache, on a daemon thread
+    if `background` is true. Returns the thread, or None.
+    """
+    names = {encoding_name_for_model(model) for model in models}
+
+    def load():
+        for name in names:
+            get_encoding(name)
+
+    if not background:
+        load()
+        return None
+    thread = threading.Thread(target=load, name="tokenizer-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def _message_texts(message):
+    """Yields the strings of a message that are encoded into the prompt."""
+    for key, value in message.items():
+        if value is None:
+            continue
+        if key == "function_call":
+            yield value.get("name", "")
+            yield value.get("arguments", "")
+        else:
+            yield value
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """Returns the number of tokens in a string."""
+    return get_encoding_for_model(model).count(text)
+
+
+def count_message_tokens(message, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a single message."""
+    return count_messages_tokens([message], model)[0]
+
+
+def count_messages_tokens(messages, model="gpt-3.5-turbo"):
+    """
+    Returns the number of tokens used by each message, encoding the text of
+    all the messages in one batch.
+    """
+    encoding = get_encoding_for_model(model)
+    tokens_per_message, tokens_per_name = message_overhead(model)
+
+    texts = []
+    offsets = [0]
+    for message in messages:
+        texts.extend(_message_texts(message))
+        offsets.append(len(texts))
+    text_counts = encoding.count_batch(texts)
+
+    counts = []
+    for i, message in enumerate(messages):
+        start, end = offsets[i], offsets[i + 1]
+        num_tokens = tokens_per_message + sum(text_counts[start:end])
+        if "name" in message:
+            num_tokens += tokens_per_name
+        counts.append(num_tokens)
+    return counts
+
+
+def count_prompt_tokens(messages, model="gpt-3.5-turbo"):
+    """Returns the number of prompt tokens used by a list of messages."""
+    return sum(count_messages_tokens(messages, model)) + REPLY_PRIMING_TOKENS
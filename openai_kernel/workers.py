@@ -0,0 +1,68 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+_DONE = object()
+
+
+def call_in_thread(fn, *args, **kwargs):
+    """
+    Run a blocking call on a daemon thread and wait for its result. The wait
+    can be interrupted (e.g. by KeyboardInterrupt from a kernel interrupt), in
+    which case the call is abandoned and its result discarded.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        future.cancel()
+        raise
+
+
+def iter_in_thread(fn, *args, **kwargs):
+    """
+    Yield the items of the iterable returned by `fn` while it is consumed on a
+    daemon thread. When the caller stops iterating (or is interrupted) the
+    thread stops reading and closes the iterable.
+    """
+    items = queue.Queue()
+    cancelled = threading.Event()
+
+    def run():
+        try:
+            iterable = fn(*args, **kwargs)
+            try:
+                for item in iterable:
+                    if cancelled.is_set():
+                        return
+                    items.put((item, None))
+            finally:
+                close = getattr(iterable, "close", None)
+                if cancelled.is_set() and close is not None:
+                    close()
+        except BaseException as e:
+            items.put((None, e))
+        else:
+            items.put((_DONE, None))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        cancelled.set()
@@ -29,4 +29,10 @@ setuptools.setup(
         "openai>=0.27.4,<1",
         "metakernel>=0.29.4,<1"
     ],
+    extras_require={
+        "tokens": ["tiktoken>=0.3"],
+        "images": ["Pillow"],
+        "semantic": ["numpy"],
+        "embed": ["numpy"],
+    },
 )
\ No newline at end of file
@@ -1,7 +1,17 @@
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import jupyter_kernel_test
 
+from openai_kernel.gateway import Gateway
+from openai_kernel.runner import run_files
+from openai_kernel.stand_in import StandInServer
+
 
 class OpenAIKernelTests(jupyter_kernel_test.KernelTests):
     kernel_name = "mock_openai"
@@ -85,6 +95,870 @@ class OpenAIKernelTests(jupyter_kernel_test.KernelTests):
             "'aliens have taken over earth'",
         )
 
+    def test_openai_stream(self):
+        """Stream a chat response into a single updating display"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%set stream True")
+        reply, output_msgs = self.execute_helper(code="stream this please")
+        self.assertEqual(reply["content"]["status"], "ok")
+        self.assertEqual(output_msgs[0]["header"]["msg_type"], "display_data")
+        self.assertEqual(output_msgs[-1]["header"]["msg_type"], "update_display_data")
+        display_ids = {msg["content"]["transient"]["display_id"] for msg in output_msgs}
+        self.assertEqual(len(display_ids), 1)
+        self.assertEqual(
+            output_msgs[-1]["content"]["data"]["text/markdown"],
+            "you said 'stream this please'",
+        )
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        self.assertEqual(
+            output_msgs[0]["content"]["data"]["text/plain"].count(
+                "you said 'stream this please'"
+            ),
+            1,
+        )
+        reply, output_msgs = self.execute_helper(code="%set stream False")
+
+    def test_openai_history_budget(self):
+        """The oldest turns are dropped once the history exceeds the budget"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+        reply, output_msgs = self.execute_helper(code="%set context_window 120")
+        reply, output_msgs = self.execute_helper(code="%set completion_tokens 20")
+        for i in range(5):
+            reply, output_msgs = self.execute_helper(code=f"message number {i}")
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        history = output_msgs[0]["content"]["data"]["text/plain"]
+        assert "message number 0" not in history
+        assert "you said 'message number 4'" in history
+        assert history.index("message number") < history.index("you said")
+
+        reply, output_msgs = self.execute_helper(code="%set context_window None")
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        assert "message number 0" in output_msgs[0]["content"]["data"]["text/plain"]
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_history_tokens(self):
+        """Show per-message token counts in the history"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+        reply, output_msgs = self.execute_helper(code="count my tokens")
+        reply, output_msgs = self.execute_helper(code="%history --tokens")
+        markdown = output_msgs[0]["content"]["data"]["text/markdown"]
+        self.assertEqual(markdown.count(" tokens` "), 3)
+        assert "**Total: " in markdown
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_response_cache(self):
+        """Repeated chat and image requests are answered from the cache"""
+        self.flush_channels()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        reply, output_msgs = self.execute_helper(code=f"%cache on --dir {cache_dir}")
+        for _ in range(2):
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            reply, output_msgs = self.execute_helper(code="cache this")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'cache this'",
+            )
+        reply, output_msgs = self.execute_helper(code="%mode image")
+        for _ in range(2):
+            reply, output_msgs = self.execute_helper(code="a cached picture")
+            self.assertEqual(output_msgs[0]["header"]["msg_type"], "display_data")
+            assert "image/png" in output_msgs[0]["content"]["data"]
+        reply, output_msgs = self.execute_helper(code="%mode chat")
+        reply, output_msgs = self.execute_helper(code="%cache stats")
+        stats = output_msgs[0]["content"]["data"]["text/plain"]
+        assert "'hits': 2" in stats
+        assert "'misses': 2" in stats
+        reply, output_msgs = self.execute_helper(code="%cache clear")
+        reply, output_msgs = self.execute_helper(code="%cache off")
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs NumPy")
+    def test_openai_semantic_cache(self):
+        """Rephrased prompts in the same context get the stored answer"""
+        self.flush_channels()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        reply, output_msgs = self.execute_helper(
+            code=f"%semantic_cache on --dir {cache_dir}"
+        )
+        for prompt in (
+            "What is the capital of France?",
+            "what is the capital of france",
+        ):
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            reply, output_msgs = self.execute_helper(code=prompt)
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'What is the capital of France?'",
+            )
+        # the same question after a different conversation is asked again
+        reply, output_msgs = self.execute_helper(code="what is the capital of France")
+        self.assertEqual(
+            output_msgs[0]["content"]["data"]["text/markdown"],
+            "you said 'what is the capital of France'",
+        )
+        reply, output_msgs = self.execute_helper(code="%semantic_cache stats")
+        stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(stats["entries"], 2)
+        assert os.path.exists(os.path.join(cache_dir, "entries.jsonl"))
+        reply, output_msgs = self.execute_helper(code="%semantic_cache clear")
+        reply, output_msgs = self.execute_helper(code="%semantic_cache off")
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs NumPy")
+    def test_openai_semantic_cache_embedder(self):
+        """A log written by another embedder starts over and is reloaded"""
+        self.flush_channels()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, "entries.jsonl")
+        on = f"%semantic_cache on --dir {cache_dir}"
+        reply, output_msgs = self.execute_helper(code=on)
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+        reply, output_msgs = self.execute_helper(code="the first question")
+        with open(path) as f:
+            lines = f.readlines()
+        lines[0] = json.dumps({"embedder": "another-64", "dim": 64}) + "\n"
+        with open(path, "w") as f:
+            f.writelines(lines)
+        try:
+            for expected in (0, 1):
+                reply, output_msgs = self.execute_helper(code=on)
+                reply, output_msgs = self.execute_helper(code="%semantic_cache stats")
+                stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+                self.assertEqual(stats["entries"], expected)
+                reply, output_msgs = self.execute_helper(code="%clear_history")
+                reply, output_msgs = self.execute_helper(code="the second question")
+        finally:
+            reply, output_msgs = self.execute_helper(code="%semantic_cache clear")
+            reply, output_msgs = self.execute_helper(code="%semantic_cache off")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs NumPy")
+    def test_openai_embed(self):
+        """Lines are embedded in batches, once per distinct text"""
+        import numpy as np
+
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "embeddings.npy")
+        try:
+            code = f"%set embed_cache {directory}/embeddings.sqlite"
+            reply, output_msgs = self.execute_helper(code=code)
+            reply, output_msgs = self.execute_helper(code="%set embed_batch_tokens 4")
+            reply, output_msgs = self.execute_helper(code=f"%set embed_file {path}")
+            reply, output_msgs = self.execute_helper(code="%mode embed")
+            lines = "red apples\ngreen pears\n\nred apples\nyellow bananas"
+            reply, output_msgs = self.execute_helper(code=lines)
+            self.assertEqual(reply["content"]["status"], "ok")
+            summary = output_msgs[-1]["content"]["data"]["text/markdown"]
+            assert summary.startswith("Embedded 4 lines (0 from the cache) in ")
+            assert "a 4 x 8 float32 array" in summary
+            reply, output_msgs = self.execute_helper(code="%get embedding_batches")
+            batches = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(sum(batches), 3)
+            assert len(batches) > 1
+            embeddings = np.load(path)
+            self.assertEqual((embeddings.shape, embeddings.dtype), ((4, 8), np.float32))
+            np.testing.assert_array_equal(embeddings[0], embeddings[2])
+            assert not np.array_equal(embeddings[0], embeddings[1])
+
+            reply, output_msgs = self.execute_helper(code="red apples\nplums")
+            summary = output_msgs[-1]["content"]["data"]["text/markdown"]
+            assert summary.startswith("Embedded 2 lines (1 from the cache) in 1 ")
+            np.testing.assert_array_equal(np.load(path)[0], embeddings[0])
+            reply, output_msgs = self.execute_helper(code="%get embedding_batches")
+            self.assertEqual(
+                eval(output_msgs[0]["content"]["data"]["text/plain"])[-1], 1
+            )
+        finally:
+            reply, output_msgs = self.execute_helper(code="%mode chat")
+            reply, output_msgs = self.execute_helper(code="%set embed_file None")
+            reply, output_msgs = self.execute_helper(code="%set embed_cache True")
+            reply, output_msgs = self.execute_helper(
+                code="%set embed_batch_tokens 100000"
+            )
+
+    def test_openai_gateway(self):
+        """A shared gateway coalesces and caches the requests that can be repeated"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server = StandInServer(latency=0.2)
+        url = server.start()
+        self.addCleanup(server.stop)
+        gateway = Gateway(
+            os.path.join(directory, "gateway.sock"),
+            url,
+            api_key="sk-shared",
+            use_cache=True,
+            cache_dir=os.path.join(directory, "cache"),
+        )
+        socket_path = gateway.start()
+        self.addCleanup(gateway.stop)
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        reply, output_msgs = self.execute_helper(code=f"%set gateway {socket_path}")
+        try:
+            batch = "%%batch --concurrency 4\n" + "\n".join(["same question"] * 4)
+            # sampled answers are always sent
+            reply, output_msgs = self.execute_helper(code=batch)
+            reply, output_msgs = self.execute_helper(code="%set temperature 0")
+            for _ in range(2):
+                reply, output_msgs = self.execute_helper(code=batch)
+                table = output_msgs[-1]["content"]["data"]["text/markdown"]
+                self.assertEqual(table.count("you said 'same question'"), 4)
+            reply, output_msgs = self.execute_helper(code="%mode image")
+            for _ in range(2):
+                reply, output_msgs = self.execute_helper(code="a shared picture")
+                self.assertEqual(output_msgs[0]["header"]["msg_type"], "display_data")
+            reply, output_msgs = self.execute_helper(code="%mode chat")
+            reply, output_msgs = self.execute_helper(code="%get gateway_stats")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(stats["requests"], 14)
+            self.assertEqual(stats["coalesced"], 3)
+            self.assertEqual(stats["cache_hits"], 4)
+            self.assertEqual(server.stats()["requests"], 7)
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set temperature 1")
+            reply, output_msgs = self.execute_helper(code="%set gateway None")
+            reply, output_msgs = self.execute_helper(code="%set stand_in False")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_gateway_retries(self):
+        """A request failing through a gateway is only retried by the gateway"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server = StandInServer(rate_limit_rate=1.0)
+        url = server.start()
+        self.addCleanup(server.stop)
+        gateway = Gateway(
+            os.path.join(directory, "gateway.sock"), url, request_retries=2
+        )
+        socket_path = gateway.start()
+        self.addCleanup(gateway.stop)
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        reply, output_msgs = self.execute_helper(code=f"%set gateway {socket_path}")
+        try:
+            reply, output_msgs = self.execute_helper(code="always rate limited")
+            self.assertEqual(reply["content"]["status"], "error")
+            self.assertEqual(gateway.stats()["requests"], 1)
+            self.assertEqual(server.stats()["requests"], 3)
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set gateway None")
+            reply, output_msgs = self.execute_helper(code="%set stand_in False")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_history_file(self):
+        """The history is appended to a log file and restored from it"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "history.jsonl")
+        try:
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            reply, output_msgs = self.execute_helper(code=f"%set history_file {path}")
+            for i in range(3):
+                reply, output_msgs = self.execute_helper(code=f"turn {i}")
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 6)
+            reply, output_msgs = self.execute_helper(code="%set history_file None")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            reply, output_msgs = self.execute_helper(code=f"%set history_file {path}")
+            reply, output_msgs = self.execute_helper(code="%history --last 2 --raw")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/plain"],
+                "[{'role': 'user', 'content': 'turn 2'}, "
+                "{'role': 'assistant', 'content': \"you said 'turn 2'\"}]",
+            )
+            reply, output_msgs = self.execute_helper(code="%history --range 0:1")
+            markdown = output_msgs[0]["content"]["data"]["text/markdown"]
+            assert markdown.startswith("`[0]` {'role': 'user', 'content': 'turn 0'}")
+            self.assertEqual(markdown.count("\n"), 1)
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set history_file None")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            shutil.rmtree(directory)
+
+    def test_openai_threads(self):
+        """Forked threads share their start and then diverge"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+        try:
+            reply, output_msgs = self.execute_helper(code="shared question")
+            reply, output_msgs = self.execute_helper(code="%thread fork other")
+            reply, output_msgs = self.execute_helper(code="other question")
+            reply, output_msgs = self.execute_helper(code="%history --raw")
+            history = output_msgs[0]["content"]["data"]["text/plain"]
+            assert "shared question" in history
+            assert "other question" in history
+            reply, output_msgs = self.execute_helper(code="%thread switch main")
+            reply, output_msgs = self.execute_helper(code="%history --raw")
+            history = output_msgs[0]["content"]["data"]["text/plain"]
+            assert "shared question" in history
+            assert "other question" not in history
+            reply, output_msgs = self.execute_helper(code="%thread list")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "- **main (2 messages)**\n- other (4 messages)",
+            )
+            reply, output_msgs = self.execute_helper(code="%thread switch missing")
+            self.assertEqual(output_msgs[0]["content"]["name"], "stderr")
+        finally:
+            reply, output_msgs = self.execute_helper(code="%thread switch main")
+            reply, output_msgs = self.execute_helper(code="%thread drop other")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_search(self):
+        """Turns are indexed as they happen and can be loaded back"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "search.sqlite")
+        try:
+            reply, output_msgs = self.execute_helper(code=f"%set search_index {path}")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            reply, output_msgs = self.execute_helper(code="where do zebras live")
+            reply, output_msgs = self.execute_helper(code="and the penguins")
+            reply, output_msgs = self.execute_helper(code="%search zebra* --raw")
+            hits = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(len(hits), 2)
+            self.assertEqual({hit["role"] for hit in hits}, {"user", "assistant"})
+            assert all(hit["timestamp_ms"] > 1e12 for hit in hits)
+            reply, output_msgs = self.execute_helper(code="%search zebra --limit 1")
+            markdown = output_msgs[0]["content"]["data"]["text/markdown"]
+            self.assertEqual(markdown.count("**zebras**"), 1)
+            self.assertEqual(markdown.count("\n"), 2)
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            code = f"%search --load {hits[0]['id']}"
+            reply, output_msgs = self.execute_helper(code=code)
+            reply, output_msgs = self.execute_helper(code="%history --raw")
+            history = output_msgs[0]["content"]["data"]["text/plain"]
+            assert "zebras" in history
+            assert "penguins" not in history
+            reply, output_msgs = self.execute_helper(code="%search --raw")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual((stats["messages"], stats["turns"]), (4, 2))
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set search_index None")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            shutil.rmtree(directory)
+
+    def test_openai_image_files(self):
+        """Images can be written to a directory and shown as links"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        try:
+            reply, output_msgs = self.execute_helper(code=f"%set image_dir {directory}")
+            reply, output_msgs = self.execute_helper(code="%mode image")
+            for image_display in ("link", "thumbnail"):
+                code = f"%set image_display {image_display}"
+                reply, output_msgs = self.execute_helper(code=code)
+                reply, output_msgs = self.execute_helper(code="a linked picture")
+                data = output_msgs[0]["content"]["data"]
+                assert "image/png" not in data
+                assert "generated image 0" in data["text/html"]
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            assert files[0] in data["text/html"]
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set image_display inline")
+            reply, output_msgs = self.execute_helper(code="%set image_dir None")
+            reply, output_msgs = self.execute_helper(code="%mode chat")
+            shutil.rmtree(directory)
+
+    def test_openai_over_file(self):
+        """A large file is answered in chunks, resuming from a checkpoint"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "big.log")
+        lines = [f"log line {i} with some words in it\n" for i in range(60)]
+        lines[30] = "connection_error in line 30 of the log\n"
+        with open(path, "w") as f:
+            f.writelines(lines)
+        mtime = os.stat(path).st_mtime_ns
+        cell = (
+            f"%%over_file {path} --chunk-tokens 100 --overlap 10 "
+            f"--checkpoint-dir {directory}/checkpoints\nfind the errors"
+        )
+        reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+        requests = len(eval(output_msgs[0]["content"]["data"]["text/plain"]))
+
+        reply, output_msgs = self.execute_helper(code=cell)
+        self.assertEqual(output_msgs[-1]["header"]["msg_type"], "stream")
+        assert "requests failed" in output_msgs[-1]["content"]["text"]
+        reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+        sizes = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        chunks = len(sizes) - requests
+        self.assertGreater(chunks, 3)
+
+        # fix the failing line without changing the file's size or mtime
+        lines[30] = "connection_fixed in line 30 of the log\n"
+        with open(path, "w") as f:
+            f.writelines(lines)
+        os.utime(path, ns=(mtime, mtime))
+        reply, output_msgs = self.execute_helper(code=cell)
+        answer = output_msgs[-1]["content"]["data"]["text/markdown"]
+        assert answer.startswith("you said 'find the errors")
+        assert "Combine these answers" in answer
+        reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+        sizes = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        # the chunks that failed (the line is in two with the overlap) again,
+        # then the reductions
+        reduced = len(sizes) - requests - chunks - 2
+        self.assertGreater(reduced, 0)
+        self.assertLess(reduced, chunks)
+        self.assertEqual(os.listdir(os.path.join(directory, "checkpoints")), [])
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        assert "over the file" in output_msgs[0]["content"]["data"]["text/plain"]
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_over_file_one_line(self):
+        """A file without newlines is split into chunks too"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "one_line.csv")
+        with open(path, "w") as f:
+            f.write(" ".join(f"value{i}" for i in range(500)))
+        reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+        requests = len(eval(output_msgs[0]["content"]["data"]["text/plain"]))
+        reply, output_msgs = self.execute_helper(
+            code=(
+                f"%%over_file {path} --chunk-tokens 100 --overlap 10 "
+                f"--checkpoint-dir {directory}/checkpoints\nsum the values"
+            )
+        )
+        answer = output_msgs[-1]["content"]["data"]["text/markdown"]
+        assert "Combine these answers" in answer
+        assert "(lines 1-1)" in answer
+        reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+        sizes = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertGreater(len(sizes) - requests, 5)
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_read_timeout(self):
+        """A request that takes longer than the read timeout fails"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%set read_timeout 0.2")
+        reply, output_msgs = self.execute_helper(code="slow_response please")
+        reply, _ = self.execute_helper(code="%set read_timeout 600")
+        self.assertEqual(output_msgs[0]["header"]["msg_type"], "error")
+        self.assertEqual(
+            output_msgs[0]["content"]["ename"], "<class 'openai.error.Timeout'>"
+        )
+        assert output_msgs[0]["content"]["traceback"][0].startswith(
+            "The OpenAI API did not respond in time"
+        )
+
+    def test_openai_interrupt(self):
+        """Interrupting the kernel cancels a pending request"""
+        self.flush_channels()
+        start = time.monotonic()
+        msg_id = self.kc.execute(code="slow_response please")
+        time.sleep(0.5)
+        self.km.interrupt_kernel()
+        reply = self.get_non_kernel_info_reply(timeout=5)
+        self.assertEqual(reply["parent_header"]["msg_id"], msg_id)
+        self.assertEqual(reply["content"]["status"], "error")
+        self.assertEqual(reply["content"]["ename"], "<class 'KeyboardInterrupt'>")
+        assert time.monotonic() - start < 2
+        self.flush_channels()
+
+    def test_openai_connection_reuse(self):
+        """Requests to a stand-in server reuse one pooled connection"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        for i in range(3):
+            reply, output_msgs = self.execute_helper(code=f"over http {i}")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                f"you said 'over http {i}'",
+            )
+        reply, output_msgs = self.execute_helper(code="%get stand_in_stats")
+        stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["requests"], 3)
+        reply, output_msgs = self.execute_helper(code="%get pool_stats")
+        stats = output_msgs[0]["content"]["data"]["text/plain"]
+        assert "'connections_opened': 1" in stats
+        reply, output_msgs = self.execute_helper(code="%set stand_in False")
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_request_count(self):
+        """Each chat cell sends one request, directly, to a backend or a gateway"""
+        self.flush_channels()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server = StandInServer()
+        url = server.start()
+        self.addCleanup(server.stop)
+        gateway = Gateway(os.path.join(directory, "gateway.sock"), url)
+        socket_path = gateway.start()
+        self.addCleanup(gateway.stop)
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        try:
+            reply, output_msgs = self.execute_helper(code="sent once")
+            reply, output_msgs = self.execute_helper(code="%get stand_in_stats")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(stats["requests"], 1)
+
+            reply, output_msgs = self.execute_helper(code=f"%backend add once {url}")
+            reply, output_msgs = self.execute_helper(code="sent once to a backend")
+            self.assertEqual(server.stats()["requests"], 1)
+            reply, output_msgs = self.execute_helper(code="%backend remove once")
+
+            reply, output_msgs = self.execute_helper(code=f"%set gateway {socket_path}")
+            reply, output_msgs = self.execute_helper(code="sent once to a gateway")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'sent once to a gateway'",
+            )
+            self.assertEqual(server.stats()["requests"], 2)
+            self.assertEqual(gateway.stats()["requests"], 1)
+            reply, output_msgs = self.execute_helper(code="%get stand_in_stats")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(stats["requests"], 1)
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set gateway None")
+            reply, output_msgs = self.execute_helper(code="%backend remove once")
+            reply, output_msgs = self.execute_helper(code="%set stand_in False")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_request_payload(self):
+        """Request bodies are built from pre-encoded messages and can be gzipped"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        long_prompt = "you are a bot " * 200
+        reply, output_msgs = self.execute_helper(
+            code=f"%set system_prompt {long_prompt}"
+        )
+        try:
+            reply, output_msgs = self.execute_helper(code="plain body")
+            reply, output_msgs = self.execute_helper(code="%get stand_in_stats")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(stats["bytes_received"], stats["body_bytes"])
+            assert stats["body_bytes"] > len(long_prompt)
+
+            reply, output_msgs = self.execute_helper(code="%set compress_requests True")
+            reply, output_msgs = self.execute_helper(code="%stats --raw")
+            totals = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            reply, output_msgs = self.execute_helper(code="compressed body")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'compressed body'",
+            )
+            reply, output_msgs = self.execute_helper(code="%get stand_in_stats")
+            new_stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            received = new_stats["bytes_received"] - stats["bytes_received"]
+            body = new_stats["body_bytes"] - stats["body_bytes"]
+            assert received < body / 2
+            reply, output_msgs = self.execute_helper(code="%stats --raw")
+            new_totals = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(
+                new_totals["request_bytes"], totals["request_bytes"] + received
+            )
+        finally:
+            reply, output_msgs = self.execute_helper(
+                code="%set compress_requests False"
+            )
+            reply, output_msgs = self.execute_helper(
+                code="%set system_prompt You are a helpful assistant."
+            )
+            reply, output_msgs = self.execute_helper(code="%set stand_in False")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_routing_fallback(self):
+        """Chat requests fall back to the next backend when one is down"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%set stand_in True")
+        reply, output_msgs = self.execute_helper(
+            code="%backend add offline http://127.0.0.1:9/v1"
+        )
+        try:
+            reply, output_msgs = self.execute_helper(code="%backend list --raw")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            openai_requests = stats[0]["requests"]
+            reply, output_msgs = self.execute_helper(code="anyone there")
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'anyone there'",
+            )
+            reply, output_msgs = self.execute_helper(code="%backend check --raw")
+            stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            backends = {backend["name"]: backend for backend in stats}
+            self.assertEqual(backends["offline"]["errors"], 1)
+            self.assertFalse(backends["offline"]["healthy"])
+            self.assertEqual(backends["openai"]["requests"], openai_requests + 1)
+            self.assertTrue(backends["openai"]["healthy"])
+            assert backends["openai"]["latency_ms"] is not None
+        finally:
+            reply, output_msgs = self.execute_helper(code="%backend remove offline")
+            reply, output_msgs = self.execute_helper(code="%set stand_in False")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_runner(self):
+        """Notebooks and prompt files run in-process across a process pool"""
+        directory = tempfile.mkdtemp()
+        try:
+            notebook = {
+                "cells": [
+                    {"cell_type": "markdown", "metadata": {}, "source": "# Nightly"},
+                ]
+                + [
+                    {
+                        "cell_type": "code",
+                        "execution_count": None,
+                        "metadata": {},
+                        "outputs": [],
+                        "source": source,
+                    }
+                    for source in (
+                        ["%set stream True"],
+                        ["hello ", "notebook"],
+                        ["%history --raw"],
+                        "throw a connection_error",
+                        "never run",
+                    )
+                ],
+                "metadata": {},
+                "nbformat": 4,
+                "nbformat_minor": 5,
+            }
+            with open(os.path.join(directory, "nightly.ipynb"), "w") as fid:
+                json.dump(notebook, fid)
+            with open(os.path.join(directory, "prompts.txt"), "w") as fid:
+                fid.write("first prompt\n%clear_history\n\n%history --raw\n")
+            lines = []
+            reports = run_files(
+                [
+                    os.path.join(directory, name)
+                    for name in ("nightly.ipynb", "prompts.txt")
+                ],
+                jobs=2,
+                setup=["%set system_prompt None"],
+                kernel="openai_kernel.mock_kernel:MockOpenAIKernel",
+                report=lines.append,
+            )
+            reports = {os.path.basename(r["path"]): r for r in reports}
+            self.assertEqual(
+                (reports["nightly.ipynb"]["cells"], reports["nightly.ipynb"]["errors"]),
+                (4, 1),
+            )
+            self.assertEqual(reports["nightly.ipynb"]["skipped"], 1)
+            self.assertEqual(reports["prompts.txt"]["cells"], 3)
+            self.assertEqual(len(lines), 3)
+            assert lines[-1].startswith("2 of 2 files, 7 cells in")
+
+            with open(os.path.join(directory, "nightly.out.ipynb")) as fid:
+                cells = json.load(fid)["cells"]
+            self.assertEqual(
+                [cell.get("execution_count") for cell in cells],
+                [None, 1, 2, 3, 4, None],
+            )
+            # the streamed answer is the final state of its display
+            self.assertEqual(
+                cells[2]["outputs"][0]["data"]["text/plain"],
+                "you said 'hello notebook'",
+            )
+            history = cells[3]["outputs"][0]["data"]["text/plain"]
+            assert history.startswith("[{'role': 'user', 'content': 'hello notebook'}")
+            self.assertEqual(cells[4]["outputs"][0]["output_type"], "error")
+            self.assertEqual(cells[5]["outputs"], [])
+
+            with open(os.path.join(directory, "prompts.out.jsonl")) as fid:
+                records = [json.loads(line) for line in fid]
+            self.assertEqual(
+                [record["code"] for record in records],
+                ["first prompt", "%clear_history", "%history --raw"],
+            )
+            self.assertEqual(records[2]["outputs"][0]["data"]["text/plain"], "[]")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_openai_batch(self):
+        """Run several prompts concurrently without touching the history"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+        reply, output_msgs = self.execute_helper(
+            code="%%batch --concurrency 2\nfirst row\nsecond | row\nthird row"
+        )
+        table = output_msgs[-1]["content"]["data"]["text/markdown"]
+        rows = table.splitlines()[2:]
+        self.assertEqual(len(rows), 3)
+        assert "you said 'first row'" in rows[0]
+        assert "you said 'second \\| row'" in rows[1]
+        assert "you said 'third row'" in rows[2]
+        reply, output_msgs = self.execute_helper(code="%get batch_results")
+        self.assertEqual(
+            output_msgs[0]["content"]["data"]["text/plain"],
+            "[\"you said 'first row'\", \"you said 'second | row'\", "
+            "\"you said 'third row'\"]",
+        )
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        assert "first row" not in output_msgs[0]["content"]["data"]["text/plain"]
+
+    def test_openai_race(self):
+        """The fastest model answers and the slower one is cancelled"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(
+            code="%%race gpt-slow gpt-3.5-turbo\nrace this"
+        )
+        markdown = output_msgs[-1]["content"]["data"]["text/markdown"]
+        assert markdown.startswith("you said 'race this'")
+        assert "| gpt-3.5-turbo |" in markdown.splitlines()[-1]
+        assert markdown.splitlines()[-1].endswith("| **won** |")
+        assert markdown.splitlines()[-2].endswith("| cancelled |")
+        reply, output_msgs = self.execute_helper(code="%get race_results")
+        results = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertEqual(
+            [(r["name"], r["won"], r["cancelled"]) for r in results],
+            [("gpt-slow", False, True), ("gpt-3.5-turbo", True, False)],
+        )
+
+        reply, output_msgs = self.execute_helper(
+            code="%%race --wait gpt-slow gpt-3.5-turbo\nrace this"
+        )
+        reply, output_msgs = self.execute_helper(code="%get race_results")
+        results = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        assert results[0]["first_byte"] >= 1 > results[1]["first_byte"]
+        self.assertEqual([r["won"] for r in results], [False, True])
+
+        # every model is sent, even when one answers or fails at once
+        reply, output_msgs = self.execute_helper(
+            code="%%race gpt-unknown gpt-3.5-turbo gpt-4 gpt-slow\nrace this"
+        )
+        reply, output_msgs = self.execute_helper(code="%get race_results")
+        results = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        assert all(r["started"] is not None for r in results)
+        self.assertEqual(results[0]["error"], "InvalidRequestError")
+        reply, output_msgs = self.execute_helper(code="%history --raw")
+        assert "race this" not in output_msgs[0]["content"]["data"]["text/plain"]
+
+    def test_openai_rate_limit_retry(self):
+        """A rate limited request is retried after the Retry-After delay"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%get scheduler_stats")
+        stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        start = time.monotonic()
+        reply, output_msgs = self.execute_helper(code="rate_limited at first")
+        assert time.monotonic() - start >= 0.1
+        self.assertEqual(
+            output_msgs[0]["content"]["data"]["text/markdown"],
+            "you said 'rate_limited at first'",
+        )
+        reply, output_msgs = self.execute_helper(code="%get scheduler_stats")
+        new_stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertEqual(new_stats["retries"], stats["retries"] + 1)
+        self.assertEqual(new_stats["rate_limited"], stats["rate_limited"] + 1)
+        reply, output_msgs = self.execute_helper(code="%clear_history")
+
+    def test_openai_stats(self):
+        """Each cell records its latency, tokens and cost, and can be exported"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%stats --raw")
+        stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        reply, output_msgs = self.execute_helper(code="hello")
+        reply, output_msgs = self.execute_helper(code="%stats --raw")
+        new_stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        self.assertEqual(new_stats["executions"], stats["executions"] + 1)
+        self.assertEqual(new_stats["prompt_tokens"], stats["prompt_tokens"] + 18)
+        self.assertEqual(new_stats["completion_tokens"], stats["completion_tokens"] + 9)
+        assert new_stats["cost"] > stats["cost"]
+        assert new_stats["latency_p95"] >= new_stats["latency_p50"] > 0
+        reply, output_msgs = self.execute_helper(code="%stats")
+        assert (
+            "Time to first byte" in output_msgs[0]["content"]["data"]["text/markdown"]
+        )
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "metrics.jsonl")
+            reply, output_msgs = self.execute_helper(code=f"%stats --export {path}")
+            reply, output_msgs = self.execute_helper(code="hello again")
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(len(records), new_stats["executions"] + 1)
+            self.assertEqual(records[-1]["completion_tokens"], 9)
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set metrics_file None")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+            shutil.rmtree(directory)
+
+    def test_openai_hedge(self):
+        """A request without an answer after the hedge delay is sent again"""
+        self.flush_channels()
+        reply, output_msgs = self.execute_helper(code="%stats --raw")
+        stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+        try:
+            reply, output_msgs = self.execute_helper(code="%set model gpt-4-slow")
+            reply, output_msgs = self.execute_helper(code="%set hedge_after 0.1")
+            reply, output_msgs = self.execute_helper(
+                code="%set hedge_model gpt-3.5-turbo"
+            )
+            start = time.monotonic()
+            reply, output_msgs = self.execute_helper(code="hedge this")
+            assert time.monotonic() - start < 1
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'hedge this'",
+            )
+            # only the bytes of the request that answered count for the cell
+            reply, output_msgs = self.execute_helper(code="%stats --raw")
+            sent = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            reply, output_msgs = self.execute_helper(code="%get payload_sizes")
+            sizes = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(sent["request_bytes"] - stats["request_bytes"], sizes[-1])
+            reply, output_msgs = self.execute_helper(code="%set stream True")
+            reply, output_msgs = self.execute_helper(code="hedge this stream")
+            self.assertEqual(
+                output_msgs[-1]["content"]["data"]["text/markdown"],
+                "you said 'hedge this stream'",
+            )
+            reply, output_msgs = self.execute_helper(code="%set stream False")
+
+            # a fast request is answered before the hedge delay
+            reply, output_msgs = self.execute_helper(code="%set model gpt-3.5-turbo")
+            reply, output_msgs = self.execute_helper(code="not hedged")
+            # too few times to first byte to take a percentile from
+            reply, output_msgs = self.execute_helper(code="%set model gpt-4-slow")
+            reply, output_msgs = self.execute_helper(code="%set hedge_after p95")
+            reply, output_msgs = self.execute_helper(code="not hedged either")
+
+            reply, output_msgs = self.execute_helper(code="%stats --raw")
+            new_stats = eval(output_msgs[0]["content"]["data"]["text/plain"])
+            self.assertEqual(new_stats["hedges"], stats["hedges"] + 2)
+            self.assertEqual(new_stats["hedge_wins"], stats["hedge_wins"] + 2)
+            assert new_stats["hedge_cost"] > stats["hedge_cost"]
+            reply, output_msgs = self.execute_helper(code="%stats")
+            table = output_msgs[0]["content"]["data"]["text/markdown"]
+            assert "**Hedged:** " in table
+            assert "for at least " in table
+
+            # a request that fails is hedged straight away
+            reply, output_msgs = self.execute_helper(code="%set model gpt-unknown")
+            reply, output_msgs = self.execute_helper(code="%set hedge_after 5")
+            start = time.monotonic()
+            reply, output_msgs = self.execute_helper(code="hedge this failure")
+            assert time.monotonic() - start < 1
+            self.assertEqual(
+                output_msgs[0]["content"]["data"]["text/markdown"],
+                "you said 'hedge this failure'",
+            )
+
+            reply, output_msgs = self.execute_helper(code="%set hedge_after p101")
+            self.assertEqual(output_msgs[0]["content"]["name"], "stderr")
+        finally:
+            reply, output_msgs = self.execute_helper(code="%set stream False")
+            reply, output_msgs = self.execute_helper(code="%set model gpt-3.5-turbo")
+            reply, output_msgs = self.execute_helper(code="%set hedge_after None")
+            reply, output_msgs = self.execute_helper(code="%set hedge_model None")
+            reply, output_msgs = self.execute_helper(code="%clear_history")
+
 
 if __name__ == "__main__":
     unittest.main()